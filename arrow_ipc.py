@@ -0,0 +1,40 @@
+from chunk_reader import get_arrow_column_types
+
+# Intermediate files with these extensions are Arrow IPC files (Feather V2 is the same format) instead of CSV.
+# Written uncompressed, as they are by default, a later stage can memory-map them and filter their record batches
+# in place without tokenizing, type-converting or even copying the records it does not keep.
+arrow_ipc_extensions = ('.arrow', '.feather')
+
+def is_arrow_ipc_file(file_path):
+    """Returns True for a path ending in .arrow or .feather; zip members and directories are never Arrow IPC files."""
+    return isinstance(file_path, str) and file_path.lower().endswith(arrow_ipc_extensions)
+
+def get_arrow_schema(fields_to_save, dtypes):
+    """Returns the schema of an output with the fields_to_save columns, typed as the CSV readers type them.
+
+    Categorical columns are saved as plain strings, since an Arrow IPC file cannot change a column's dictionary from
+    one record batch to the next; Parquet dictionary-encodes them by itself.
+    """
+    import pyarrow as pa
+    column_types = get_arrow_column_types(dtypes)
+    column_types = {field: column_type.value_type if pa.types.is_dictionary(column_type) else column_type for field, column_type in column_types.items()}
+    return pa.schema([(field, column_types.get(field, pa.string())) for field in fields_to_save])
+
+def read_arrow_ipc_chunks(file_path, columns_to_read=None, progress=None):
+    """Yields the record batches of an Arrow IPC file, one per chunk written, memory-mapped rather than read.
+
+    The batches point straight into the mapped file, so only the rows a filter selects are ever copied.  With a
+    ProgressReporter, the position is advanced by the size of each batch.
+    """
+    import pyarrow as pa
+    with pa.memory_map(file_path) as source:
+        reader = pa.ipc.open_file(source)
+        position = 0
+        for batch_index in range(reader.num_record_batches):
+            batch = reader.get_batch(batch_index)
+            position += batch.nbytes
+            if columns_to_read:
+                batch = batch.select(columns_to_read)
+            if progress is not None:
+                progress.set_position(min(position, source.size()))
+            yield batch
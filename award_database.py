@@ -0,0 +1,244 @@
+import os
+import re
+import sqlite3
+import pandas as pd
+from chunk_reader import to_pandas_chunk
+from output_sink import get_output_file_stem
+
+# Columns indexed in every award table, when they are among its fields, for the usual ad-hoc lookups, e.g.
+#   SELECT * FROM combined_dod
+#   WHERE awarding_office_name = 'W6QK ACC-APG' AND period_of_performance_current_end_date BETWEEN date('now') AND date('now', '+18 months')
+indexed_fields = [
+    'naics_code',
+    'product_or_service_code',
+    'awarding_agency_name',
+    'awarding_sub_agency_name',
+    'awarding_office_name',
+    'funding_agency_name',
+    'recipient_uei',
+    'period_of_performance_current_end_date',
+    'period_of_performance_potential_end_date',
+]
+
+# Rows inserted per executemany call
+insert_batch_rows = 50000
+
+# Rows read at a time from a CSV loaded into a table
+load_chunk_rows = 100000
+
+# Column of every award table with the source of each row: the cached part or CSV file it was loaded from, or ''
+# for the rows a run wrote directly
+source_column = 'load_source'
+
+# Table with the size and mtime of every source loaded into each award table, so unchanged sources are skipped
+loaded_sources_table = 'loaded_sources'
+
+def get_table_name(output_file_path):
+    """Returns the table of an output, e.g. combined_dod for C:\\temp\\awards\\out\\combined_dod.csv."""
+    return re.sub(r'\W', '_', os.path.basename(get_output_file_stem(output_file_path)))
+
+def get_column_type(dtype):
+    """Returns the SQLite column type of a dtype_mapping dtype."""
+    if str(dtype).lower().startswith('float'):
+        return 'REAL'
+    if str(dtype).lower().startswith('int'):
+        return 'INTEGER'
+    return 'TEXT'
+
+def quote_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# A local SQLite database of filtered award rows, with one table per output
+class AwardDatabase:
+    """A connection to the award database whose tables are all loaded in one transaction, committed when the
+    last table opened is finished, so a run replaces every table at once or not at all.
+
+    Readers of the WAL database keep seeing the rows of the previous run until then.
+    """
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.connection = sqlite3.connect(database_path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('BEGIN')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {loaded_sources_table} (table_name TEXT, source TEXT, size INTEGER, mtime INTEGER, PRIMARY KEY (table_name, source))')
+        self.open_tables = 0
+
+    def open_table(self, table_name, fields, dtypes=None):
+        """Returns the AwardTable with the given fields, creating it or loading it again from scratch if its fields changed."""
+        self.open_tables += 1
+        return AwardTable(self, table_name, fields, dtypes)
+
+    def release_table(self):
+        """Commits once every table opened is finished."""
+        self.open_tables -= 1
+        if self.open_tables == 0 and self.connection is not None:
+            self.connection.execute('COMMIT')
+            self.connection.close()
+            self.connection = None
+
+    def rollback(self):
+        """Drops everything done since the database was opened, leaving the rows of the previous run."""
+        if self.connection is not None:
+            self.connection.execute('ROLLBACK')
+            self.connection.close()
+            self.connection = None
+
+# One table of the award database
+class AwardTable:
+    """A table of award rows with the given fields.
+
+    Rows are inserted with executemany in batches of insert_batch_rows, and the rows of each source replace
+    those it loaded before, so the table always holds what the sources hold now.  Indexes on indexed_fields are
+    created after the first load, which is quicker than keeping them up to date row by row.
+    """
+
+    def __init__(self, database, table_name, fields, dtypes=None):
+        self.database = database
+        self.connection = database.connection
+        self.table_name = table_name
+        self.fields = list(fields)
+        self.dtypes = dtypes or {}
+        self.rows_inserted = 0
+        self.sources_loaded = set()
+
+        # A table with other fields, e.g. after fields_to_save changed, is loaded again from scratch
+        table_fields = [row[1] for row in self.connection.execute(f'PRAGMA table_info({quote_name(table_name)})')]
+        if table_fields != self.fields + [source_column]:
+            if table_fields:
+                print(f"The fields of table {table_name} changed; loading it again")
+                self.connection.execute(f'DROP TABLE {quote_name(table_name)}')
+                self.connection.execute(f'DELETE FROM {loaded_sources_table} WHERE table_name = ?', (table_name,))
+            columns = [f'{quote_name(field)} {get_column_type(self.dtypes.get(field))}' for field in self.fields] + [f'{source_column} TEXT']
+            self.connection.execute(f'CREATE TABLE {quote_name(table_name)} ({", ".join(columns)})')
+
+        self.loaded_sources = {source: (size, mtime) for source, size, mtime in
+                               self.connection.execute(f'SELECT source, size, mtime FROM {loaded_sources_table} WHERE table_name = ?', (table_name,))}
+        self.insert_statement = f'INSERT INTO {quote_name(table_name)} VALUES ({", ".join("?" * (len(self.fields) + 1))})'
+
+    def delete_source(self, source):
+        """Deletes the rows a source loaded before."""
+        self.connection.execute(f'DELETE FROM {quote_name(self.table_name)} WHERE {source_column} = ?', (source,))
+        self.connection.execute(f'DELETE FROM {loaded_sources_table} WHERE table_name = ? AND source = ?', (self.table_name, source))
+
+    def insert_chunk(self, chunk, source=''):
+        """Inserts the rows of a pandas chunk with the table's fields, replacing the rows the source loaded before on its first chunk."""
+        if source not in self.sources_loaded:
+            self.delete_source(source)
+            self.sources_loaded.add(source)
+        chunk = chunk[self.fields]
+        for batch_start in range(0, len(chunk), insert_batch_rows):
+            batch = chunk.iloc[batch_start:batch_start + insert_batch_rows]
+            rows = batch.astype(object).where(batch.notna(), None).to_numpy().tolist()
+            self.connection.executemany(self.insert_statement, [row + [source] for row in rows])
+            self.rows_inserted += len(rows)
+
+    def read_csv_chunks(self, csv_file_path):
+        """Yields the table's fields of a CSV in chunks, with the same dtypes as the filtered chunks."""
+        dtypes = {field: self.dtypes[field] for field in self.fields if field in self.dtypes}
+        yield from pd.read_csv(csv_file_path, usecols=self.fields, dtype=dtypes, chunksize=load_chunk_rows)
+
+    def load_csv(self, csv_file_path, source):
+        """Loads a CSV as the rows of source, unless it is unchanged since it was last loaded."""
+        file_stat = os.stat(csv_file_path)
+        fingerprint = (file_stat.st_size, file_stat.st_mtime_ns)
+        if self.loaded_sources.get(source) == fingerprint:
+            self.sources_loaded.add(source)
+            return
+        self.delete_source(source)
+        self.sources_loaded.add(source)
+        for chunk in self.read_csv_chunks(csv_file_path):
+            self.insert_chunk(chunk, source)
+        self.connection.execute(f'INSERT INTO {loaded_sources_table} VALUES (?, ?, ?, ?)', (self.table_name, source) + fingerprint)
+
+    def finish(self):
+        """Deletes the rows of sources not loaded in this run, creates any missing indexes, and returns the row count."""
+        for source in set(self.loaded_sources) | {''}:
+            if source not in self.sources_loaded:
+                self.delete_source(source)
+        for field in indexed_fields:
+            if field in self.fields:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {quote_name(self.table_name + "_" + field)} ON {quote_name(self.table_name)} ({quote_name(field)})')
+        row_count = self.connection.execute(f'SELECT COUNT(*) FROM {quote_name(self.table_name)}').fetchone()[0]
+        self.database.release_table()
+        return row_count
+
+# A sink stage that also loads the rows passing through it into a SQLite table
+class AwardDatabaseSink:
+    """Wraps an output sink and keeps a table of the same name in an AwardDatabase in step with the output.
+
+    Part files kept after they are appended, such as the cached results of an input file, are loaded as sources
+    of their own and skipped while unchanged, so a run with the run manifest only inserts the rows of new or
+    changed input files.  Rows written directly replace those of the previous run.  The database commits when
+    the last of its sinks closes, before that output is renamed into place, and rolls back on abort.
+    """
+
+    def __init__(self, sink, award_database, dtypes=None):
+        self.sink = sink
+        self.fields_to_save = sink.fields_to_save
+        self.output_file_path = sink.output_file_path
+        self.database_path = award_database.database_path
+        self.table = award_database.open_table(get_table_name(self.output_file_path), self.fields_to_save, dtypes)
+
+    @property
+    def records_written(self):
+        return self.sink.records_written
+
+    def write(self, filtered_chunk):
+        """Inserts the rows of a chunk and passes the chunk on."""
+        if len(filtered_chunk) == 0:
+            return
+        if not isinstance(filtered_chunk, pd.DataFrame):
+            filtered_chunk = to_pandas_chunk(filtered_chunk.select(self.fields_to_save))
+        self.table.insert_chunk(filtered_chunk)
+        self.sink.write(filtered_chunk)
+
+    def append_part(self, part_file_path, part_records, remove_part=True):
+        """Loads the rows of a part file, unless it is a kept part that is unchanged, and passes the part on."""
+        if part_records:
+            if remove_part:
+                # Temporary parts, e.g. of worker processes, are new on every run; their rows count as written directly
+                for chunk in self.table.read_csv_chunks(part_file_path):
+                    self.table.insert_chunk(chunk)
+            else:
+                self.table.load_csv(part_file_path, os.path.relpath(part_file_path, os.path.dirname(os.path.abspath(self.output_file_path))))
+        self.sink.append_part(part_file_path, part_records, remove_part)
+
+    def close(self):
+        """Finishes the table and the wrapped sink."""
+        rows_inserted = self.table.rows_inserted
+        row_count = self.table.finish()
+        self.sink.close()
+        if getattr(self.sink, 'verbose', True):
+            print(f"Inserted {rows_inserted} rows into table {self.table.table_name} of {self.database_path}, which now has {row_count} rows")
+
+    def abort(self):
+        """Rolls the database back and aborts the wrapped sink."""
+        self.table.database.rollback()
+        self.sink.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def load_csv_into_database(database_path, csv_file_path, dtypes=None):
+    """Loads an output CSV into the table of the same name, unless it is unchanged since it was last loaded, and returns the table's row count."""
+    award_database = AwardDatabase(database_path)
+    try:
+        table = award_database.open_table(get_table_name(csv_file_path), pd.read_csv(csv_file_path, nrows=0).columns, dtypes)
+        table.load_csv(csv_file_path, os.path.basename(csv_file_path))
+        row_count = table.finish()
+    except BaseException:
+        award_database.rollback()
+        raise
+    if table.rows_inserted:
+        print(f"Loaded {table.rows_inserted} rows of {csv_file_path} into table {table.table_name} of {database_path}")
+    else:
+        print(f"Skipping {csv_file_path}: table {table.table_name} is current")
+    return row_count
@@ -0,0 +1,196 @@
+import os
+import shutil
+import zlib
+import numpy as np
+import pandas as pd
+from chunk_reader import to_pandas_chunk
+from chunk_sizing import parse_memory_size, memory_sample_rows
+
+# The key of an award, and the fields that order its rows: the row with the greatest last_modified_date, and then
+# modification_number, is the latest.  Both compare as text, which orders USAspending's 'YYYY-MM-DD HH:MM:SS'
+# dates and zero-padded modification numbers (0, P00001, P00002, ...) correctly.
+award_key_field = 'contract_award_unique_key'
+latest_order_fields = ['last_modified_date', 'modification_number']
+
+# Disk partitions the rows are hashed into by award key; each is deduplicated on its own
+spill_partition_count = 64
+
+# A held award takes about this many times the size of its key and ordering fields in a DataFrame
+award_memory_overhead_factor = 2
+
+# Rows read at a time from a part file appended to the sink, or from a partition of the rows on close
+append_chunk_rows = 100000
+
+# Bookkeeping columns of the spill files: the position of the row in the input, and of the first row of its award
+row_sequence_field = 'dedup_row_sequence'
+first_sequence_field = 'dedup_first_sequence'
+
+def get_latest_per_award_fields(fields_to_save):
+    """Returns fields_to_save plus the award key and ordering fields the deduplication needs, if they are missing."""
+    return list(fields_to_save) + [field for field in [award_key_field] + latest_order_fields if field not in fields_to_save]
+
+def get_award_partition(award_key):
+    """Returns the spill partition of an award key, the same on every run and in every process."""
+    return zlib.crc32(award_key.encode('utf-8')) % spill_partition_count
+
+# A sink stage that keeps only the latest row per award, with memory bounded by spilling to disk partitions
+class LatestPerAwardSink:
+    """Wraps a StreamingCsvSink and writes it only the latest row of each contract_award_unique_key.
+
+    The rows are appended to spill_partition_count files hashed by award key as they come, and only a hash map
+    from award key to the ordering fields and positions of its latest row so far is held in memory.  When the map
+    outgrows memory_limit, it is spilled to entry files per partition as well.  On close each partition is
+    deduplicated on its own and its latest rows read back, so no more than one partition is ever in memory.
+    Awards come out grouped by partition, in the order each award was first seen within its partition, whether or
+    not the map spilled.  Ties on the ordering fields go to the row seen last.  Rows without an award key are dropped.
+    """
+
+    def __init__(self, sink, memory_limit='1GB'):
+        self.sink = sink
+        self.fields_to_save = sink.fields_to_save
+        self.output_file_path = sink.output_file_path
+        missing_fields = [field for field in [award_key_field] + latest_order_fields if field not in self.fields_to_save]
+        if missing_fields:
+            raise ValueError(f"Keeping the latest row per award needs these output fields: {', '.join(missing_fields)}")
+
+        self.memory_limit = parse_memory_size(memory_limit)
+        self.spill_directory = self.output_file_path + '.spill'
+        self.spilled = False
+        self.latest_entries = {}
+        self.bytes_per_award = None
+        self.rows_seen = 0
+        self.rows_without_key = 0
+
+    @property
+    def records_written(self):
+        return self.sink.records_written
+
+    def get_partition_file_path(self, kind, partition):
+        """Returns the spill file of a partition's rows or entries, e.g. combined_dod.csv.spill/007.rows.csv."""
+        return os.path.join(self.spill_directory, f"{partition:03d}.{kind}.csv")
+
+    def append_partition_frames(self, kind, frame, partitions):
+        """Appends the rows of a DataFrame to the kind spill file of the partition each row is hashed to."""
+        os.makedirs(self.spill_directory, exist_ok=True)
+        for partition, partition_frame in frame.groupby(partitions, sort=False):
+            partition_file_path = self.get_partition_file_path(kind, partition)
+            partition_frame.to_csv(partition_file_path, mode='a', index=False, header=not os.path.exists(partition_file_path))
+
+    def write(self, filtered_chunk):
+        """Appends the rows of a chunk to their partitions and notes those that are the latest of their award so far."""
+        if len(filtered_chunk) == 0:
+            return
+        if not isinstance(filtered_chunk, pd.DataFrame):
+            filtered_chunk = to_pandas_chunk(filtered_chunk.select(self.fields_to_save))
+        award_keys = filtered_chunk[award_key_field].to_numpy(dtype=object)
+        has_key = np.array([isinstance(award_key, str) and award_key != '' for award_key in award_keys], dtype=bool)
+        row_sequences = np.arange(self.rows_seen, self.rows_seen + len(filtered_chunk))[has_key]
+        self.rows_seen += len(filtered_chunk)
+        self.rows_without_key += len(filtered_chunk) - len(row_sequences)
+        if not len(row_sequences):
+            return
+
+        # Estimate the memory a held award takes from a sample of its key and ordering fields
+        entry_fields = filtered_chunk[[award_key_field] + latest_order_fields]
+        sample = entry_fields.iloc[::max(len(entry_fields) // memory_sample_rows, 1)]
+        sample_bytes_per_award = sample.memory_usage(deep=True, index=False).sum() / len(sample) * award_memory_overhead_factor
+        self.bytes_per_award = max(self.bytes_per_award or 0, sample_bytes_per_award)
+
+        # Hold only the ordering fields and positions of each award's latest row; missing values order first
+        latest_entries = self.latest_entries
+        order_columns = [[value if isinstance(value, str) else '' for value in entry_fields[field].to_numpy(dtype=object)[has_key]] for field in latest_order_fields]
+        for award_key, row_sequence, *order in zip(award_keys[has_key], row_sequences.tolist(), *order_columns):
+            order = tuple(order) + (row_sequence,)
+            held_entry = latest_entries.get(award_key)
+            if held_entry is None:
+                latest_entries[award_key] = (order, row_sequence)
+            elif order > held_entry[0]:
+                latest_entries[award_key] = (order, held_entry[1])
+
+        # The rows themselves go to disk, each with its position, to be read back on close
+        keyed_rows = filtered_chunk.loc[has_key, self.fields_to_save]
+        keyed_rows.insert(0, row_sequence_field, row_sequences)
+        self.append_partition_frames('rows', keyed_rows, [get_award_partition(award_key) for award_key in award_keys[has_key]])
+
+        if len(latest_entries) * self.bytes_per_award > self.memory_limit:
+            self.spill()
+
+    def append_part(self, part_file_path, part_records, remove_part=True):
+        """Adds the rows of a part CSV written by a sink with the same fields, reading it in chunks."""
+        if part_records:
+            # Read every field as text, so values are written out exactly as they were read
+            for chunk in pd.read_csv(part_file_path, dtype=str, keep_default_na=False, chunksize=append_chunk_rows):
+                self.write(chunk)
+        if remove_part and os.path.exists(part_file_path):
+            os.remove(part_file_path)
+
+    def get_entry_frame(self):
+        """Returns the held entries as a DataFrame of award keys, ordering fields and positions."""
+        return pd.DataFrame([(award_key,) + order[:-1] + (order[-1], first_sequence) for award_key, (order, first_sequence) in self.latest_entries.items()],
+                            columns=[award_key_field] + latest_order_fields + [row_sequence_field, first_sequence_field])
+
+    def spill(self):
+        """Appends the held entries to their partition's entry file and empties the map."""
+        print(f"Spilling {len(self.latest_entries)} awards for {self.output_file_path} to disk")
+        entry_frame = self.get_entry_frame()
+        self.append_partition_frames('entries', entry_frame, [get_award_partition(award_key) for award_key in entry_frame[award_key_field]])
+        self.latest_entries = {}
+        self.spilled = True
+
+    def get_partition_entries(self):
+        """Yields each partition with its entries, the latest row of every award and its first position, as a DataFrame."""
+        if not self.spilled:
+            entry_frame = self.get_entry_frame()
+            partitions = [get_award_partition(award_key) for award_key in entry_frame[award_key_field]]
+            yield from sorted(entry_frame.groupby(partitions, sort=False), key=lambda partition_entries: partition_entries[0])
+            return
+
+        self.spill()
+        for partition in range(spill_partition_count):
+            entries_file_path = self.get_partition_file_path('entries', partition)
+            if not os.path.exists(entries_file_path):
+                continue
+            entry_frame = pd.read_csv(entries_file_path, dtype=str, keep_default_na=False)
+            entry_frame[row_sequence_field] = entry_frame[row_sequence_field].astype('int64')
+            entry_frame[first_sequence_field] = entry_frame[first_sequence_field].astype('int64')
+
+            # The same award may have been spilled several times; keep its latest row and its first position
+            first_sequences = entry_frame.groupby(award_key_field)[first_sequence_field].min()
+            entry_frame = entry_frame.sort_values(latest_order_fields + [row_sequence_field], kind='stable')
+            entry_frame = entry_frame.drop_duplicates(award_key_field, keep='last')
+            yield partition, entry_frame.assign(**{first_sequence_field: entry_frame[award_key_field].map(first_sequences)})
+
+    def close(self):
+        """Writes the latest row of every award to the wrapped sink and finishes it."""
+        for partition, entry_frame in self.get_partition_entries():
+            # Read back only the latest rows of the partition, as text so values are written out exactly as they were read
+            first_sequences = entry_frame.set_index(row_sequence_field)[first_sequence_field]
+            latest_rows = []
+            for chunk in pd.read_csv(self.get_partition_file_path('rows', partition), dtype=str, keep_default_na=False, na_values=[''], chunksize=append_chunk_rows):
+                chunk[row_sequence_field] = chunk[row_sequence_field].astype('int64')
+                latest_rows.append(chunk[chunk[row_sequence_field].isin(first_sequences.index)])
+            partition_frame = pd.concat(latest_rows)
+            partition_frame = partition_frame.assign(**{first_sequence_field: partition_frame[row_sequence_field].map(first_sequences)})
+            self.sink.write(partition_frame.sort_values(first_sequence_field)[self.fields_to_save])
+        shutil.rmtree(self.spill_directory, ignore_errors=True)
+
+        if self.rows_without_key:
+            print(f"Dropped {self.rows_without_key} rows without a {award_key_field} from {self.output_file_path}")
+        if self.rows_seen:
+            print(f"Kept the latest of {self.rows_seen - self.rows_without_key} rows for each of {self.sink.records_written} awards in {self.output_file_path}")
+        self.sink.close()
+
+    def abort(self):
+        """Discards the held entries, the spill files and the wrapped sink's temp file."""
+        self.latest_entries = {}
+        shutil.rmtree(self.spill_directory, ignore_errors=True)
+        self.sink.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,288 @@
+from encoding_detection import normalize_input_encoding
+from chunk_reader import read_award_chunks, is_byte_splittable
+from file_checkpoint import read_checkpointed_chunks
+from chunk_predicates import CodeMatcher, isin_mask, equal_mask, not_equal_mask, and_masks, select_rows
+from line_audit import InputFileAudit
+from input_files import is_zip_member
+from code_index import load_current_code_index, get_indexed_runs, read_indexed_chunks
+from pipeline_metrics import FileMetrics
+from progress_report import ProgressReporter
+from arrow_ipc import is_arrow_ipc_file, read_arrow_ipc_chunks
+
+# Filter profiles describe one market segment each, e.g.
+#   {
+#       'name': 'IT',
+#       'naics_codes': {"541511", ...},                                 # None to skip the NAICS predicate
+#       'psc_codes': compile_code_matcher(["D", "R499", ...], psc_code_length),   # a set for exact matches only, None to skip
+#       'excluded_awarding_sub_agencies': {'Federal Acquisition Service'},
+#       'split_by_funding_agency': True,                                # FedCiv and DoD outputs, or one output
+#       'output_file_name_fedciv': "combined_fedciv.csv",
+#       'output_file_name_dod': "combined_dod.csv",
+#       'output_file_name': "combined.csv",                             # used when split_by_funding_agency is False
+#   }
+# All profiles are evaluated against each chunk, so the input is read and parsed only once however many there are.
+
+def get_profile_output_file_names(filter_profile):
+    """Returns the output file names of a profile, in the order filter_chunk_for_profiles returns its records."""
+    if filter_profile.get('split_by_funding_agency', True):
+        return [filter_profile['output_file_name_fedciv'], filter_profile['output_file_name_dod']]
+    return [filter_profile['output_file_name']]
+
+# A function to work out which columns the reader actually has to parse
+def get_projected_columns(filter_fields, fields_to_save):
+    """Returns the columns read by the filter predicates plus the output fields, in first-seen order."""
+    projected_columns = []
+    for field in list(filter_fields) + list(fields_to_save):
+        if field not in projected_columns:
+            projected_columns.append(field)
+    return projected_columns
+
+def get_profile_filter_fields(filter_profiles):
+    """Returns the columns read by the predicates of any of the profiles."""
+    filter_fields = []
+    for filter_profile in filter_profiles:
+        profile_fields = []
+        if filter_profile.get('naics_codes') is not None:
+            profile_fields.append('naics_code')
+        if filter_profile.get('psc_codes') is not None:
+            profile_fields.append('product_or_service_code')
+        if filter_profile.get('excluded_awarding_sub_agencies'):
+            profile_fields.append('awarding_sub_agency_name')
+        if filter_profile.get('split_by_funding_agency', True):
+            profile_fields.append('funding_agency_name')
+        filter_fields += [field for field in profile_fields if field not in filter_fields]
+    return filter_fields
+
+def get_profile_code_predicates(filter_profiles):
+    """Returns the NAICS and PSC predicates of each profile for a code index lookup, or None if a profile has neither, so any record can match."""
+    code_predicates = []
+    for filter_profile in filter_profiles:
+        code_predicate = {field_name: filter_profile[key] for key, field_name in [('naics_codes', 'naics_code'), ('psc_codes', 'product_or_service_code')]
+                          if filter_profile.get(key) is not None}
+        if not code_predicate:
+            return None
+        code_predicates.append(code_predicate)
+    return code_predicates
+
+# A function to filter one chunk for every profile based on NAICS, PSC codes, and type of agency (either fedciv or dod)
+def filter_chunk_for_profiles(chunk, filter_profiles):
+    """Returns the matching records of a chunk for each output of each profile, in profile order.
+
+    Masks shared by several profiles, such as the DoD split, are computed once per chunk.  Works on
+    pandas DataFrames and pyarrow RecordBatches alike.
+    """
+    mask_cache = {}
+    def get_mask(kind, field_name, values, make_mask):
+        key = (kind, field_name, values if isinstance(values, (str, CodeMatcher)) else frozenset(values))
+        if key not in mask_cache:
+            mask_cache[key] = make_mask(chunk, field_name, values)
+        return mask_cache[key]
+
+    def combine_masks(mask, other_mask):
+        return other_mask if mask is None else and_masks(mask, other_mask)
+
+    filtered_chunks = []
+    for filter_profile in filter_profiles:
+        # Filter the chunk based on the NAICS codes and PSC codes of the profile
+        mask = None
+        if filter_profile.get('naics_codes') is not None:
+            mask = combine_masks(mask, get_mask('isin', 'naics_code', filter_profile['naics_codes'], isin_mask))
+        if filter_profile.get('psc_codes') is not None:
+            mask = combine_masks(mask, get_mask('isin', 'product_or_service_code', filter_profile['psc_codes'], isin_mask))
+
+        # Also weed out records from excluded awarding sub agencies, e.g. GSA MAS schedule actions which we don't care about
+        for excluded_agency in filter_profile.get('excluded_awarding_sub_agencies') or []:
+            mask = combine_masks(mask, get_mask('not_equal', 'awarding_sub_agency_name', excluded_agency, not_equal_mask))
+
+        if filter_profile.get('split_by_funding_agency', True):
+            # Further filter based on the funding agency name
+            fedciv_mask = get_mask('not_equal', 'funding_agency_name', 'Department of Defense', not_equal_mask)  # Exclude DoD records
+            dod_mask = get_mask('equal', 'funding_agency_name', 'Department of Defense', equal_mask)  # Include DoD records
+            filtered_chunks.append(select_rows(chunk, combine_masks(mask, fedciv_mask)))
+            filtered_chunks.append(select_rows(chunk, combine_masks(mask, dod_mask)))
+        else:
+            filtered_chunks.append(chunk if mask is None else select_rows(chunk, mask))
+
+    return filtered_chunks
+
+# A filter chain describes a staged filter, where each stage keeps some of the records the stage before it kept, e.g.
+#   [
+#       {
+#           'name': 'DoD IT NAICS',
+#           'naics_codes': compile_code_matcher(["541511", ...], naics_code_length),   # None to skip, as in a profile
+#           'excluded_awarding_sub_agencies': {'Federal Acquisition Service'},
+#           'funding_group': 'dod',                                 # 'dod' or 'fedciv' by funding agency, None for both
+#           'tap_file_name': "dod_awards_by_naics_codes.csv",       # also save the records left after this stage; None for no tap
+#       },
+#       {'name': 'IT PSC', 'psc_codes': psc_codes_matcher},
+#   ]
+# The whole chain runs on one read of the input, and the records left after the last stage go to the chain's output.
+# Intermediate files are only written for the stages with a tap.
+funding_groups = {'dod', 'fedciv'}
+
+def get_chain_output_file_names(filter_chain, output_file_name):
+    """Returns the tap file names of a chain in stage order, then output_file_name, in the order filter_chunk_for_chain returns its records."""
+    return [stage['tap_file_name'] for stage in filter_chain if stage.get('tap_file_name')] + [output_file_name]
+
+def get_chain_tap_count(filter_chain):
+    """Returns the number of stages with a tap, whose records come before the chain's output in what filter_chunk_for_chain returns."""
+    return sum(1 for stage in filter_chain if stage.get('tap_file_name'))
+
+def count_written_rows(filtered_chunks, tap_count=0):
+    """Returns the rows written to a chunk's outputs and to its taps, the first tap_count of filtered_chunks, which repeat rows of the outputs.
+
+    A row matching several outputs is counted once for each, so this is not the number of rows that matched.
+    """
+    return sum(len(filtered_chunk) for filtered_chunk in filtered_chunks[tap_count:]), sum(len(filtered_chunk) for filtered_chunk in filtered_chunks[:tap_count])
+
+def get_chain_filter_fields(filter_chain):
+    """Returns the columns read by the predicates of any stage of the chain."""
+    filter_fields = []
+    for stage in filter_chain:
+        stage_fields = []
+        if stage.get('naics_codes') is not None:
+            stage_fields.append('naics_code')
+        if stage.get('psc_codes') is not None:
+            stage_fields.append('product_or_service_code')
+        if stage.get('excluded_awarding_sub_agencies'):
+            stage_fields.append('awarding_sub_agency_name')
+        if stage.get('funding_group'):
+            stage_fields.append('funding_agency_name')
+        filter_fields += [field for field in stage_fields if field not in filter_fields]
+    return filter_fields
+
+def get_chain_code_predicates(filter_chain):
+    """Returns the NAICS and PSC predicate of the stages up to the first tap for a code index lookup, or None if they have neither.
+
+    The stages after a tap only narrow the records of the tap, so they cannot narrow the records read.
+    """
+    code_predicate = {}
+    for stage in filter_chain:
+        for key, field_name in [('naics_codes', 'naics_code'), ('psc_codes', 'product_or_service_code')]:
+            if stage.get(key) is not None and field_name not in code_predicate:
+                code_predicate[field_name] = stage[key]
+        if stage.get('tap_file_name'):
+            break
+    return [code_predicate] if code_predicate else None
+
+def get_stage_mask(chunk, stage):
+    """Returns the mask of the records of a chunk that pass one stage of a filter chain, or None if the stage has no predicate."""
+    masks = []
+    if stage.get('naics_codes') is not None:
+        masks.append(isin_mask(chunk, 'naics_code', stage['naics_codes']))
+    if stage.get('psc_codes') is not None:
+        masks.append(isin_mask(chunk, 'product_or_service_code', stage['psc_codes']))
+    for excluded_agency in stage.get('excluded_awarding_sub_agencies') or []:
+        masks.append(not_equal_mask(chunk, 'awarding_sub_agency_name', excluded_agency))
+    funding_group = stage.get('funding_group')
+    if funding_group == 'dod':
+        masks.append(equal_mask(chunk, 'funding_agency_name', 'Department of Defense'))
+    elif funding_group == 'fedciv':
+        masks.append(not_equal_mask(chunk, 'funding_agency_name', 'Department of Defense'))
+    elif funding_group is not None:
+        raise ValueError(f"Unknown funding_group {funding_group!r} in filter stage {stage.get('name')}; use one of {', '.join(sorted(funding_groups))} or None")
+
+    mask = None
+    for stage_mask in masks:
+        mask = stage_mask if mask is None else and_masks(mask, stage_mask)
+    return mask
+
+# A function to run one chunk through every stage of a filter chain
+def filter_chunk_for_chain(chunk, filter_chain):
+    """Returns the records of a chunk left after each stage with a tap, in stage order, then the records left after the last stage.
+
+    Each stage evaluates its predicates only on the records the stages before it kept, so the later stages of a
+    selective chain cost little.  Works on pandas DataFrames and pyarrow RecordBatches alike.
+    """
+    filtered_chunks = []
+    for stage in filter_chain:
+        mask = get_stage_mask(chunk, stage)
+        if mask is not None:
+            chunk = select_rows(chunk, mask)
+        if stage.get('tap_file_name'):
+            filtered_chunks.append(chunk)
+    filtered_chunks.append(chunk)
+    return filtered_chunks
+
+# A function to filter a single csv file into the outputs of the filter profiles
+def filter_award_file(input_file_path, columns_to_read, dtypes_to_read, chunk_size, chunk_filter, filter_args, sinks, engine='pandas', checkpoint=None, quarantine_directory=None,
+                      code_predicates=None, metrics=None, progress=None, tap_count=0):
+    """Reads one award CSV, a ZipMember, or an Arrow IPC file, in chunks and writes what chunk_filter(chunk, *filter_args) returns to the sinks, one DataFrame per sink.
+
+    With a FileCheckpoint, progress is committed every checkpoint interval and an interrupted run resumes at the
+    last committed chunk; the sinks must then have been opened with resume=True when the checkpoint exists.
+    With a quarantine_directory, the malformed lines skipped are written there with their line numbers, and
+    the file's counters are recorded in its input_line_counts.json.
+    With code_predicates (see get_profile_code_predicates) and a current code index of the file, only the records
+    that can match are read; the counters then cover just those records.
+    A .arrow or .feather file is memory-mapped and its record batches filtered as written, with no code index or checkpoint.
+    With a RunMetrics, the seconds of each stage and the rows of each chunk are added to the file's metrics.
+    Progress through the file is reported to the run's ProgressReporter, or to one of the file's own.
+    The first tap_count sinks are the taps of a filter chain (see get_chain_tap_count); their rows are not counted as matches.
+    """
+    audit = InputFileAudit(input_file_path)
+    file_metrics = metrics.get_file_metrics(input_file_path) if metrics is not None else FileMetrics(input_file_path)
+    progress = progress if progress is not None else ProgressReporter([input_file_path])
+
+    # UTF-16 files are read from their UTF-8 copy, made on first use; Arrow IPC files are not text
+    arrow_ipc_input = is_arrow_ipc_file(input_file_path)
+    with file_metrics.time_stage('detect'):
+        csv_file_path, file_encoding = (input_file_path, None) if arrow_ipc_input else normalize_input_encoding(input_file_path)
+    file_metrics.set_parsed_file(csv_file_path)
+
+    # With a current code index, seek to the records that can match instead of parsing the whole file
+    code_index = load_current_code_index(csv_file_path) if code_predicates and not arrow_ipc_input else None
+    record_runs = get_indexed_runs(csv_file_path, code_index, code_predicates, engine) if code_index is not None else None
+    start_position = 0
+    if arrow_ipc_input or record_runs is not None:
+        # Indexed and Arrow IPC reads are quick, so an interrupted one starts over rather than resuming
+        if checkpoint is not None:
+            for sink in sinks:
+                sink.rewind(0, 0)
+            checkpoint.remove()
+            checkpoint = None
+        if arrow_ipc_input:
+            # An Arrow IPC intermediate is memory-mapped and its record batches filtered in place, without parsing
+            chunks = read_arrow_ipc_chunks(input_file_path, columns_to_read, progress)
+        else:
+            chunks = read_indexed_chunks(csv_file_path, code_index, record_runs, columns_to_read, dtypes_to_read, chunk_size, file_encoding, engine, progress)
+
+    # Read the CSV file in chunks and skip bad lines
+    # use small chunksize to lower memory needs
+    # Checkpoints need to seek to their offset, which a zip member streamed out of its archive cannot do cheaply
+    elif checkpoint is not None and is_byte_splittable(file_encoding) and not is_zip_member(csv_file_path):
+        chunks = read_checkpointed_chunks(csv_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding, checkpoint, sinks, engine, audit, progress)
+        start_position = checkpoint.state['offset'] if checkpoint.exists else 0
+    else:
+        chunks = read_award_chunks(csv_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding, engine=engine, audit=audit, progress=progress)
+
+    # Initialize a counter for total processed records, continuing from a checkpoint
+    total_processed_count = checkpoint.processed_count if checkpoint is not None else 0  # Counter for total records processed
+
+    progress.start_file(input_file_path, csv_file_path, start_position)
+    for chunk in file_metrics.time_chunks(chunks):
+
+        # Count the records and missing values of the current chunk
+        audit.count_chunk(chunk)
+
+        # Update the total processed count
+        total_processed_count += len(chunk)
+
+        # Append the filtered records to the outputs right away
+        with file_metrics.time_stage('filter'):
+            filtered_chunks = chunk_filter(chunk, *filter_args)
+        with file_metrics.time_stage('write'):
+            for sink, filtered_chunk in zip(sinks, filtered_chunks):
+                sink.write(filtered_chunk)
+        rows_written, tap_rows = count_written_rows(filtered_chunks, tap_count)
+        file_metrics.end_chunk(chunk, rows_written, tap_rows)
+
+        # Report the bytes and rows read and written so far, at most once per progress interval
+        progress.add_chunk(len(chunk), rows_written)
+    progress.finish_file()
+
+    # Quarantine the malformed lines and record the counters of the file
+    if quarantine_directory:
+        audit.report(quarantine_directory, csv_file_path, file_encoding)
+
+    return total_processed_count
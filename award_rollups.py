@@ -0,0 +1,209 @@
+import os
+import pandas as pd
+from chunk_reader import to_pandas_chunk
+from award_dedup import award_key_field
+from output_sink import get_output_file_stem
+
+# The fields the rollups read from each filtered row
+recipient_key_fields = ['recipient_uei', 'recipient_name']
+rollup_fields = [award_key_field, 'federal_action_obligation', 'potential_total_value_of_award'] + recipient_key_fields
+
+# How each column of the award table combines with itself, so partial tables can be combined in any grouping
+award_rollup_aggregations = {
+    'recipient_uei': 'last',
+    'recipient_name': 'last',
+    'transaction_count': 'sum',
+    'total_federal_action_obligation': 'sum',
+    'max_potential_total_value_of_award': 'max',
+}
+recipient_rollup_aggregations = {
+    'transaction_count': 'sum',
+    'total_federal_action_obligation': 'sum',
+}
+
+# Obligations are dollars and cents.  Sums are rounded to cents when saved, so float rounding from summing in a
+# different order, e.g. per file from the cache or per worker part, never changes the tables.
+amount_decimals = 2
+
+# Partial rows gathered from chunks before they are combined into the running totals
+min_combine_rows = 100000
+
+# Rows read at a time from a part file appended to the sink
+append_chunk_rows = 100000
+
+def get_rollup_fields(fields_to_save):
+    """Returns fields_to_save plus the fields the rollups read, if they are missing."""
+    return list(fields_to_save) + [field for field in rollup_fields if field not in fields_to_save]
+
+def get_rollup_file_paths(output_file_path):
+    """Returns the award-level and recipient-level tables of an output, e.g. combined_dod_awards.csv and combined_dod_recipients.csv."""
+    output_stem = get_output_file_stem(output_file_path)
+    return [output_stem + '_awards.csv', output_stem + '_recipients.csv']
+
+def combine_rollup(partial_tables, aggregations):
+    """Combines partial rollup tables indexed by their keys into one, keeping the keys in first-seen order."""
+    partial_table = pd.concat(partial_tables)
+    return partial_table.groupby(level=list(range(partial_table.index.nlevels)), sort=False, dropna=False).agg(aggregations)
+
+# Obligations rolled up per award and per recipient, one chunk at a time
+class ObligationRollup:
+    """Sums federal_action_obligation and counts transactions per award and per recipient, and takes the max
+    potential_total_value_of_award per award.
+
+    Each chunk is reduced with a vectorized groupby into a partial table, and partial tables are combined into the
+    running totals in batches, so memory grows with the number of awards rather than with the transactions.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def add_chunk(self, chunk):
+        """Adds the transactions of a pandas chunk with the rollup_fields columns."""
+        chunk = chunk.assign(transaction_count=1)
+        award_table = chunk.groupby(award_key_field, sort=False).agg(
+            recipient_uei=('recipient_uei', 'last'),
+            recipient_name=('recipient_name', 'last'),
+            transaction_count=('transaction_count', 'sum'),
+            total_federal_action_obligation=('federal_action_obligation', 'sum'),
+            max_potential_total_value_of_award=('potential_total_value_of_award', 'max'),
+        )
+        recipient_table = chunk.groupby(recipient_key_fields, sort=False, dropna=False).agg(
+            transaction_count=('transaction_count', 'sum'),
+            total_federal_action_obligation=('federal_action_obligation', 'sum'),
+        )
+        self.add_tables(award_table, recipient_table)
+
+    def add_tables(self, award_table, recipient_table):
+        """Adds partial award and recipient tables, combining them into the totals once enough have gathered."""
+        self.award_tables.append(award_table)
+        self.recipient_tables.append(recipient_table)
+        self.pending_rows += len(award_table) + len(recipient_table)
+        if self.pending_rows > max(self.combined_rows, min_combine_rows):
+            self.combine()
+
+    def combine(self):
+        """Combines the gathered partial tables into one award table and one recipient table."""
+        if len(self.award_tables) > 1:
+            self.award_tables = [combine_rollup(self.award_tables, award_rollup_aggregations)]
+            self.recipient_tables = [combine_rollup(self.recipient_tables, recipient_rollup_aggregations)]
+        self.combined_rows = sum(len(table) for table in self.award_tables + self.recipient_tables)
+        self.pending_rows = 0
+
+    def reset(self):
+        """Drops everything added so far."""
+        self.award_tables = []
+        self.recipient_tables = []
+        self.pending_rows = 0
+        self.combined_rows = 0
+
+    @property
+    def award_count(self):
+        self.combine()
+        return len(self.award_tables[0]) if self.award_tables else 0
+
+    def save(self, rollup_file_paths):
+        """Writes the award and recipient tables atomically, or removes stale ones if nothing was added."""
+        self.combine()
+        for rollup_file_path, tables in zip(rollup_file_paths, [self.award_tables, self.recipient_tables]):
+            if not tables:
+                if os.path.exists(rollup_file_path):
+                    os.remove(rollup_file_path)
+                continue
+            temp_file_path = rollup_file_path + '.tmp'
+            tables[0].round({'total_federal_action_obligation': amount_decimals}).to_csv(temp_file_path)
+            os.replace(temp_file_path, rollup_file_path)
+
+    def load(self, rollup_file_paths):
+        """Adds the award and recipient tables that save() wrote, e.g. for another input file."""
+        award_file_path, recipient_file_path = rollup_file_paths
+        if not os.path.exists(award_file_path):
+            return
+        award_table = pd.read_csv(award_file_path, index_col=0, dtype={field: 'str' for field in [award_key_field] + recipient_key_fields})
+        recipient_table = pd.read_csv(recipient_file_path, index_col=[0, 1], dtype={field: 'str' for field in recipient_key_fields})
+        self.add_tables(award_table, recipient_table)
+
+# A sink stage that rolls up the obligations of the rows passing through it
+class RollupSink:
+    """Wraps an output sink, rolls up every row written to it, and writes the award and recipient tables next to
+    the output on close.
+
+    Part files with rollup tables of their own, such as the cached results of an input file, contribute their
+    tables rather than being read again; other part files are read for the rollup columns only.  commit() and
+    rewind() keep the rollups in step with a checkpointed sink.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.fields_to_save = sink.fields_to_save
+        self.output_file_path = sink.output_file_path
+        missing_fields = [field for field in rollup_fields if field not in self.fields_to_save]
+        if missing_fields:
+            raise ValueError(f"Rolling up obligations needs these output fields: {', '.join(missing_fields)}")
+        self.rollup = ObligationRollup()
+        self.rollup_file_paths = get_rollup_file_paths(self.output_file_path)
+        self.committed_file_paths = [rollup_file_path + '.committed' for rollup_file_path in self.rollup_file_paths]
+
+    @property
+    def records_written(self):
+        return self.sink.records_written
+
+    def write(self, filtered_chunk):
+        """Adds the rows of a chunk to the rollups and passes the chunk on."""
+        if len(filtered_chunk) == 0:
+            return
+        if not isinstance(filtered_chunk, pd.DataFrame):
+            filtered_chunk = to_pandas_chunk(filtered_chunk.select(self.fields_to_save))
+        self.rollup.add_chunk(filtered_chunk[rollup_fields])
+        self.sink.write(filtered_chunk)
+
+    def append_part(self, part_file_path, part_records, remove_part=True):
+        """Adds the rollups of a part file and passes the part on."""
+        if part_records:
+            part_rollup_file_paths = get_rollup_file_paths(part_file_path)
+            if all(os.path.exists(rollup_file_path) for rollup_file_path in part_rollup_file_paths):
+                self.rollup.load(part_rollup_file_paths)
+            else:
+                dtypes = {'federal_action_obligation': 'float', 'potential_total_value_of_award': 'float', award_key_field: 'str', 'recipient_uei': 'str', 'recipient_name': 'str'}
+                for chunk in pd.read_csv(part_file_path, usecols=rollup_fields, dtype=dtypes, chunksize=append_chunk_rows):
+                    self.rollup.add_chunk(chunk)
+        self.sink.append_part(part_file_path, part_records, remove_part)
+
+    def commit(self):
+        """Saves the rollups so far alongside the wrapped sink's commit."""
+        self.rollup.save(self.committed_file_paths)
+        return self.sink.commit()
+
+    def rewind(self, position, records_written):
+        """Rewinds the wrapped sink and restores the rollups committed with it."""
+        self.sink.rewind(position, records_written)
+        self.rollup.reset()
+        if records_written:
+            self.rollup.load(self.committed_file_paths)
+
+    def remove_committed_files(self):
+        for committed_file_path in self.committed_file_paths:
+            if os.path.exists(committed_file_path):
+                os.remove(committed_file_path)
+
+    def close(self):
+        """Finishes the wrapped sink and writes the rollup tables."""
+        self.sink.close()
+        self.rollup.save(self.rollup_file_paths)
+        self.remove_committed_files()
+        if getattr(self.sink, 'verbose', True) and self.rollup.award_count:
+            print(f"Rolled up obligations for {self.rollup.award_count} awards to: {self.rollup_file_paths[0]}")
+
+    def abort(self):
+        """Aborts the wrapped sink; committed rollups are kept with its committed rows."""
+        self.sink.abort()
+        if not getattr(self.sink, 'committed', False):
+            self.remove_committed_files()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -1,121 +1,5 @@
-import pandas as pd
-import os
-import time
-import chardet
-
-def detect_file_encoding(file_path):
-    """Detects the encoding of a given file and returns it for use in pd.read_csv."""
-    try:
-        with open(file_path, 'rb') as file:
-            raw_data = file.read(10000)  # Read the first 10000 bytes
-            result = chardet.detect(raw_data)
-            encoding = result['encoding']
-            encoding = 'utf-8' if encoding == 'ascii' else encoding
-            confidence = result['confidence']
-            print(f"Detected encoding for {file_path}: {encoding} with confidence {confidence*100:.2f}")
-            return encoding  # Return the detected encoding
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None  # Return None in case of an error
-
-# A function to concatenate all filtered records into a single DataFrame by type of funding_agency (federal civilian or dod)
-def save_filtered_data(filtered_chunk, fields_to_save, output_file_path):
-    """Saves a DataFrame to a CSV file with the specified fields."""
-    if not filtered_chunk.empty:
-        # Select only the desired fields
-        final_filtered_df = filtered_chunk[fields_to_save]
-
-        # Save the filtered DataFrame to a single output file with one header
-        final_filtered_df.to_csv(output_file_path, index=False, encoding='utf-8') # save in utf-8 for maximum comptability
-
-        # Output the number of records saved
-        print(f"Filtered records saved to: {output_file_path}")
-        print(f"Number of records saved: {len(final_filtered_df)}")
-    else:
-        print("No records found matching the specified product_or_service_code values across all files.")
-
-# A function to process all csv files and filter based on NACICS, PSC codes, and type of agency (either fedciv or dod)
-def combine_and_filter_data(input_directory,output_directory,naics_codes_hash_set,psc_codes_hash_set):
-
-    output_file_name_fedciv = "combined_fedciv_HR.csv"
-    output_file_name_dod = "combined_dod_HR.csv"
-
-    output_file_path_fedciv = os.path.join(output_directory, output_file_name_fedciv)
-    output_file_path_dod = os.path.join(output_directory, output_file_name_dod)
-
-    # Process each CSV file in the input directory
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.csv'):
-            file_processing_start_time = time.time()
-            input_file_path = os.path.join(input_directory, filename)
-
-            # Initialize a counter for skipped lines and total processed records
-            skipped_lines_count = 0
-            total_processed_count = 0  # Counter for total records processed
-
-            # Read the CSV file in chunks and skip bad lines
-            # use small chunksize to lower memory needs
-            chunk_size = 250000
-            file_encoding = detect_file_encoding(input_file_path)
-            chunk_processing_start_time = time.time()
-            for chunk in pd.read_csv(input_file_path, dtype=dtype_mapping, chunksize=chunk_size, encoding=file_encoding, on_bad_lines='skip'):
-                
-                # Count skipped lines in the current chunk
-                skipped_lines_count += chunk.shape[0] - len(chunk.dropna())
-
-                # Update the total processed count
-                total_processed_count += len(chunk)
-
-                # Filter the DataFrame based on the NAICS codes and PSC codes.  Also weed out records which are actions related to GSA MAS schedule
-                filtered_chunk = chunk[
-                    (chunk['naics_code'].isin(naics_codes_hash_set)) & 
-                    #(chunk['product_or_service_code'].isin(psc_codes_hash_set)) &
-                    (chunk['awarding_sub_agency_name'] != 'Federal Acquisition Service')       # Indicator of MAS Schedule actions which we don't care about
-                ]
-
-                # Further filter based on the funding agency name
-                filtered_chunk_fedciv = filtered_chunk[filtered_chunk['funding_agency_name'] != 'Department of Defense']  # Exclude DoD records
-                filtered_chunk_dod = filtered_chunk[filtered_chunk['funding_agency_name'] == 'Department of Defense']  # Include DoD records
-
-                # Append the filtered records to the list
-                all_filtered_fedciv_data.append(filtered_chunk_fedciv)
-                all_filtered_dod_data.append(filtered_chunk_dod)
-
-                chunk_processing_duration = time.time() - chunk_processing_start_time
-                
-                # Convert duration into hours, minutes, and seconds for readability
-                chunk_hours, chunk_remainder = divmod(chunk_processing_duration, 3600)
-                chunk_minutes, chunk_seconds = divmod(chunk_remainder, 60)
-
-                # Print user-friendly execution time for each chunk
-                print(f"\t{total_processed_count} records \t\t: {int(chunk_hours)} hours, {int(chunk_minutes)} minutes, {int(chunk_seconds)} seconds")
-
-    if all_filtered_fedciv_data:
-        # Concatenate all filtered FedCiv data
-        final_filtered_fedciv_df = pd.concat(all_filtered_fedciv_data, ignore_index=True)
-        
-        # Call the function to save filtered FedCiv data
-        save_filtered_data(final_filtered_fedciv_df, fields_to_save, output_file_path_fedciv)
-
-    if all_filtered_dod_data:
-        # Concatenate all filtered DoD data
-        final_filtered_dod_df = pd.concat(all_filtered_dod_data, ignore_index=True)
-        
-        # Call the function to save filtered DoD data
-        save_filtered_data(final_filtered_dod_df, fields_to_save, output_file_path_dod)
-
-
-#start a timer to measure total elapsed time
-script_start_time = time.time()
-
-# Define the list of Product or Service Codes to filter
-# 10/9/2024 AS: Do not filter by these codes as there are several codes with prefix 'D' which pertain to IT.  BIA ITSS award is DF01
-# So for now, only use NAICS codes to weed out unneeded records.
-# psc_codes_to_filter = ["R499", "D399", "D306", "R408", "R410", "D308", "D318", "D301", "DC01", "DA01", "DF01"]
-# Convert the codes to a set for faster lookup
-# psc_codes_hash_set = set(psc_codes_to_filter)
-
-# Define data types for columns based on the original list of field types
+# Define data types for the columns of the USAspending contract transaction files, based on the original list of field types.
+# Shared by the filter scripts and the tools that need the full schema.
 dtype_mapping = {
     'contract_transaction_unique_key': 'str',
     'contract_award_unique_key': 'str',
@@ -416,92 +300,103 @@ dtype_mapping = {
     'last_modified_date': 'str',
 }
 
-# Specify the fields to save in the output file
-fields_to_save = [
-'contract_transaction_unique_key',
-'potential_total_value_of_award',
-'recipient_name',
-'transaction_description',
-'contract_award_unique_key',
-'award_id_piid',
-'modification_number',
-'transaction_number',
-'action_date',
-'action_date_fiscal_year',
-'period_of_performance_start_date',
-'period_of_performance_current_end_date',
-'period_of_performance_potential_end_date',
-'ordering_period_end_date',
-'solicitation_date',
-'awarding_agency_name',
-'awarding_sub_agency_name',
-'awarding_office_name',
-'funding_agency_name',
-'funding_sub_agency_name',
-'funding_office_name',
-'recipient_uei',
-'cage_code',
-'recipient_parent_uei',
-'recipient_parent_name',
-'primary_place_of_performance_city_name',
-'primary_place_of_performance_state_code',
-'award_or_idv_flag',
-'award_type',
-'idv_type',
-'multiple_or_single_award_idv',
-'type_of_contract_pricing',
-'action_type',
-'solicitation_identifier',
-'product_or_service_code',
-'product_or_service_code_description',
-'naics_code',
-'extent_competed',
-'type_of_set_aside',
-'number_of_offers_received',
-'contracting_officers_determination_of_business_size',
-'sba_certified_8a_joint_venture',
-'usaspending_permalink',
+# Columns with at most a few thousand distinct values in a chunk, such as agencies, offices, states and the coded
+# contract fields with their descriptions.  Read as categoricals, each value takes a small integer code instead of
+# a string of its own, and the text is kept once per chunk.
+low_cardinality_fields = [
+    'parent_award_agency_id', 'parent_award_agency_name', 'awarding_agency_code', 'awarding_agency_name',
+    'awarding_sub_agency_code', 'awarding_sub_agency_name', 'awarding_office_code', 'awarding_office_name',
+    'funding_agency_code', 'funding_agency_name', 'funding_sub_agency_code', 'funding_sub_agency_name',
+    'funding_office_code', 'funding_office_name', 'foreign_funding', 'foreign_funding_description', 'sam_exception',
+    'sam_exception_description', 'recipient_country_code', 'recipient_country_name', 'recipient_state_code',
+    'recipient_state_name', 'primary_place_of_performance_country_code', 'primary_place_of_performance_country_name',
+    'primary_place_of_performance_state_code', 'primary_place_of_performance_state_name', 'award_or_idv_flag',
+    'award_type_code', 'award_type', 'idv_type_code', 'idv_type', 'multiple_or_single_award_idv_code',
+    'multiple_or_single_award_idv', 'type_of_idc_code', 'type_of_idc', 'type_of_contract_pricing_code',
+    'type_of_contract_pricing', 'action_type_code', 'action_type', 'inherently_governmental_functions',
+    'inherently_governmental_functions_description', 'contract_bundling_code', 'contract_bundling',
+    'dod_claimant_program_description', 'recovered_materials_sustainability_code',
+    'recovered_materials_sustainability', 'domestic_or_foreign_entity_code', 'domestic_or_foreign_entity',
+    'information_technology_commercial_item_category_code', 'information_technology_commercial_item_category',
+    'epa_designated_product_code', 'epa_designated_product', 'country_of_product_or_service_origin_code',
+    'country_of_product_or_service_origin', 'place_of_manufacture_code', 'place_of_manufacture',
+    'subcontracting_plan_code', 'subcontracting_plan', 'extent_competed_code', 'extent_competed',
+    'solicitation_procedures_code', 'solicitation_procedures', 'type_of_set_aside_code', 'type_of_set_aside',
+    'evaluated_preference_code', 'evaluated_preference', 'research_code', 'research',
+    'fair_opportunity_limited_sources_code', 'fair_opportunity_limited_sources',
+    'other_than_full_and_open_competition_code', 'other_than_full_and_open_competition',
+    'commercial_item_acquisition_procedures_code', 'commercial_item_acquisition_procedures',
+    'simplified_procedures_for_certain_commercial_items_code', 'simplified_procedures_for_certain_commercial_items',
+    'a76_fair_act_action_code', 'a76_fair_act_action', 'fed_biz_opps_code', 'fed_biz_opps',
+    'local_area_set_aside_code', 'local_area_set_aside', 'clinger_cohen_act_planning_code',
+    'clinger_cohen_act_planning', 'materials_supplies_articles_equipment_code',
+    'materials_supplies_articles_equipment', 'labor_standards_code', 'labor_standards',
+    'construction_wage_rate_requirements_code', 'construction_wage_rate_requirements',
+    'interagency_contracting_authority_code', 'interagency_contracting_authority', 'parent_award_type_code',
+    'parent_award_type', 'parent_award_single_or_multiple_code', 'parent_award_single_or_multiple',
+    'national_interest_action_code', 'national_interest_action', 'cost_or_pricing_data_code', 'cost_or_pricing_data',
+    'cost_accounting_standards_clause_code', 'cost_accounting_standards_clause',
+    'government_furnished_property_code', 'government_furnished_property', 'sea_transportation_code',
+    'sea_transportation', 'undefinitized_action_code', 'undefinitized_action', 'consolidated_contract_code',
+    'consolidated_contract', 'performance_based_service_acquisition_code', 'performance_based_service_acquisition',
+    'multi_year_contract_code', 'multi_year_contract', 'contract_financing_code', 'contract_financing',
+    'purchase_card_as_payment_method_code', 'purchase_card_as_payment_method',
+    'contingency_humanitarian_or_peacekeeping_operation_code', 'contingency_humanitarian_or_peacekeeping_operation',
+    'contracting_officers_determination_of_business_size',
+    'contracting_officers_determination_of_business_size_code', 'organizational_type',
 ]
 
-# Define the list of NAICS codes to include in the final dataset
-naics_codes_to_filter = [
-     "611430", "611699", "624210", "611710"
+# The yes/no fields of the recipient's business types, 't' or 'f'.  They are read as categoricals of that text rather
+# than as booleans: one byte per value, like a nullable boolean, but written back to the CSV outputs, the SQLite
+# tables and the spill files as the same 't' and 'f' instead of True and False.
+flag_fields = [
+    'small_business_competitiveness_demonstration_program', 'alaskan_native_corporation_owned_firm',
+    'american_indian_owned_business', 'indian_tribe_federally_recognized', 'native_hawaiian_organization_owned_firm',
+    'tribally_owned_firm', 'veteran_owned_business', 'service_disabled_veteran_owned_business',
+    'woman_owned_business', 'women_owned_small_business', 'economically_disadvantaged_women_owned_small_business',
+    'joint_venture_women_owned_small_business', 'joint_venture_economic_disadvantaged_women_owned_small_bus',
+    'minority_owned_business', 'subcontinent_asian_asian_indian_american_owned_business',
+    'asian_pacific_american_owned_business', 'black_american_owned_business', 'hispanic_american_owned_business',
+    'native_american_owned_business', 'other_minority_owned_business', 'emerging_small_business',
+    'community_developed_corporation_owned_firm', 'labor_surplus_area_firm', 'us_federal_government',
+    'federally_funded_research_and_development_corp', 'federal_agency', 'us_state_government', 'us_local_government',
+    'city_local_government', 'county_local_government', 'inter_municipal_local_government', 'local_government_owned',
+    'municipality_local_government', 'school_district_local_government', 'township_local_government',
+    'us_tribal_government', 'foreign_government', 'corporate_entity_not_tax_exempt', 'corporate_entity_tax_exempt',
+    'partnership_or_limited_liability_partnership', 'sole_proprietorship', 'small_agricultural_cooperative',
+    'international_organization', 'us_government_entity', 'community_development_corporation', 'domestic_shelter',
+    'educational_institution', 'foundation', 'hospital_flag', 'manufacturer_of_goods', 'veterinary_hospital',
+    'hispanic_servicing_institution', 'receives_contracts', 'receives_financial_assistance',
+    'receives_contracts_and_financial_assistance', 'airport_authority', 'council_of_governments',
+    'housing_authorities_public_tribal', 'interstate_entity', 'planning_commission', 'port_authority',
+    'transit_authority', 'subchapter_scorporation', 'limited_liability_corporation', 'foreign_owned',
+    'for_profit_organization', 'nonprofit_organization', 'other_not_for_profit_organization',
+    'the_ability_one_program', 'private_university_or_college', 'state_controlled_institution_of_higher_learning',
+    '1862_land_grant_college', '1890_land_grant_college', '1994_land_grant_college', 'minority_institution',
+    'historically_black_college', 'tribal_college', 'alaskan_native_servicing_institution',
+    'native_hawaiian_servicing_institution', 'school_of_forestry', 'veterinary_college',
+    'dot_certified_disadvantage', 'self_certified_small_disadvantaged_business', 'small_disadvantaged_business',
+    'c8a_program_participant', 'historically_underutilized_business_zone_hubzone_firm',
+    'sba_certified_8a_joint_venture',
 ]
 
-# Convert the NAICS codes to a set for faster lookup
-naics_codes_hash_set = set(naics_codes_to_filter)
-
-# Define the list of PSC codes to include in the final dataset.
-psc_codes_to_filter = ["R499", "D399", "D306", "R408", "R410", "D308", "D318", "D301", "DC01", "DA01", "DF01", 
-                       "D","D3","D301","D302","D303","D304","D305",
-                       "D306","D307","D308","D309","D310","D311",
-                       "D312","D313","D314","D315","D316","D317",
-                       "D318","D319","D320","D321","D322","D324","D325","D399","DA","DA01","DA10",
-                       "DB","DB01","DB02","DB10","DC","DC01","DC10","DD","DD01","DE","DE01","DE02",
-                       "DE10","DE11","DF","DF01","DF10","DG","DG01","DG10","DG11","DH","DH01",
-                       "DH10","DJ","DJ01","DJ10","DJ10","DK","DK01","DK10",
-                       ]
-# Convert the codes to a set for faster lookup
-psc_codes_hash_set = set(psc_codes_to_filter)
-
-# Define the input directory and output directory
-input_directory = r"C:\temp\awards"  
-output_directory = os.path.join(input_directory, "out")
-
-# Create the output directory if it does not exist
-os.makedirs(output_directory, exist_ok=True)
-
-# Initialize an array to hold filtered records from all files
-all_filtered_fedciv_data = []
-all_filtered_dod_data = []
-
-combine_and_filter_data(input_directory,output_directory,naics_codes_hash_set,psc_codes_hash_set)
-#End the timer to measure total script elapsed time
-script_duration = time.time() - script_start_time
-
-# Convert duration into hours, minutes, and seconds for readability
-hours, remainder = divmod(script_duration, 3600)
-minutes, seconds = divmod(remainder, 60)
+# Integer columns with a narrower type that holds every value they can have; a value that does not fit stops the read
+# with an error rather than being changed.  Amounts stay float64, since float32 would round cents off large awards.
+narrow_integer_types = {
+    'action_date_fiscal_year': 'Int16',
+    'number_of_actions': 'Int32',
+    'number_of_offers_received': 'Int32',
+}
 
-# Print user-friendly execution time
-print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
\ No newline at end of file
+def get_compact_dtype_mapping(dtype_mapping):
+    """Returns dtype_mapping with the low-cardinality and flag fields as categoricals and the narrower integer types; the other columns keep their dtypes."""
+    compact_dtype_mapping = {}
+    for column, dtype in dtype_mapping.items():
+        if column in low_cardinality_fields or column in flag_fields:
+            compact_dtype_mapping[column] = 'category'
+        else:
+            compact_dtype_mapping[column] = narrow_integer_types.get(column, dtype)
+    return compact_dtype_mapping
+
+# The compact schema the filter scripts read with, unless they turn it off
+compact_dtype_mapping = get_compact_dtype_mapping(dtype_mapping)
@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import shutil
+import importlib.util
+from contextlib import redirect_stdout
+
+# The scripts and modules benchmarked live in the parent directory
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repository_directory not in sys.path:
+    sys.path.insert(0, repository_directory)
+
+from chunk_sizing import AdaptiveChunkSize
+from encoding_detection import encoding_cache_name, utf8_copy_directory_name
+from pipeline_metrics import metrics_history_file_name
+
+# The scripts a case can run
+benchmark_scripts = ['combine and filter.py', 'filter by psc.py', 'filter5.py']
+
+def load_script(script_file_name):
+    """Imports one of the filter scripts, whose file names are not module names, without starting its run."""
+    module_name = os.path.splitext(script_file_name)[0].replace(' ', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(repository_directory, script_file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def get_chunk_size(chunk_size):
+    """Returns the chunk_size setting of a case: a row count, or an AdaptiveChunkSize for a memory budget such as 'auto'."""
+    return chunk_size if isinstance(chunk_size, int) else AdaptiveChunkSize(chunk_size)
+
+def get_peak_rss():
+    """Returns the peak resident memory of this process in bytes, or None where it cannot be read.
+
+    Linux keeps ru_maxrss across fork and exec, so a case process would report the peak of the process that
+    started it; the high-water mark of its own address space is read instead.
+    """
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        pass
+    try:
+        import resource
+        # ru_maxrss is in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return None
+
+def count_output_rows(output_directory):
+    """Returns the number of records in the filtered outputs of a case, leaving out quarantined lines and the metrics history."""
+    import pandas as pd
+    output_rows = 0
+    for file_name in os.listdir(output_directory):
+        if file_name.endswith('.csv') and not file_name.endswith('_bad_lines.csv') and file_name != metrics_history_file_name:
+            output_rows += sum(len(chunk) for chunk in pd.read_csv(os.path.join(output_directory, file_name), usecols=[0], dtype=str, chunksize=1000000))
+    return output_rows
+
+def clear_input_caches(input_directory):
+    """Removes the encoding cache and UTF-8 copies of an input directory, so every case reads its input as a first run would."""
+    encoding_cache_path = os.path.join(input_directory, encoding_cache_name)
+    if os.path.exists(encoding_cache_path):
+        os.remove(encoding_cache_path)
+    shutil.rmtree(os.path.join(input_directory, utf8_copy_directory_name), ignore_errors=True)
+
+def prepare_script_run(case, output_directory):
+    """Imports the script of a case and returns a function that runs it over the case's input with the case's settings."""
+    input_directory = os.path.dirname(case['input_file'])
+    chunk_size = get_chunk_size(case['chunk_size'])
+    if case['script'] == 'combine and filter.py':
+        script = load_script(case['script'])
+        # Measure the filtering itself, without the caches that let a re-run skip it
+        script.use_run_manifest = False
+        script.use_code_index = False
+        script.award_database_path = None
+        script.chunk_size = chunk_size
+        script.csv_engine = case['engine']
+        script.parallel_workers = case['parallel_workers']
+        script.output_directory = output_directory
+        return lambda: script.combine_and_filter_data(input_directory, output_directory, script.filter_profiles)
+    if case['script'] == 'filter by psc.py':
+        script = load_script(case['script'])
+        # The NAICS and PSC stages run fused on the raw input, as the script runs by default
+        script.use_code_index = False
+        script.chunk_size = chunk_size
+        script.csv_engine = case['engine']
+        return lambda: script.filter_chain_files(input_directory, output_directory, script.filter_chain, 'dod_awards_by_naics_and_psc_codes_isnotin.csv')
+    if case['script'] == 'filter5.py':
+        import filter5
+        filter5.chunk_size = chunk_size
+        filter5.csv_engine = case['engine']
+        filter5.parallel_workers = case['parallel_workers']
+        return lambda: filter5.filter_psc_files(input_directory, output_directory)
+    raise ValueError(f"Unknown benchmark script {case['script']}; choose one of {', '.join(benchmark_scripts)}")
+
+def run_case(case, output_directory):
+    """Runs one benchmark case in this process and returns its measurements.
+
+    Meant to run in a fresh spawned process per case, so the peak resident memory is that of the case alone;
+    the worker processes of parallel cases are not included.  The scripts' progress messages are discarded.
+    """
+    clear_input_caches(os.path.dirname(case['input_file']))
+    shutil.rmtree(output_directory, ignore_errors=True)
+    os.makedirs(output_directory)
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        run_script = prepare_script_run(case, output_directory)
+        start_time = time.perf_counter()
+        run_script()
+        seconds = time.perf_counter() - start_time
+    peak_rss_bytes = get_peak_rss()
+
+    input_bytes = os.path.getsize(case['input_file'])
+    output_rows = count_output_rows(output_directory)
+    shutil.rmtree(output_directory, ignore_errors=True)
+    return {
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(case['rows'] / seconds),
+        'megabytes_per_second': round(input_bytes / 1e6 / seconds, 2),
+        'peak_rss_bytes': peak_rss_bytes,
+        'input_bytes': input_bytes,
+        'output_rows': output_rows,
+    }
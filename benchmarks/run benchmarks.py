@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import multiprocessing
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+# The scripts and modules benchmarked live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from award_schema import dtype_mapping
+from synthetic_awards import generate_award_file
+from benchmark_cases import run_case, repository_directory
+
+#start a timer to measure total elapsed time
+script_start_time = time.time()
+
+# Generate seeded synthetic USAspending contract files and time the filter scripts on them across a sweep of file
+# sizes, chunk sizes, selectivities, engines and encodings.  Each case runs in a fresh process and is appended to
+# the results file as one JSON object with its settings, rows/s, MB/s and peak resident memory, so runs before and
+# after a change can be compared.  Generated files are kept and reused while their settings are unchanged.
+
+# Directory for the generated inputs, the outputs of the case running, and the results
+benchmark_directory = r"C:\temp\awards_benchmarks"
+results_file_path = os.path.join(benchmark_directory, "benchmark_results.jsonl")
+
+# The sweep: every combination is one case.  Rows are about 1.7 KB each, so 500,000 rows make an 850 MB file.
+scripts_to_run = ['combine and filter.py', 'filter by psc.py', 'filter5.py']
+file_row_counts = [50000, 500000]
+chunk_sizes = [50000, 250000, 'auto']   # rows per chunk, or a memory budget for AdaptiveChunkSize
+match_fractions = [0.01, 0.1]           # share of rows with a matching NAICS code, and separately a matching PSC code
+csv_engines = ['pandas', 'pyarrow']
+file_encodings = ['utf-8', 'utf-16']    # utf-16 cases include making the UTF-8 copy, as on a first run
+parallel_worker_counts = [1]
+
+# Seed of the generator, share of multiline descriptions, and times each case is run
+seed = 0
+multiline_share = 0.01
+repeats = 1
+
+def get_input_file_path(rows, match_fraction, encoding):
+    """Returns the generated input of a case, in a directory of its own since the scripts read whole directories."""
+    dataset_name = f"awards_{rows}_rows_{match_fraction}_match_{encoding}_seed_{seed}"
+    return os.path.join(benchmark_directory, "inputs", dataset_name, dataset_name + ".csv")
+
+def get_git_commit():
+    """Returns the commit of the scripts benchmarked, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository_directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_environment():
+    """Returns what the results depend on besides the case settings."""
+    import pandas as pd
+    try:
+        import pyarrow
+        pyarrow_version = pyarrow.__version__
+    except ImportError:
+        pyarrow_version = None
+    return {
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'pyarrow': pyarrow_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+# Guard the run so the case processes can import this script without starting another run
+if __name__ == '__main__':
+    os.makedirs(benchmark_directory, exist_ok=True)
+    environment = get_environment()
+    run_started = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    # Generate the inputs that do not exist yet
+    for rows, match_fraction, encoding in itertools.product(file_row_counts, match_fractions, file_encodings):
+        input_file_path = get_input_file_path(rows, match_fraction, encoding)
+        if not os.path.exists(input_file_path):
+            os.makedirs(os.path.dirname(input_file_path), exist_ok=True)
+            print(f"Generating {input_file_path}")
+            generate_award_file(input_file_path, rows, dtype_mapping, seed, match_fraction, multiline_share, encoding)
+
+    cases = []
+    for script, rows, chunk_size, match_fraction, engine, encoding, parallel_workers in itertools.product(
+            scripts_to_run, file_row_counts, chunk_sizes, match_fractions, csv_engines, file_encodings, parallel_worker_counts):
+        cases.append({
+            'script': script,
+            'rows': rows,
+            'chunk_size': chunk_size,
+            'match_fraction': match_fraction,
+            'engine': engine,
+            'encoding': encoding,
+            'parallel_workers': parallel_workers,
+            'input_file': get_input_file_path(rows, match_fraction, encoding),
+        })
+
+    output_directory = os.path.join(benchmark_directory, "case_output")
+    for case_number, case in enumerate(cases * repeats, start=1):
+        # A fresh spawned process per case, so neither this process nor an earlier case adds to its peak memory
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as case_executor:
+            measurements = case_executor.submit(run_case, case, output_directory).result()
+
+        result = {'run_started': run_started, **case, **measurements, **environment}
+        with open(results_file_path, 'a', encoding='utf-8') as results_file:
+            results_file.write(json.dumps(result) + '\n')
+        peak_rss = f"{measurements['peak_rss_bytes'] / 1e6:.0f} MB" if measurements['peak_rss_bytes'] else "n/a"
+        print(f"{case_number}/{len(cases) * repeats} {case['script']}, {case['rows']} rows, chunk {case['chunk_size']}, match {case['match_fraction']}, {case['engine']}, "
+              f"{case['encoding']}: {measurements['rows_per_second']} rows/s, {measurements['megabytes_per_second']} MB/s, peak RSS {peak_rss}")
+
+    print(f"Results appended to: {results_file_path}")
+
+    #End the timer to measure total script elapsed time
+    script_duration = time.time() - script_start_time
+
+    # Convert duration into hours, minutes, and seconds for readability
+    hours, remainder = divmod(script_duration, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    # Print user-friendly execution time
+    print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
@@ -0,0 +1,157 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Codes the filter scripts select, by default: the IT NAICS codes of "combine and filter.py" and the PSC codes of
+# filter5.py, which "filter by psc.py" also selects
+matching_naics_codes = ["541511", "541512", "541513", "541519", "541611", "541612", "541613", "541614", "541618", "541620", "541690"]
+matching_psc_codes = ["R499", "D399", "D306", "R408", "R410", "D308", "D318", "D301", "DC01", "DA01"]
+
+# Common codes of federal contract transactions that none of the scripts select, most frequent first
+other_naics_codes = [
+    "336411", "541330", "236220", "541712", "561210", "562910", "336611", "334511", "237990", "325412",
+    "488190", "561612", "531120", "541990", "336413", "423430", "238220", "621111", "541380", "561720",
+    "336992", "811219", "541715", "221122", "236210", "332994", "334220", "424210", "493110", "722310",
+]
+other_psc_codes = [
+    "R425", "J099", "Z2AA", "AC13", "S206", "Y1AA", "R706", "6515", "5340", "Q201",
+    "7030", "1560", "AJ11", "V231", "Z1AA", "C1AA", "J019", "S201", "6640", "R699",
+    "B549", "7A21", "4730", "5998", "8415", "6150", "Q999", "F999", "H999", "Z2JZ",
+]
+
+# Share of transactions funded by the Department of Defense, and of actions by GSA's Federal Acquisition Service
+dod_share = 0.55
+federal_acquisition_service_share = 0.05
+
+# Transactions per award, on average
+transactions_per_award = 3
+
+# Share of empty values in the columns that are often empty in USAspending files
+missing_share = 0.3
+
+# Rows generated and written at a time
+generate_chunk_rows = 50000
+
+other_agency_names = ["Department of Veterans Affairs", "Department of Health and Human Services", "Department of Homeland Security",
+                      "General Services Administration", "Department of Energy", "Department of the Treasury", "Department of Justice",
+                      "National Aeronautics and Space Administration", "Department of Agriculture", "Department of the Interior"]
+dod_sub_agency_names = ["Department of the Army", "Department of the Navy", "Department of the Air Force", "Defense Logistics Agency", "Defense Information Systems Agency"]
+description_words = ["SUPPORT", "SERVICES", "IT", "MODERNIZATION", "SYSTEM", "ENGINEERING", "MAINTENANCE", "SOFTWARE", "LICENSE",
+                     "OPTION", "YEAR", "FUNDING", "INCREMENTAL", "PROGRAM", "MANAGEMENT", "CLOUD", "HOSTING", "DATA", "ANALYTICS", "TRAINING"]
+
+def get_zipf_weights(count, exponent=1.1):
+    """Returns weights for count values that fall off like the code frequencies of real award files."""
+    weights = 1 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+def choose_codes(random, rows, matching_codes, other_codes, match_fraction):
+    """Returns one code per row, from matching_codes for about match_fraction of them and from other_codes otherwise."""
+    matches = random.random(rows) < match_fraction
+    codes = random.choice(np.array(other_codes, dtype=object), rows, p=get_zipf_weights(len(other_codes)))
+    codes[matches] = random.choice(np.array(matching_codes, dtype=object), matches.sum(), p=get_zipf_weights(len(matching_codes)))
+    return codes
+
+def choose_dates(random, rows, start='2015-10-01', days=4000, with_time=False):
+    """Returns random dates as USAspending writes them, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'."""
+    dates = np.datetime64(start, 's') + random.integers(0, days * 86400, rows).astype('timedelta64[s]')
+    if with_time:
+        return pd.Series(dates).dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype=object)
+    return pd.Series(dates).dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+
+def choose_descriptions(random, rows, multiline_share):
+    """Returns transaction descriptions of a few words, with embedded newlines, quotes and commas in multiline_share of them."""
+    word_counts = random.integers(2, 12, rows)
+    words = random.choice(np.array(description_words, dtype=object), (rows, 12))
+    descriptions = np.array([' '.join(row_words[:word_count]) for row_words, word_count in zip(words, word_counts)], dtype=object)
+    for row in np.flatnonzero(random.random(rows) < multiline_share):
+        descriptions[row] = f'{descriptions[row]},\n"{description_words[row % len(description_words)]}" PHASE {row % 7}\nSEE ATTACHMENT'
+    return descriptions
+
+def with_missing(random, values, share=missing_share):
+    values = values.astype(object)
+    values[random.random(len(values)) < share] = None
+    return values
+
+def get_column_vocabularies(random, dtype_mapping):
+    """Returns a small vocabulary of values for each text column without a generator of its own."""
+    vocabularies = {}
+    for column, dtype in dtype_mapping.items():
+        if dtype == 'str':
+            if column.endswith('_name') or column.endswith('_description'):
+                size = int(random.integers(20, 200))
+                vocabularies[column] = np.array([f"{column.replace('_', ' ').upper()} {value}" for value in range(size)], dtype=object)
+            elif column.endswith('_code') or column.endswith('_type'):
+                vocabularies[column] = np.array([f"{chr(65 + value % 26)}{value}" for value in range(int(random.integers(2, 60)))], dtype=object)
+            else:
+                vocabularies[column] = np.array(['t', 'f'], dtype=object)
+    return vocabularies
+
+def generate_award_chunk(random, first_row, rows, dtype_mapping, vocabularies, match_fraction, multiline_share):
+    """Returns a DataFrame of rows synthetic contract transactions with the columns of dtype_mapping, in order."""
+    row_numbers = np.arange(first_row, first_row + rows)
+    award_numbers = row_numbers // transactions_per_award
+    dod = random.random(rows) < dod_share
+    award_numbers_text = pd.Series(award_numbers).astype(str).str.zfill(9).to_numpy(dtype=object)
+
+    columns = {}
+    for column, dtype in dtype_mapping.items():
+        if column == 'contract_transaction_unique_key':
+            values = np.array([f"9700_-NONE-_{award_number}_{row_number % transactions_per_award}" for award_number, row_number in zip(award_numbers_text, row_numbers)], dtype=object)
+        elif column == 'contract_award_unique_key':
+            values = 'CONT_AWD_' + award_numbers_text + '_9700_-NONE-_-NONE-'
+        elif column == 'award_id_piid':
+            values = 'W91' + award_numbers_text
+        elif column == 'modification_number':
+            values = np.where(row_numbers % transactions_per_award == 0, '0', pd.Series(row_numbers % transactions_per_award).astype(str).str.zfill(5).radd('P').to_numpy(dtype=object))
+        elif column == 'naics_code':
+            values = choose_codes(random, rows, matching_naics_codes, other_naics_codes, match_fraction)
+        elif column == 'product_or_service_code':
+            values = choose_codes(random, rows, matching_psc_codes, other_psc_codes, match_fraction)
+        elif column in ('awarding_agency_name', 'funding_agency_name'):
+            values = np.where(dod, 'Department of Defense', random.choice(np.array(other_agency_names, dtype=object), rows))
+        elif column in ('awarding_sub_agency_name', 'funding_sub_agency_name'):
+            values = np.where(dod, random.choice(np.array(dod_sub_agency_names, dtype=object), rows), 'Office of the Secretary')
+            if column == 'awarding_sub_agency_name':
+                values[(~dod) & (random.random(rows) < federal_acquisition_service_share / (1 - dod_share))] = 'Federal Acquisition Service'
+        elif column == 'transaction_description':
+            values = choose_descriptions(random, rows, multiline_share)
+        elif column in ('recipient_uei', 'recipient_parent_uei'):
+            values = pd.Series(random.zipf(1.3, rows) % 50000).astype(str).str.zfill(12).radd('U').to_numpy(dtype=object)
+        elif column in ('last_modified_date', 'initial_report_date'):
+            values = choose_dates(random, rows, with_time=True)
+        elif column.endswith('_date'):
+            values = choose_dates(random, rows)
+            if column not in ('action_date', 'period_of_performance_start_date', 'period_of_performance_current_end_date'):
+                values = with_missing(random, values)
+        elif column == 'action_date_fiscal_year':
+            values = random.integers(2016, 2026, rows)
+        elif dtype == 'Int64':
+            values = with_missing(random, random.integers(1, 20, rows))
+        elif dtype == 'float':
+            values = np.round(random.lognormal(10, 2, rows), 2)
+            if column != 'federal_action_obligation':
+                values = with_missing(random, values)
+        elif column == 'usaspending_permalink':
+            values = 'https://www.usaspending.gov/award/CONT_AWD_' + award_numbers_text + '_9700_-NONE-_-NONE-/'
+        else:
+            values = with_missing(random, random.choice(vocabularies[column], rows))
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+def generate_award_file(output_file_path, rows, dtype_mapping, seed=0, match_fraction=0.1, multiline_share=0.01, encoding='utf-8'):
+    """Writes a synthetic USAspending contract transaction CSV with the columns of dtype_mapping and returns its size in bytes.
+
+    The same arguments always give the same file.  About match_fraction of the rows have a NAICS code in
+    matching_naics_codes, and independently about match_fraction a PSC code in matching_psc_codes, the rest
+    following the long-tailed frequencies of other codes.  multiline_share of the descriptions are quoted and span
+    several lines.  encoding='utf-16' writes the byte order mark and UTF-16 text of the PowerShell filters.
+    """
+    random = np.random.default_rng(seed)
+    vocabularies = get_column_vocabularies(random, dtype_mapping)
+    temp_file_path = output_file_path + '.tmp'
+    with open(temp_file_path, 'w', newline='', encoding=encoding) as output_file:
+        for first_row in range(0, rows, generate_chunk_rows):
+            chunk = generate_award_chunk(random, first_row, min(generate_chunk_rows, rows - first_row), dtype_mapping, vocabularies, match_fraction, multiline_share)
+            chunk.to_csv(output_file, index=False, header=first_row == 0, lineterminator='\n')
+    os.replace(temp_file_path, output_file_path)
+    return os.path.getsize(output_file_path)
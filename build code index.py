@@ -0,0 +1,31 @@
+import os
+import time
+from input_files import list_input_files
+from code_index import build_code_index
+
+#start a timer to measure total elapsed time
+script_start_time = time.time()
+
+# Record, for each raw award CSV, the byte offset of every record and which records have each naics_code and
+# product_or_service_code value.  "combine and filter.py" and "filter by psc.py" then seek to just the records
+# that can match their code lists, whatever the lists are, instead of parsing every record of every file.
+# The index is kept in a .code_index directory next to the CSVs and rebuilt when a file changes.
+
+# Define the input directory
+input_directory = r"C:\temp\awards"
+
+# Also index the NAICS-filtered file that "filter by psc.py" reads
+extra_input_files = [os.path.join(input_directory, "out", "dod_awards_by_naics_codes.csv")]
+
+for input_file_path in list_input_files(input_directory) + [path for path in extra_input_files if os.path.exists(path)]:
+    build_code_index(input_file_path)
+
+#End the timer to measure total script elapsed time
+script_duration = time.time() - script_start_time
+
+# Convert duration into hours, minutes, and seconds for readability
+hours, remainder = divmod(script_duration, 3600)
+minutes, seconds = divmod(remainder, 60)
+
+# Print user-friendly execution time
+print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
@@ -0,0 +1,28 @@
+import os
+import time
+from award_schema import dtype_mapping
+from parquet_store import build_parquet_store
+
+#start a timer to measure total elapsed time
+script_start_time = time.time()
+
+# Convert each raw award CSV once into a Parquet dataset partitioned by action_date_fiscal_year and by DoD vs.
+# civilian funding agency.  Point parquet_store_directory in "combine and filter.py" or "filter by psc.py" at the
+# store to query it with predicate and column pushdown instead of re-parsing the CSVs on every run.
+# Files already ingested are skipped until their size or modification time changes.
+
+# Define the input directory and the store directory
+input_directory = r"C:\temp\awards"
+store_directory = os.path.join(input_directory, "parquet_store")
+
+build_parquet_store(input_directory, store_directory, dtype_mapping)
+
+#End the timer to measure total script elapsed time
+script_duration = time.time() - script_start_time
+
+# Convert duration into hours, minutes, and seconds for readability
+hours, remainder = divmod(script_duration, 3600)
+minutes, seconds = divmod(remainder, 60)
+
+# Print user-friendly execution time
+print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+# Predicate helpers shared by the filter scripts.  Each one accepts either a pandas DataFrame chunk
+# or a pyarrow RecordBatch, so the same filter runs unchanged on either CSV engine.  The Arrow
+# variants keep pandas' null semantics: a missing value never matches isin or ==, and always matches !=.
+
+def is_pandas_chunk(chunk):
+    """Returns True for chunks read by the pandas engine and False for pyarrow RecordBatches."""
+    return isinstance(chunk, pd.DataFrame)
+
+# A code matcher compiled from a list of PSC or NAICS codes.  Entries shorter than a full code are category
+# prefixes ("D", "D3", "DA" match whole PSC families); full-length entries must match exactly.
+# prefixes_by_length is a tuple of (prefix length, frozenset of prefixes) pairs.
+CodeMatcher = namedtuple('CodeMatcher', ['exact_codes', 'prefixes_by_length'])
+
+# Full code lengths, used to tell category prefixes from complete codes
+psc_code_length = 4
+naics_code_length = 6
+
+def compile_code_matcher(codes, full_code_length):
+    """Builds a CodeMatcher once from a code list, dropping entries already covered by a shorter prefix."""
+    prefixes = sorted({code for code in codes if len(code) < full_code_length}, key=len)
+    kept_prefixes = []
+    for prefix in prefixes:
+        if not any(prefix.startswith(shorter_prefix) for shorter_prefix in kept_prefixes):
+            kept_prefixes.append(prefix)
+
+    exact_codes = frozenset(code for code in codes if len(code) >= full_code_length
+                            and not any(code.startswith(prefix) for prefix in kept_prefixes))
+    prefixes_by_length = {}
+    for prefix in kept_prefixes:
+        prefixes_by_length.setdefault(len(prefix), set()).add(prefix)
+    return CodeMatcher(exact_codes, tuple((length, frozenset(prefixes_by_length[length])) for length in sorted(prefixes_by_length)))
+
+def code_matcher_mask_pandas(series, code_matcher):
+    """Evaluates a CodeMatcher on the distinct values of a column only, then broadcasts the result to every row."""
+    # Factorizing keeps the prefix checks proportional to the few thousand distinct codes, not the rows in the chunk
+    value_codes, unique_values = pd.factorize(series)
+    unique_values = pd.Index(unique_values, dtype=object)
+    unique_mask = unique_values.isin(code_matcher.exact_codes)
+    for prefix_length, prefixes in code_matcher.prefixes_by_length:
+        unique_mask |= unique_values.str[:prefix_length].isin(prefixes)
+
+    # Missing values get code -1, which picks the trailing False
+    row_mask = np.append(unique_mask, False)[value_codes]
+    return pd.Series(row_mask, index=series.index)
+
+def isin_mask(chunk, field_name, codes_hash_set):
+    """Returns a boolean mask of the rows whose field_name value is in codes_hash_set, or matches it when it is a CodeMatcher."""
+    if is_pandas_chunk(chunk):
+        if isinstance(codes_hash_set, CodeMatcher):
+            return code_matcher_mask_pandas(chunk[field_name], codes_hash_set)
+        return chunk[field_name].isin(codes_hash_set)
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    column = chunk.column(field_name)
+    if not isinstance(codes_hash_set, CodeMatcher):
+        # Categorical columns are dictionary-encoded and looked up by the type of their values
+        value_type = column.type.value_type if pa.types.is_dictionary(column.type) else column.type
+        return pc.is_in(column, value_set=pa.array(list(codes_hash_set), type=value_type))
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+
+    # Slice every value to each prefix length with one vectorized kernel and look the slices up in the prefix set
+    mask = pc.is_in(column, value_set=pa.array(list(codes_hash_set.exact_codes), type=column.type))
+    for prefix_length, prefixes in codes_hash_set.prefixes_by_length:
+        prefix_column = pc.utf8_slice_codeunits(column, 0, prefix_length)
+        mask = pc.or_(mask, pc.is_in(prefix_column, value_set=pa.array(list(prefixes), type=column.type)))
+    return mask
+
+def equal_mask(chunk, field_name, value):
+    """Returns a boolean mask of the rows whose field_name value equals value."""
+    if is_pandas_chunk(chunk):
+        return chunk[field_name] == value
+
+    import pyarrow.compute as pc
+    return pc.fill_null(pc.equal(chunk.column(field_name), value), False)
+
+def not_equal_mask(chunk, field_name, value):
+    """Returns a boolean mask of the rows whose field_name value is missing or differs from value."""
+    if is_pandas_chunk(chunk):
+        return chunk[field_name] != value
+
+    import pyarrow.compute as pc
+    return pc.fill_null(pc.not_equal(chunk.column(field_name), value), True)
+
+def and_masks(mask, other_mask):
+    """Combines two boolean masks with a logical and."""
+    if isinstance(mask, pd.Series):
+        return mask & other_mask
+
+    import pyarrow.compute as pc
+    return pc.and_(mask, other_mask)
+
+def select_rows(chunk, mask):
+    """Returns the rows of a chunk where mask is True."""
+    if is_pandas_chunk(chunk):
+        return chunk[mask]
+    return chunk.filter(mask)
+
+def count_missing_values(chunk):
+    """Returns the number of missing values in each column of a chunk, without copying it."""
+    if is_pandas_chunk(chunk):
+        # One column at a time, so only a single column's mask is ever allocated
+        return {column: int(chunk[column].isna().sum()) for column in chunk.columns}
+    return {column_name: chunk.column(column_name).null_count for column_name in chunk.schema.names}
@@ -0,0 +1,351 @@
+import os
+import re
+import warnings
+import importlib.util
+import pandas as pd
+from contextlib import nullcontext
+from chunk_sizing import AdaptiveChunkSize
+from input_files import is_zip_member, open_input_file
+
+# The message pandas' C parser warns with for each line it skips
+skipped_line_pattern = re.compile(r'Skipping line (\d+): ([^\n]*)')
+
+# Ranges smaller than this are not worth a separate worker; smaller files are read by one worker as a whole
+min_range_bytes = 64 * 1024 * 1024
+
+# Bytes scanned at a time while counting quotes and looking for record boundaries
+scan_block_bytes = 8 * 1024 * 1024
+
+# The pyarrow engine sizes its batches in bytes rather than rows
+arrow_block_bytes = 64 * 1024 * 1024
+
+# pandas' default NA strings, so that both engines turn the same fields into missing values
+pandas_na_values = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+# A read-only binary file object over one byte range of a file, so pandas can parse the range in chunks
+class ByteRangeFile:
+    """Reads the bytes from start up to (not including) end of a file and reports end-of-file after that."""
+
+    def __init__(self, file_path, start, end):
+        self.file = open(file_path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def tell(self):
+        """Returns the position in the whole file, not in the range."""
+        return self.file.tell()
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def readable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# A binary file object that reports how far into its file the parser has read
+class ProgressFile:
+    """Reads from a binary file object, or a file path it opens, and passes the file position after each read to progress.set_position."""
+
+    def __init__(self, file, progress):
+        self.opened_here = isinstance(file, (str, os.PathLike))
+        self.file = open(file, 'rb') if self.opened_here else file
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.progress.set_position(self.file.tell())
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.progress.set_position(self.file.tell())
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def readable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def close(self):
+        # A file object passed in is closed by whoever opened it
+        if self.opened_here:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def track_progress(input_file, progress):
+    """Returns a ProgressFile over a file path or binary file object, or a context giving it unchanged when progress is None."""
+    return ProgressFile(input_file, progress) if progress is not None else nullcontext(input_file)
+
+def is_byte_splittable(encoding):
+    """Returns True if quotes and newlines are single bytes in this encoding, so a file can be split on raw bytes."""
+    try:
+        return '"\n'.encode(encoding or 'utf-8') == b'"\n'
+    except LookupError:
+        return False
+
+def find_record_end(file, position, in_quotes):
+    """Returns the offset just past the first newline at or after position that is outside a quoted field."""
+    file.seek(position)
+    while True:
+        block = file.read(scan_block_bytes)
+        if not block:
+            return position
+        block_position = 0
+        while True:
+            next_newline = block.find(b'\n', block_position)
+            next_quote = block.find(b'"', block_position)
+
+            # A newline before the next quote ends the record unless we are inside a quoted field
+            if next_newline != -1 and (next_quote == -1 or next_newline < next_quote):
+                if not in_quotes:
+                    return position + next_newline + 1
+                block_position = next_newline + 1
+            elif next_quote != -1:
+                # Escaped quotes ("") toggle twice, so tracking parity is enough
+                in_quotes = not in_quotes
+                block_position = next_quote + 1
+            else:
+                break
+        position += len(block)
+
+def find_range_end(file, start, range_bytes):
+    """Returns the first record boundary at least range_bytes past start, which must itself be a record boundary."""
+    position = start
+    in_quotes = False
+    file.seek(position)
+    target = start + range_bytes
+    while position < target:
+        block = file.read(min(scan_block_bytes, target - position))
+        if not block:
+            return position
+        if block.count(b'"') % 2:
+            in_quotes = not in_quotes
+        position += len(block)
+    return find_record_end(file, position, in_quotes)
+
+def split_file_into_ranges(file_path, range_count):
+    """Splits a CSV into up to range_count byte ranges that each start and end on a record boundary.
+
+    Returns the list of (start, end) ranges after the header record.  Quoted fields with embedded
+    newlines are handled by tracking quote parity from the start of the file, so boundaries never
+    fall inside a multi-line transaction_description.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        header_end = find_record_end(file, 0, False)
+        range_size = max((file_size - header_end) // max(range_count, 1), 1)
+
+        boundaries = [header_end]
+        position = header_end
+        in_quotes = False
+        file.seek(position)
+        for range_index in range(1, range_count):
+            target = header_end + range_index * range_size
+            if target <= boundaries[-1]:
+                continue
+
+            # Count quotes up to the target so we know whether it falls inside a quoted field
+            while position < target:
+                block = file.read(min(scan_block_bytes, target - position))
+                if not block:
+                    break
+                if block.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                position += len(block)
+
+            # Move forward to the end of the record that contains the target
+            boundary = find_record_end(file, position, in_quotes)
+            if boundary >= file_size:
+                break
+            boundaries.append(boundary)
+
+            # Resume counting from the boundary, which is always outside quotes
+            position = boundary
+            in_quotes = False
+            file.seek(position)
+
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+def get_range_count(file_path, worker_count):
+    """Returns how many byte ranges a file should be split into for worker_count workers."""
+    if is_zip_member(file_path):
+        # A zip member can only be decompressed front to back, so it is read by one worker as a whole
+        return 1
+    file_size = os.path.getsize(file_path)
+
+    # A few ranges per worker keeps all cores busy when some ranges filter faster than others
+    return max(1, min(worker_count * 4, file_size // min_range_bytes))
+
+def open_whole_file(file_path):
+    """Returns what pd.read_csv and pyarrow should read a whole input from: its path, or a stream for a zip member."""
+    return open_input_file(file_path) if is_zip_member(file_path) else nullcontext(file_path)
+
+def read_column_names(file_path, file_encoding):
+    """Returns the column names from the header record of a CSV file."""
+    with open_whole_file(file_path) as input_file:
+        return list(pd.read_csv(input_file, nrows=0, encoding=file_encoding).columns)
+
+def get_arrow_column_types(dtypes_to_read):
+    """Translates a dtype_mapping into pyarrow column types."""
+    import pyarrow as pa
+    arrow_types = {'str': pa.string(), 'float': pa.float64(), 'Int64': pa.int64(), 'Int32': pa.int32(), 'Int16': pa.int16(),
+                   'category': pa.dictionary(pa.int32(), pa.string())}
+    return {column: arrow_types[dtype] for column, dtype in (dtypes_to_read or {}).items() if dtype in arrow_types}
+
+def read_arrow_batches(input_file, columns_to_read, dtypes_to_read, file_encoding, column_names=None, block_bytes=arrow_block_bytes, bad_line_callback=None):
+    """Yields pyarrow RecordBatches from a CSV path or binary file object using pyarrow's multithreaded streaming reader.
+
+    Malformed rows are skipped; bad_line_callback(None, raw_line, reason) is called for each one when given.
+    """
+    import pyarrow.csv as pa_csv
+
+    # Malformed rows are dropped, like on_bad_lines='skip' does for pandas
+    def invalid_row_handler(row):
+        if bad_line_callback is not None:
+            bad_line_callback(None, row.text, f"expected {row.expected_columns} fields, saw {row.actual_columns}")
+        return 'skip'
+
+    read_options = pa_csv.ReadOptions(block_size=block_bytes, encoding=file_encoding or 'utf8', column_names=column_names, use_threads=True)
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True, invalid_row_handler=invalid_row_handler)
+    convert_options = pa_csv.ConvertOptions(column_types=get_arrow_column_types(dtypes_to_read), include_columns=columns_to_read or [],
+                                            null_values=pandas_na_values, strings_can_be_null=True)
+    for batch in pa_csv.open_csv(input_file, read_options=read_options, parse_options=parse_options, convert_options=convert_options):
+        yield batch
+
+def to_pandas_chunk(chunk):
+    """Converts a pyarrow RecordBatch to a pandas DataFrame with the dtypes pandas would have used; DataFrames pass through."""
+    if isinstance(chunk, pd.DataFrame):
+        return chunk
+    import pyarrow as pa
+    return chunk.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype(), pa.int32(): pd.Int32Dtype(), pa.int16(): pd.Int16Dtype()}.get)
+
+def report_skipped_lines(caught_warnings, bad_line_callback):
+    """Passes the lines pandas skipped, as reported in its ParserWarnings, to bad_line_callback(record_number, None, reason); re-issues other warnings."""
+    for caught_warning in caught_warnings:
+        skipped_lines = skipped_line_pattern.findall(str(caught_warning.message)) if issubclass(caught_warning.category, pd.errors.ParserWarning) else []
+        if not skipped_lines:
+            warnings.warn_explicit(caught_warning.message, caught_warning.category, caught_warning.filename, caught_warning.lineno)
+        for record_number, reason in skipped_lines:
+            bad_line_callback(int(record_number), None, reason)
+
+def read_pandas_chunks(input_file, chunk_size, bad_line_callback=None, **read_csv_options):
+    """Yields DataFrame chunks from pd.read_csv, resizing each chunk to the memory budget when chunk_size is an AdaptiveChunkSize.
+
+    Malformed lines are skipped; bad_line_callback(record_number, None, reason) is called for each one when given.
+    """
+    adaptive = isinstance(chunk_size, AdaptiveChunkSize)
+    if not adaptive and bad_line_callback is None:
+        yield from pd.read_csv(input_file, chunksize=chunk_size, on_bad_lines='skip', **read_csv_options)
+        return
+
+    # The C parser only reports skipped lines through warnings, so have it warn and collect them per chunk.  It only
+    # checks field counts when reading every column, which is why read_projected_pandas_chunks has pyarrow tokenise
+    # projected reads.
+    with pd.read_csv(input_file, chunksize=chunk_size.rows if adaptive else chunk_size, on_bad_lines='warn' if bad_line_callback else 'skip', **read_csv_options) as reader:
+        while True:
+            with warnings.catch_warnings(record=True) as caught_warnings:
+                warnings.simplefilter('always', pd.errors.ParserWarning)
+                try:
+                    chunk = reader.get_chunk(chunk_size.rows if adaptive else None)
+                except StopIteration:
+                    return
+            if bad_line_callback is not None:
+                report_skipped_lines(caught_warnings, bad_line_callback)
+            if adaptive:
+                chunk_size.observe(chunk)
+            yield chunk
+
+def read_projected_pandas_chunks(input_file, columns_to_read, dtypes_to_read, chunk_size, file_encoding, column_names=None, bad_line_callback=None, **read_csv_options):
+    """Yields DataFrame chunks of the columns_to_read columns, or of every column when it is None, with the same records as a pandas read of every column.
+
+    pandas' C parser stops checking field counts when given usecols, so a projected read is tokenised by pyarrow's
+    reader instead, which checks every record and skips those with too many fields, and its batches are converted
+    to DataFrames of chunk_size rows.  Without pyarrow, every column is parsed and the projection made afterwards.
+    """
+    if columns_to_read and importlib.util.find_spec('pyarrow') is not None:
+        adaptive = isinstance(chunk_size, AdaptiveChunkSize)
+        block_bytes = chunk_size.arrow_block_bytes if adaptive else arrow_block_bytes
+        for batch in read_arrow_batches(input_file, columns_to_read, dtypes_to_read, file_encoding, column_names, block_bytes, bad_line_callback):
+            batch_position = 0
+            while batch_position < len(batch):
+                chunk = to_pandas_chunk(batch.slice(batch_position, chunk_size.rows if adaptive else chunk_size))
+                batch_position += len(chunk)
+                if adaptive:
+                    chunk_size.observe(chunk)
+                yield chunk
+        return
+
+    for chunk in read_pandas_chunks(input_file, chunk_size, bad_line_callback, names=column_names, dtype=dtypes_to_read, encoding=file_encoding, **read_csv_options):
+        yield chunk[[column for column in chunk.columns if column in columns_to_read]] if columns_to_read else chunk
+
+# The chunked reader used by the filter scripts
+def read_award_chunks(input_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding, byte_range=None, column_names=None, engine='pandas', audit=None,
+                      progress=None):
+    """Yields chunks of an award CSV, or of one byte range of it when byte_range is given.
+
+    With engine='pandas' the chunks are DataFrames of chunk_size rows.  With engine='pyarrow' they are
+    pyarrow RecordBatches of about arrow_block_bytes each, parsed on all cores; the chunk_predicates
+    helpers filter either kind.  chunk_size may be an AdaptiveChunkSize, which sizes both kinds from a
+    memory budget.  A byte range has no header of its own, so column_names must be passed along with it.
+    Malformed lines are skipped and, when an InputFileAudit is given, recorded in it.  With a ProgressReporter,
+    the position read up to in the file is reported to it as the parser reads.
+    """
+    block_bytes = chunk_size.arrow_block_bytes if isinstance(chunk_size, AdaptiveChunkSize) else arrow_block_bytes
+    range_start = byte_range[0] if byte_range else 0
+    bad_line_callback = None
+    if audit is not None:
+        bad_line_callback = lambda record_number, raw_line, reason: audit.record_bad_line(range_start, record_number, raw_line, reason)
+
+    if byte_range is None:
+        # Zip members are decompressed as the parser reads them, without extracting them to disk
+        with open_whole_file(input_file_path) as whole_file, track_progress(whole_file, progress) as input_file:
+            if engine == 'pyarrow':
+                yield from read_arrow_batches(input_file, columns_to_read, dtypes_to_read, file_encoding, block_bytes=block_bytes, bad_line_callback=bad_line_callback)
+            else:
+                yield from read_projected_pandas_chunks(input_file, columns_to_read, dtypes_to_read, chunk_size, file_encoding, bad_line_callback=bad_line_callback)
+        return
+
+    start, end = byte_range
+    with ByteRangeFile(input_file_path, start, end) as byte_range_file, track_progress(byte_range_file, progress) as range_file:
+        if engine == 'pyarrow':
+            yield from read_arrow_batches(range_file, columns_to_read, dtypes_to_read, file_encoding, column_names, block_bytes, bad_line_callback)
+        else:
+            yield from read_projected_pandas_chunks(range_file, columns_to_read, dtypes_to_read, chunk_size, file_encoding, column_names, bad_line_callback, header=None)
@@ -0,0 +1,112 @@
+import os
+import ctypes
+
+# Rows sampled from a chunk, or from the first input file, to estimate the memory one row takes
+memory_sample_rows = 1000
+
+# Parsing and filtering hold several copies of a chunk at once (raw text, parsed frame, boolean masks, filtered slices)
+chunk_memory_overhead_factor = 3
+
+def get_available_memory():
+    """Returns the available physical memory in bytes, or None if it cannot be determined."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    # Windows: ask the kernel directly
+    if os.name == 'nt':
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+        memory_status = MEMORYSTATUSEX()
+        memory_status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(memory_status)):
+            return memory_status.ullAvailPhys
+        return None
+
+    # Linux and most other POSIX systems
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Bounds on the rows per chunk chosen from a memory budget
+min_chunk_rows = 1000
+max_chunk_rows = 5000000
+
+# Rows in the first chunk, before any bytes per row have been observed
+initial_chunk_rows = 10000
+
+# Share of the available memory used when the budget is 'auto', and the budget used when it cannot be determined
+auto_memory_fraction = 0.5
+fallback_memory_budget = 2 * 1024**3
+
+# Bounds on the pyarrow block size chosen from a memory budget
+min_arrow_block_bytes = 1024 * 1024
+max_arrow_block_bytes = 256 * 1024 * 1024
+
+memory_units = {'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4, 'B': 1}
+
+def parse_memory_size(memory_size):
+    """Returns the bytes in a memory size such as '4GB', '512 MB' or 2**30; 'auto' is half of the available memory."""
+    if isinstance(memory_size, (int, float)):
+        return int(memory_size)
+    memory_size = memory_size.strip().upper()
+    if memory_size == 'AUTO':
+        available_memory = get_available_memory()
+        return int(available_memory * auto_memory_fraction) if available_memory else fallback_memory_budget
+    for unit, unit_bytes in memory_units.items():
+        if memory_size.endswith(unit):
+            return int(float(memory_size[:-len(unit)]) * unit_bytes)
+    return int(memory_size)
+
+# Rows per chunk derived from a memory budget instead of a hard-coded count
+class AdaptiveChunkSize:
+    """Tunes the rows per chunk so a parsed chunk, with the copies filtering makes, fits in a memory budget.
+
+    Pass it wherever a chunk_size is expected.  The reader calls observe() with every chunk it reads, and the
+    next chunk is sized from the bytes per row seen so far, so wide or narrow column selections and long or
+    short descriptions are accounted for as the file goes.
+    """
+
+    def __init__(self, memory_budget, rows=initial_chunk_rows):
+        self.memory_budget = parse_memory_size(memory_budget)
+        self.rows = rows
+        self.bytes_per_row = None
+
+    def observe(self, chunk):
+        """Updates the bytes per row from an evenly spaced sample of a pandas chunk and resizes the next chunk."""
+        if len(chunk) == 0:
+            return
+        sample = chunk.iloc[::max(len(chunk) // memory_sample_rows, 1)]
+        sample_bytes_per_row = sample.memory_usage(deep=True, index=False).sum() / len(sample)
+
+        # Follow wider rows at once so the budget is never overrun; narrow down gradually
+        if self.bytes_per_row is None or sample_bytes_per_row > self.bytes_per_row:
+            self.bytes_per_row = sample_bytes_per_row
+        else:
+            self.bytes_per_row = 0.8 * self.bytes_per_row + 0.2 * sample_bytes_per_row
+
+        rows = int(self.memory_budget / (max(self.bytes_per_row, 1) * chunk_memory_overhead_factor))
+        self.rows = max(min_chunk_rows, min(max_chunk_rows, rows))
+
+    @property
+    def arrow_block_bytes(self):
+        """Returns the pyarrow block size for the budget; pyarrow parses one block per core at a time."""
+        block_bytes = self.memory_budget // (chunk_memory_overhead_factor * (os.cpu_count() or 1))
+        return max(min_arrow_block_bytes, min(max_arrow_block_bytes, block_bytes))
+
+    def share(self, share_count):
+        """Returns the chunk size for one of share_count workers splitting this budget."""
+        return AdaptiveChunkSize(self.memory_budget // max(share_count, 1), self.rows)
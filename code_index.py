@@ -0,0 +1,278 @@
+import os
+import io
+import csv
+import json
+import numpy as np
+import pandas as pd
+from chunk_reader import read_pandas_chunks, read_arrow_batches, find_record_end, is_byte_splittable, track_progress
+from chunk_predicates import isin_mask
+from encoding_detection import normalize_input_encoding
+from input_files import is_zip_member
+from line_audit import iter_records
+from run_manifest import get_file_fingerprint
+
+# The code fields indexed for each raw CSV
+index_fields = ['naics_code', 'product_or_service_code']
+
+# Directory, next to the raw CSVs, that holds one index file per CSV.  It has no .csv extension, so the filter
+# scripts never pick it up as an input file.
+code_index_directory_name = '.code_index'
+
+# Rows of the code columns parsed at a time while building an index
+index_chunk_rows = 500000
+
+# Time a seek to the next run costs, and the bytes per second each engine parses.  Matching records are read in one
+# run through a gap between them when parsing the gap takes less time than the seek past it.
+seek_seconds = 0.01
+parse_bytes_per_second = {'pandas': 40 * 1024 * 1024, 'pyarrow': 200 * 1024 * 1024}
+
+# Above this fraction of the file covered by the runs of matching records, a full scan is about as quick
+max_indexed_fraction = 0.5
+
+# Bytes read at a time from the runs of matching records
+run_read_bytes = 8 * 1024 * 1024
+
+def get_code_index_path(csv_file_path):
+    """Returns the index file of a CSV, e.g. C:\\temp\\awards\\.code_index\\FY2024_All_Contracts_1.csv.npz."""
+    directory, filename = os.path.split(os.path.abspath(csv_file_path))
+    return os.path.join(directory, code_index_directory_name, filename + '.npz')
+
+# A read-only binary file object over a list of byte runs of a file, read one after the other
+class ByteRunsFile:
+    """Reads the (start, end) byte runs of a file in order, as if they were one file, so pandas or pyarrow can parse just those records."""
+
+    def __init__(self, file_path, runs):
+        self.file = open(file_path, 'rb')
+        self.runs = iter(runs)
+        self.remaining = 0
+        self.next_run()
+
+    def next_run(self):
+        run = next(self.runs, None)
+        if run is None:
+            self.remaining = 0
+            return False
+        self.file.seek(run[0])
+        self.remaining = run[1] - run[0]
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = run_read_bytes
+        data = []
+        while size > 0 and (self.remaining or self.next_run()):
+            block = self.file.read(min(size, self.remaining))
+            if not block:
+                break
+            data.append(block)
+            size -= len(block)
+            self.remaining -= len(block)
+        return b''.join(data)
+
+    def tell(self):
+        """Returns the position in the whole file, past the records skipped so far."""
+        return self.file.tell()
+
+    def readable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Where the records of each NAICS and PSC code are in a raw CSV
+class CodeIndex:
+    """The byte offset of every record of a CSV, and for each indexed field the records of each code.
+
+    Stored as sorted arrays in one .npz file: record_starts holds the offset of each record plus the end of
+    the file, and for each field, <field>.codes holds the distinct codes in sorted order, <field>.records the
+    record numbers grouped by code, and <field>.code_starts where each code's group starts, as in a CSR matrix.
+    Missing codes, and records a full scan skips as malformed, are not indexed, since no code set matches them.
+    """
+
+    def __init__(self, index_path):
+        with np.load(index_path, allow_pickle=False) as index_arrays:
+            self.arrays = {name: index_arrays[name] for name in index_arrays.files}
+        self.fingerprint = json.loads(str(self.arrays['fingerprint']))
+        self.record_starts = self.arrays['record_starts']
+
+    @property
+    def record_count(self):
+        return len(self.record_starts) - 1
+
+    def get_matching_records(self, field_name, codes):
+        """Returns the sorted numbers of the records whose field_name is in codes, which may be a CodeMatcher."""
+        field_codes = self.arrays[f'{field_name}.codes']
+        code_starts = self.arrays[f'{field_name}.code_starts']
+        records = self.arrays[f'{field_name}.records']
+
+        # Match the distinct codes with the same predicate the filters use, then gather their records
+        code_mask = isin_mask(pd.DataFrame({field_name: field_codes.astype(object)}), field_name, codes).to_numpy()
+        matching_codes = np.flatnonzero(code_mask)
+        if not len(matching_codes):
+            return np.empty(0, dtype=records.dtype)
+        return np.sort(np.concatenate([records[code_starts[code]:code_starts[code + 1]] for code in matching_codes]))
+
+    def get_candidate_records(self, code_predicates):
+        """Returns the sorted numbers of the records that can match any of code_predicates.
+
+        Each predicate is a {field_name: codes} dict whose fields must all match; a record is a candidate if it
+        matches any of the predicates.
+        """
+        candidate_records = []
+        for code_predicate in code_predicates:
+            predicate_records = None
+            for field_name, codes in code_predicate.items():
+                field_records = self.get_matching_records(field_name, codes)
+                predicate_records = field_records if predicate_records is None else np.intersect1d(predicate_records, field_records, assume_unique=True)
+            candidate_records.append(predicate_records)
+        return np.unique(np.concatenate(candidate_records)) if candidate_records else np.empty(0, dtype=np.int64)
+
+    def get_record_runs(self, record_numbers, max_gap_bytes):
+        """Returns the (start, end) byte runs covering the records, merging records at most max_gap_bytes apart."""
+        if not len(record_numbers):
+            return []
+        starts = self.record_starts[record_numbers]
+        ends = self.record_starts[record_numbers + 1]
+
+        # A new run starts wherever the gap from the previous record is too large to read through
+        new_run = np.empty(len(starts), dtype=bool)
+        new_run[0] = True
+        new_run[1:] = starts[1:] - ends[:-1] > max_gap_bytes
+        run_starts = starts[new_run]
+        run_ends = ends[np.append(np.flatnonzero(new_run)[1:] - 1, len(ends) - 1)]
+        return list(zip(run_starts.tolist(), run_ends.tolist()))
+
+def count_record_fields(record_bytes, file_encoding):
+    """Returns the number of fields of one CSV record."""
+    record_text = record_bytes.decode(file_encoding or 'utf-8', errors='replace')
+    return len(next(csv.reader(io.StringIO(record_text)), []))
+
+def build_code_index(input_file_path):
+    """Builds the code index of a raw CSV unless a current one exists, and returns the index path, or None if the file cannot be indexed.
+
+    Zip members cannot be seeked into and are not indexed; UTF-16 inputs are indexed through their UTF-8 copy.
+    """
+    if is_zip_member(input_file_path):
+        print(f"Not indexing {input_file_path}: records in a zip archive cannot be read by offset; extract it to index it")
+        return None
+    csv_file_path, file_encoding = normalize_input_encoding(input_file_path)
+    if not is_byte_splittable(file_encoding):
+        print(f"Not indexing {input_file_path}: its {file_encoding} encoding cannot be read by byte offset")
+        return None
+
+    index_path = get_code_index_path(csv_file_path)
+    fingerprint = get_file_fingerprint(csv_file_path)
+    if os.path.exists(index_path) and CodeIndex(index_path).fingerprint == fingerprint:
+        print(f"Skipping {input_file_path}: code index is current")
+        return index_path
+
+    # Find the offset of every data record; pandas skips blank lines, so they are left out here too
+    record_starts = []
+    too_long_records = []
+    with open(csv_file_path, 'rb') as file:
+        header_end = find_record_end(file, 0, False)
+        file.seek(0)
+        header_field_count = count_record_fields(file.read(header_end), file_encoding)
+        file_end = header_end
+        for record_start, record_bytes in iter_records(file, header_end):
+            if record_bytes.strip(b'\r\n'):
+                # A full scan skips records with more fields than the header, so no filter ever matches them;
+                # only records with enough commas can have too many fields
+                if record_bytes.count(b',') >= header_field_count and count_record_fields(record_bytes, file_encoding) > header_field_count:
+                    too_long_records.append(len(record_starts))
+                record_starts.append(record_start)
+            file_end = record_start + len(record_bytes)
+    record_starts.append(file_end)
+
+    # Parse only the code columns; with usecols the C parser keeps every non-blank record, so row i is record i
+    code_columns = {field: [] for field in index_fields}
+    for chunk in read_pandas_chunks(csv_file_path, index_chunk_rows, usecols=index_fields, dtype='str', encoding=file_encoding):
+        for field in index_fields:
+            code_columns[field].append(chunk[field].to_numpy(dtype=object))
+    row_count = sum(len(codes) for codes in code_columns[index_fields[0]])
+    if row_count != len(record_starts) - 1:
+        print(f"Not indexing {input_file_path}: parsed {row_count} records but found {len(record_starts) - 1}")
+        return None
+
+    index_arrays = {
+        'fingerprint': np.array(json.dumps(fingerprint)),
+        'record_starts': np.array(record_starts, dtype=np.uint64),
+    }
+    for field in index_fields:
+        codes = pd.Series(np.concatenate(code_columns[field]) if code_columns[field] else np.empty(0, dtype=object))
+        indexed = codes.notna().to_numpy(copy=True)
+        indexed[too_long_records] = False
+        record_numbers = np.flatnonzero(indexed)
+
+        # Sort the records by code, keeping file order within a code, and note where each code's group starts
+        code_numbers, distinct_codes = pd.factorize(codes.iloc[record_numbers], sort=True)
+        order = np.argsort(code_numbers, kind='stable')
+        index_arrays[f'{field}.codes'] = np.array(distinct_codes, dtype=str)
+        index_arrays[f'{field}.records'] = record_numbers[order].astype(np.uint32)
+        index_arrays[f'{field}.code_starts'] = np.searchsorted(code_numbers[order], np.arange(len(distinct_codes) + 1)).astype(np.int64)
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    temp_file_path = index_path + '.tmp.npz'
+    np.savez_compressed(temp_file_path, **index_arrays)
+    os.replace(temp_file_path, index_path)
+    print(f"Indexed {len(record_starts) - 1} records of {input_file_path}")
+    return index_path
+
+def load_current_code_index(csv_file_path):
+    """Returns the CodeIndex of a CSV if one exists and the file has not changed since, else None."""
+    if is_zip_member(csv_file_path):
+        return None
+    index_path = get_code_index_path(csv_file_path)
+    if not os.path.exists(index_path):
+        return None
+    code_index = CodeIndex(index_path)
+    if code_index.fingerprint != get_file_fingerprint(csv_file_path):
+        print(f"The code index of {csv_file_path} is out of date; reading the whole file")
+        return None
+    return code_index
+
+def get_indexed_runs(csv_file_path, code_index, code_predicates, engine='pandas'):
+    """Returns the byte runs of the records of a CSV that can match code_predicates, or None if a full scan is about as quick.
+
+    Gaps between matching records that parse faster than a seek are read through, so the runs can cover more
+    bytes than the matching records themselves.
+    """
+    candidate_records = code_index.get_candidate_records(code_predicates)
+    record_runs = code_index.get_record_runs(candidate_records, int(seek_seconds * parse_bytes_per_second[engine]))
+    run_bytes = sum(end - start for start, end in record_runs)
+    file_bytes = int(code_index.record_starts[-1])
+    indexed_fraction = run_bytes / file_bytes if file_bytes else 0
+    print(f"{len(candidate_records)} of {code_index.record_count} records of {csv_file_path} can match; "
+          f"their {len(record_runs)} runs cover {run_bytes:,} of {file_bytes:,} bytes ({indexed_fraction:.1%})")
+    if indexed_fraction > max_indexed_fraction:
+        print(f"Reading the whole of {csv_file_path}: the runs cover more than {max_indexed_fraction:.0%} of it")
+        return None
+    return record_runs
+
+def read_indexed_chunks(csv_file_path, code_index, record_runs, columns_to_read, dtypes_to_read, chunk_size, file_encoding, engine='pandas', progress=None):
+    """Yields chunks of only the records of a CSV in record_runs, from get_indexed_runs, seeking to them with its CodeIndex.
+
+    The chunks are what read_award_chunks would yield for those records, so the filters are applied to them
+    unchanged and give the same rows as a full scan.  The records skipped count as read for a ProgressReporter.
+    """
+    if not record_runs:
+        return
+
+    # Read the header record first, rather than passing the column names, so a malformed first record is
+    # skipped just as it is in a full scan instead of being taken for index columns
+    header_run = (0, int(code_index.record_starts[0]))
+    with ByteRunsFile(csv_file_path, [header_run] + record_runs) as byte_runs_file, track_progress(byte_runs_file, progress) as runs_file:
+        if engine == 'pyarrow':
+            yield from read_arrow_batches(runs_file, columns_to_read, dtypes_to_read, file_encoding)
+        else:
+            yield from read_pandas_chunks(runs_file, chunk_size, usecols=columns_to_read, dtype=dtypes_to_read, encoding=file_encoding)
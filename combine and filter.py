@@ -1,108 +1,153 @@
-import pandas as pd
 import os
 import time
-import chardet
-
-def detect_file_encoding(file_path):
-    """Detects the encoding of a given file and returns it for use in pd.read_csv."""
-    try:
-        with open(file_path, 'rb') as file:
-            raw_data = file.read(10000)  # Read the first 10000 bytes
-            result = chardet.detect(raw_data)
-            encoding = result['encoding']
-            encoding = 'utf-8' if encoding == 'ascii' else encoding
-            confidence = result['confidence']
-            print(f"Detected encoding for {file_path}: {encoding} with confidence {confidence*100:.2f}")
-            return encoding  # Return the detected encoding
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return None  # Return None in case of an error
-
-# A function to concatenate all filtered records into a single DataFrame by type of funding_agency (federal civilian or dod)
-def save_filtered_data(filtered_chunk, fields_to_save, output_file_path):
-    """Saves a DataFrame to a CSV file with the specified fields."""
-    if not filtered_chunk.empty:
-        # Select only the desired fields
-        final_filtered_df = filtered_chunk[fields_to_save]
-
-        # Save the filtered DataFrame to a single output file with one header
-        final_filtered_df.to_csv(output_file_path, index=False, encoding='utf-8') # save in utf-8 for maximum comptability
-
-        # Output the number of records saved
-        print(f"Filtered records saved to: {output_file_path}")
-        print(f"Number of records saved: {len(final_filtered_df)}")
+from contextlib import ExitStack, nullcontext
+from output_sink import StreamingCsvSink, open_output_sink, get_output_file_stem
+from award_filter import filter_award_file, filter_chunk_for_profiles, get_profile_filter_fields, get_profile_output_file_names, get_profile_code_predicates, get_projected_columns
+from parallel_runner import filter_files_in_parallel
+from parquet_store import filter_parquet_store
+from chunk_predicates import compile_code_matcher, naics_code_length, psc_code_length
+from run_manifest import RunManifest, get_settings_hash
+from file_checkpoint import FileCheckpoint
+from chunk_sizing import AdaptiveChunkSize
+from input_files import list_input_files
+from award_dedup import LatestPerAwardSink, get_latest_per_award_fields
+from award_rollups import RollupSink, get_rollup_fields
+from award_database import AwardDatabase, AwardDatabaseSink
+from pipeline_metrics import RunMetrics
+from progress_report import ProgressReporter
+import award_schema
+
+# A function to filter csv files into a set of sinks, serially or on worker processes
+def filter_input_files(input_file_paths, work_directory, columns_to_read, dtypes_to_read, filter_profiles, sinks, metrics=None, progress=None):
+    """Filters the files for every profile and writes the matching records to the sinks in input order.
+
+    Malformed lines are quarantined in the output directory.  Stage timings are added to metrics, a RunMetrics, if given,
+    and progress is reported to progress, a ProgressReporter, if given.
+    """
+    if parallel_workers > 1:
+        # Send each file, or each byte range of a large file, to a worker process and merge the results in input order
+        filter_files_in_parallel(input_file_paths, work_directory, parallel_workers, columns_to_read, dtypes_to_read, chunk_size,
+                                 filter_chunk_for_profiles, (filter_profiles,), sinks, split_files=split_large_files, engine=csv_engine,
+                                 quarantine_directory=output_directory, metrics=metrics, progress=progress, csv_writer=csv_writer)
     else:
-        print("No records found matching the specified product_or_service_code values across all files.")
-
-# A function to process all csv files and filter based on NACICS, PSC codes, and type of agency (either fedciv or dod)
-def combine_and_filter_data(input_directory,output_directory,naics_codes_hash_set,psc_codes_hash_set):
-
-    output_file_name_fedciv = "combined_fedciv.csv"
-    output_file_name_dod = "combined_dod.csv"
-
-    output_file_path_fedciv = os.path.join(output_directory, output_file_name_fedciv)
-    output_file_path_dod = os.path.join(output_directory, output_file_name_dod)
-
-    # Process each CSV file in the input directory
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.csv'):
-            file_processing_start_time = time.time()
-            input_file_path = os.path.join(input_directory, filename)
-
-            # Initialize a counter for skipped lines and total processed records
-            skipped_lines_count = 0
-            total_processed_count = 0  # Counter for total records processed
-
-            # Read the CSV file in chunks and skip bad lines
-            # use small chunksize to lower memory needs
-            chunk_size = 250000
-            file_encoding = detect_file_encoding(input_file_path)
-            chunk_processing_start_time = time.time()
-            for chunk in pd.read_csv(input_file_path, dtype=dtype_mapping, chunksize=chunk_size, encoding=file_encoding, on_bad_lines='skip'):
-                
-                # Count skipped lines in the current chunk
-                skipped_lines_count += chunk.shape[0] - len(chunk.dropna())
-
-                # Update the total processed count
-                total_processed_count += len(chunk)
-
-                # Filter the DataFrame based on the NAICS codes and PSC codes.  Also weed out records which are actions related to GSA MAS schedule
-                filtered_chunk = chunk[
-                    (chunk['naics_code'].isin(naics_codes_hash_set)) & 
-                    (chunk['product_or_service_code'].isin(psc_codes_hash_set)) &
-                    (chunk['awarding_sub_agency_name'] != 'Federal Acquisition Service')       # Indicator of MAS Schedule actions which we don't care about
-                ]
-
-                # Further filter based on the funding agency name
-                filtered_chunk_fedciv = filtered_chunk[filtered_chunk['funding_agency_name'] != 'Department of Defense']  # Exclude DoD records
-                filtered_chunk_dod = filtered_chunk[filtered_chunk['funding_agency_name'] == 'Department of Defense']  # Include DoD records
-
-                # Append the filtered records to the list
-                all_filtered_fedciv_data.append(filtered_chunk_fedciv)
-                all_filtered_dod_data.append(filtered_chunk_dod)
-
-                chunk_processing_duration = time.time() - chunk_processing_start_time
-                
-                # Convert duration into hours, minutes, and seconds for readability
-                chunk_hours, chunk_remainder = divmod(chunk_processing_duration, 3600)
-                chunk_minutes, chunk_seconds = divmod(chunk_remainder, 60)
-
-                # Print user-friendly execution time for each chunk
-                print(f"\t{total_processed_count} records \t\t: {int(chunk_hours)} hours, {int(chunk_minutes)} minutes, {int(chunk_seconds)} seconds")
-
-    if all_filtered_fedciv_data:
-        # Concatenate all filtered FedCiv data
-        final_filtered_fedciv_df = pd.concat(all_filtered_fedciv_data, ignore_index=True)
-        
-        # Call the function to save filtered FedCiv data
-        save_filtered_data(final_filtered_fedciv_df, fields_to_save, output_file_path_fedciv)
-
-    if all_filtered_dod_data:
-        # Concatenate all filtered DoD data
-        final_filtered_dod_df = pd.concat(all_filtered_dod_data, ignore_index=True)
-        
-        # Call the function to save filtered DoD data
-        save_filtered_data(final_filtered_dod_df, fields_to_save, output_file_path_dod)
+        # Process each CSV file in the input directory, seeking to the matching records of files with a code index
+        code_predicates = get_profile_code_predicates(filter_profiles) if use_code_index else None
+        for input_file_path in input_file_paths:
+            filter_award_file(input_file_path, columns_to_read, dtypes_to_read, chunk_size, filter_chunk_for_profiles, (filter_profiles,), sinks, engine=csv_engine,
+                              quarantine_directory=output_directory, code_predicates=code_predicates, metrics=metrics, progress=progress)
+
+# A function to process all csv files and filter them for every filter profile in a single pass
+def combine_and_filter_data(input_directory,output_directory,filter_profiles):
+
+    # Time each stage of the run per input file and chunk, for the metrics report written at the end
+    run_metrics = RunMetrics('combine and filter') if collect_metrics else None
+
+    # Each profile writes to its own outputs, in the order filter_chunk_for_profiles returns its records
+    output_file_names = [output_file_name for filter_profile in filter_profiles for output_file_name in get_profile_output_file_names(filter_profile)]
+    output_file_paths = [os.path.join(output_directory, output_file_name) for output_file_name in output_file_names]
+
+    # The results of each input file are cached as uncompressed CSV, whatever the format of the outputs they are appended to
+    result_file_names = [os.path.basename(get_output_file_stem(output_file_name)) + '.csv' for output_file_name in output_file_names]
+
+    # Keeping the latest row per award also saves the fields that decide which row is the latest
+    output_fields = get_latest_per_award_fields(fields_to_save) if latest_per_award else fields_to_save
+
+    # The rollups also need federal_action_obligation and the recipient fields
+    if award_rollups:
+        output_fields = get_rollup_fields(output_fields)
+
+    # Only parse the columns used by the filters and the output, unless projection is turned off
+    if use_column_projection:
+        columns_to_read = get_projected_columns(get_profile_filter_fields(filter_profiles), output_fields)
+        dtypes_to_read = {column: dtype_mapping[column] for column in columns_to_read if column in dtype_mapping}
+    else:
+        columns_to_read = None
+        dtypes_to_read = dtype_mapping
+
+    # Collect the CSV files in the input directory, including those inside USAspending zip archives, which are read without extracting them
+    input_file_paths = list_input_files(input_directory)
+
+    # Filter only the new or changed files into cached per-file results; the outputs are then reassembled from the cache
+    run_manifest = None
+    if use_run_manifest and not parquet_store_directory:
+        settings = [filter_profiles, output_fields, dtypes_to_read]
+        if award_rollups:
+            # Results cached by runs without rollups have no rollup tables
+            settings.append('award_rollups')
+        if csv_writer != 'pandas':
+            # The cached results are appended to the CSV outputs as they are, so they are written by the same writer
+            settings.append(csv_writer)
+        run_manifest = RunManifest(output_directory, get_settings_hash(*settings), hash_input_contents)
+        run_manifest.forget_removed_files(input_file_paths)
+        stale_file_paths = []
+        for input_file_path in input_file_paths:
+            if run_manifest.is_current(input_file_path, result_file_names):
+                print(f"Reusing the cached results of unchanged file {input_file_path}")
+            else:
+                stale_file_paths.append(input_file_path)
+
+        # Report progress through the bytes of the files to filter, not of those reused
+        progress = ProgressReporter(stale_file_paths, progress_interval_seconds, progress_log_file_path)
+        for input_file_path in stale_file_paths:
+            # Serial runs commit a checkpoint as they go, so an interrupted file resumes at its last committed chunk
+            checkpoint = None
+            if use_checkpoints and parallel_workers <= 1:
+                checkpoint = FileCheckpoint(run_manifest.get_checkpoint_path(input_file_path), input_file_path, run_manifest.settings_hash, checkpoint_interval_bytes)
+            resume = checkpoint is not None and checkpoint.exists
+
+            result_file_paths = run_manifest.prepare_results(input_file_path, result_file_names, keep_partial_results=resume)
+            with ExitStack() as result_stack:
+                result_sinks = []
+                for result_file_path in result_file_paths:
+                    result_sink = StreamingCsvSink(result_file_path, output_fields, verbose=False, resume=resume, writer=csv_writer)
+                    if award_rollups:
+                        # Cache the rollups of each file with its results, so unchanged files are never read again
+                        result_sink = RollupSink(result_sink)
+                    result_sinks.append(result_stack.enter_context(result_sink))
+                if checkpoint is not None:
+                    filter_award_file(input_file_path, columns_to_read, dtypes_to_read, chunk_size, filter_chunk_for_profiles, (filter_profiles,), result_sinks, engine=csv_engine,
+                                      checkpoint=checkpoint, quarantine_directory=output_directory,
+                                      code_predicates=get_profile_code_predicates(filter_profiles) if use_code_index else None, metrics=run_metrics, progress=progress)
+                else:
+                    filter_input_files([input_file_path], os.path.dirname(result_file_paths[0]), columns_to_read, dtypes_to_read, filter_profiles, result_sinks,
+                                       run_metrics, progress)
+            run_manifest.record(input_file_path, result_file_names, [result_sink.records_written for result_sink in result_sinks])
+
+    # Stream the filtered records to the outputs as each chunk is filtered,
+    # so memory stays bounded by one chunk.  The outputs are renamed into place only on success.
+    award_database = AwardDatabase(award_database_path) if award_database_path else None
+    with ExitStack() as output_stack:
+        sinks = []
+        for output_file_name, output_file_path in zip(output_file_names, output_file_paths):
+            sink = open_output_sink(output_file_path, output_fields, dtype_mapping, output_compression.get(output_file_name), csv_writer)
+            if award_database:
+                # Keep a table of the same rows in the SQLite database, inserting only the cached results of new or changed files
+                sink = AwardDatabaseSink(sink, award_database, dtype_mapping)
+            if latest_per_award:
+                # Keep only the latest row of each award, spilling the awards held to disk beyond latest_per_award_memory
+                sink = LatestPerAwardSink(sink, latest_per_award_memory)
+            if award_rollups:
+                # Roll up every transaction, before any deduplication, into tables next to the output
+                sink = RollupSink(sink)
+            sinks.append(output_stack.enter_context(sink))
+
+        if run_manifest:
+            # Append the cached results of every input file, in input order
+            for input_file_path in input_file_paths:
+                result_file_paths = run_manifest.get_result_file_paths(input_file_path, result_file_names)
+                with run_metrics.get_file_metrics(input_file_path).time_stage('concat') if run_metrics else nullcontext():
+                    for sink, result_file_path, records in zip(sinks, result_file_paths, run_manifest.get_records(input_file_path)):
+                        sink.append_part(result_file_path, records, remove_part=False)
+        elif parquet_store_directory:
+            # Query the Parquet store with predicate and column pushdown instead of parsing the CSVs
+            filter_parquet_store(parquet_store_directory, columns_to_read, filter_profiles, sinks)
+        else:
+            progress = ProgressReporter(input_file_paths, progress_interval_seconds, progress_log_file_path)
+            filter_input_files(input_file_paths, output_directory, columns_to_read, dtypes_to_read, filter_profiles, sinks, run_metrics, progress)
+
+    # Save the stage timings and rows read and written of each file and chunk next to the outputs
+    if run_metrics:
+        run_metrics.write_report(output_directory)
 
 
 #start a timer to measure total elapsed time
@@ -115,306 +160,12 @@ script_start_time = time.time()
 # Convert the codes to a set for faster lookup
 # psc_codes_hash_set = set(psc_codes_to_filter)
 
-# Define data types for columns based on the original list of field types
-dtype_mapping = {
-    'contract_transaction_unique_key': 'str',
-    'contract_award_unique_key': 'str',
-    'award_id_piid': 'str',
-    'modification_number': 'str',
-    'transaction_number': 'str',
-    'parent_award_agency_id': 'str',
-    'parent_award_agency_name': 'str',
-    'parent_award_id_piid': 'str',
-    'parent_award_modification_number': 'str',
-    'federal_action_obligation': 'float',
-    'total_dollars_obligated': 'float',
-    'total_outlayed_amount_for_overall_award': 'float',
-    'base_and_exercised_options_value': 'float',
-    'current_total_value_of_award': 'float',
-    'base_and_all_options_value': 'float',
-    'potential_total_value_of_award': 'float',
-    'disaster_emergency_fund_codes_for_overall_award': 'str',
-    'outlayed_amount_from_COVID-19_supplementals_for_overall_award': 'float',
-    'obligated_amount_from_COVID-19_supplementals_for_overall_award': 'float',
-    'outlayed_amount_from_IIJA_supplemental_for_overall_award': 'float',
-    'obligated_amount_from_IIJA_supplementals_for_overall_award': 'float',
-    'action_date': 'str',  # Using str to handle various date formats
-    'action_date_fiscal_year': 'Int64',
-    'period_of_performance_start_date': 'str',
-    'period_of_performance_current_end_date': 'str',
-    'period_of_performance_potential_end_date': 'str',
-    'ordering_period_end_date': 'str',
-    'solicitation_date': 'str',
-    'awarding_agency_code': 'str',
-    'awarding_agency_name': 'str',
-    'awarding_sub_agency_code': 'str',
-    'awarding_sub_agency_name': 'str',
-    'awarding_office_code': 'str',
-    'awarding_office_name': 'str',
-    'funding_agency_code': 'str',
-    'funding_agency_name': 'str',
-    'funding_sub_agency_code': 'str',
-    'funding_sub_agency_name': 'str',
-    'funding_office_code': 'str',
-    'funding_office_name': 'str',
-    'treasury_accounts_funding_this_award': 'str',
-    'federal_accounts_funding_this_award': 'str',
-    'object_classes_funding_this_award': 'str',
-    'program_activities_funding_this_award': 'str',
-    'foreign_funding': 'str',
-    'foreign_funding_description': 'str',
-    'sam_exception': 'str',
-    'sam_exception_description': 'str',
-    'recipient_uei': 'str',
-    'recipient_duns': 'str',
-    'recipient_name': 'str',
-    'recipient_name_raw': 'str',
-    'recipient_doing_business_as_name': 'str',
-    'cage_code': 'str',
-    'recipient_parent_uei': 'str',
-    'recipient_parent_duns': 'str',
-    'recipient_parent_name': 'str',
-    'recipient_parent_name_raw': 'str',
-    'recipient_country_code': 'str',
-    'recipient_country_name': 'str',
-    'recipient_address_line_1': 'str',
-    'recipient_address_line_2': 'str',
-    'recipient_city_name': 'str',
-    'prime_award_transaction_recipient_county_fips_code': 'str',
-    'recipient_county_name': 'str',
-    'prime_award_transaction_recipient_state_fips_code': 'str',
-    'recipient_state_code': 'str',
-    'recipient_state_name': 'str',
-    'recipient_zip_4_code': 'str',
-    'prime_award_transaction_recipient_cd_original': 'str',
-    'prime_award_transaction_recipient_cd_current': 'str',
-    'recipient_phone_number': 'str',
-    'recipient_fax_number': 'str',
-    'primary_place_of_performance_country_code': 'str',
-    'primary_place_of_performance_country_name': 'str',
-    'primary_place_of_performance_city_name': 'str',
-    'prime_award_transaction_place_of_performance_county_fips_code': 'str',
-    'primary_place_of_performance_county_name': 'str',
-    'prime_award_transaction_place_of_performance_state_fips_code': 'str',
-    'primary_place_of_performance_state_code': 'str',
-    'primary_place_of_performance_state_name': 'str',
-    'primary_place_of_performance_zip_4': 'str',
-    'prime_award_transaction_place_of_performance_cd_original': 'str',
-    'prime_award_transaction_place_of_performance_cd_current': 'str',
-    'award_or_idv_flag': 'str',
-    'award_type_code': 'str',
-    'award_type': 'str',
-    'idv_type_code': 'str',
-    'idv_type': 'str',
-    'multiple_or_single_award_idv_code': 'str',
-    'multiple_or_single_award_idv': 'str',
-    'type_of_idc_code': 'str',
-    'type_of_idc': 'str',
-    'type_of_contract_pricing_code': 'str',
-    'type_of_contract_pricing': 'str',
-    'transaction_description': 'str',
-    'prime_award_base_transaction_description': 'str',
-    'action_type_code': 'str',
-    'action_type': 'str',
-    'solicitation_identifier': 'str',
-    'number_of_actions': 'Int64',
-    'inherently_governmental_functions': 'str',
-    'inherently_governmental_functions_description': 'str',
-    'product_or_service_code': 'str',
-    'product_or_service_code_description': 'str',
-    'contract_bundling_code': 'str',
-    'contract_bundling': 'str',
-    'dod_claimant_program_code': 'str',
-    'dod_claimant_program_description': 'str',
-    'naics_code': 'str',
-    'naics_description': 'str',
-    'recovered_materials_sustainability_code': 'str',
-    'recovered_materials_sustainability': 'str',
-    'domestic_or_foreign_entity_code': 'str',
-    'domestic_or_foreign_entity': 'str',
-    'dod_acquisition_program_code': 'str',
-    'dod_acquisition_program_description': 'str',
-    'information_technology_commercial_item_category_code': 'str',
-    'information_technology_commercial_item_category': 'str',
-    'epa_designated_product_code': 'str',
-    'epa_designated_product': 'str',
-    'country_of_product_or_service_origin_code': 'str',
-    'country_of_product_or_service_origin': 'str',
-    'place_of_manufacture_code': 'str',
-    'place_of_manufacture': 'str',
-    'subcontracting_plan_code': 'str',
-    'subcontracting_plan': 'str',
-    'extent_competed_code': 'str',
-    'extent_competed': 'str',
-    'solicitation_procedures_code': 'str',
-    'solicitation_procedures': 'str',
-    'type_of_set_aside_code': 'str',
-    'type_of_set_aside': 'str',
-    'evaluated_preference_code': 'str',
-    'evaluated_preference': 'str',
-    'research_code': 'str',
-    'research': 'str',
-    'fair_opportunity_limited_sources_code': 'str',
-    'fair_opportunity_limited_sources': 'str',
-    'other_than_full_and_open_competition_code': 'str',
-    'other_than_full_and_open_competition': 'str',
-    'number_of_offers_received': 'Int64',
-    'commercial_item_acquisition_procedures_code': 'str',
-    'commercial_item_acquisition_procedures': 'str',
-    'small_business_competitiveness_demonstration_program': 'str',
-    'simplified_procedures_for_certain_commercial_items_code': 'str',
-    'simplified_procedures_for_certain_commercial_items': 'str',
-    'a76_fair_act_action_code': 'str',
-    'a76_fair_act_action': 'str',
-    'fed_biz_opps_code': 'str',
-    'fed_biz_opps': 'str',
-    'local_area_set_aside_code': 'str',
-    'local_area_set_aside': 'str',
-    'price_evaluation_adjustment_preference_percent_difference': 'float',
-    'clinger_cohen_act_planning_code': 'str',
-    'clinger_cohen_act_planning': 'str',
-    'materials_supplies_articles_equipment_code': 'str',
-    'materials_supplies_articles_equipment': 'str',
-    'labor_standards_code': 'str',
-    'labor_standards': 'str',
-    'construction_wage_rate_requirements_code': 'str',
-    'construction_wage_rate_requirements': 'str',
-    'interagency_contracting_authority_code': 'str',
-    'interagency_contracting_authority': 'str',
-    'other_statutory_authority': 'str',
-    'program_acronym': 'str',
-    'parent_award_type_code': 'str',
-    'parent_award_type': 'str',
-    'parent_award_single_or_multiple_code': 'str',
-    'parent_award_single_or_multiple': 'str',
-    'major_program': 'str',
-    'national_interest_action_code': 'str',
-    'national_interest_action': 'str',
-    'cost_or_pricing_data_code': 'str',
-    'cost_or_pricing_data': 'str',
-    'cost_accounting_standards_clause_code': 'str',
-    'cost_accounting_standards_clause': 'str',
-    'government_furnished_property_code': 'str',
-    'government_furnished_property': 'str',
-    'sea_transportation_code': 'str',
-    'sea_transportation': 'str',
-    'undefinitized_action_code': 'str',
-    'undefinitized_action': 'str',
-    'consolidated_contract_code': 'str',
-    'consolidated_contract': 'str',
-    'performance_based_service_acquisition_code': 'str',
-    'performance_based_service_acquisition': 'str',
-    'multi_year_contract_code': 'str',
-    'multi_year_contract': 'str',
-    'contract_financing_code': 'str',
-    'contract_financing': 'str',
-    'purchase_card_as_payment_method_code': 'str',
-    'purchase_card_as_payment_method': 'str',
-    'contingency_humanitarian_or_peacekeeping_operation_code': 'str',
-    'contingency_humanitarian_or_peacekeeping_operation': 'str',
-    'alaskan_native_corporation_owned_firm': 'str',
-    'american_indian_owned_business': 'str',
-    'indian_tribe_federally_recognized': 'str',
-    'native_hawaiian_organization_owned_firm': 'str',
-    'tribally_owned_firm': 'str',
-    'veteran_owned_business': 'str',
-    'service_disabled_veteran_owned_business': 'str',
-    'woman_owned_business': 'str',
-    'women_owned_small_business': 'str',
-    'economically_disadvantaged_women_owned_small_business': 'str',
-    'joint_venture_women_owned_small_business': 'str',
-    'joint_venture_economic_disadvantaged_women_owned_small_bus': 'str',
-    'minority_owned_business': 'str',
-    'subcontinent_asian_asian_indian_american_owned_business': 'str',
-    'asian_pacific_american_owned_business': 'str',
-    'black_american_owned_business': 'str',
-    'hispanic_american_owned_business': 'str',
-    'native_american_owned_business': 'str',
-    'other_minority_owned_business': 'str',
-    'contracting_officers_determination_of_business_size': 'str',
-    'contracting_officers_determination_of_business_size_code': 'str',
-    'emerging_small_business': 'str',
-    'community_developed_corporation_owned_firm': 'str',
-    'labor_surplus_area_firm': 'str',
-    'us_federal_government': 'str',
-    'federally_funded_research_and_development_corp': 'str',
-    'federal_agency': 'str',
-    'us_state_government': 'str',
-    'us_local_government': 'str',
-    'city_local_government': 'str',
-    'county_local_government': 'str',
-    'inter_municipal_local_government': 'str',
-    'local_government_owned': 'str',
-    'municipality_local_government': 'str',
-    'school_district_local_government': 'str',
-    'township_local_government': 'str',
-    'us_tribal_government': 'str',
-    'foreign_government': 'str',
-    'organizational_type': 'str',
-    'corporate_entity_not_tax_exempt': 'str',
-    'corporate_entity_tax_exempt': 'str',
-    'partnership_or_limited_liability_partnership': 'str',
-    'sole_proprietorship': 'str',
-    'small_agricultural_cooperative': 'str',
-    'international_organization': 'str',
-    'us_government_entity': 'str',
-    'community_development_corporation': 'str',
-    'domestic_shelter': 'str',
-    'educational_institution': 'str',
-    'foundation': 'str',
-    'hospital_flag': 'str',
-    'manufacturer_of_goods': 'str',
-    'veterinary_hospital': 'str',
-    'hispanic_servicing_institution': 'str',
-    'receives_contracts': 'str',
-    'receives_financial_assistance': 'str',
-    'receives_contracts_and_financial_assistance': 'str',
-    'airport_authority': 'str',
-    'council_of_governments': 'str',
-    'housing_authorities_public_tribal': 'str',
-    'interstate_entity': 'str',
-    'planning_commission': 'str',
-    'port_authority': 'str',
-    'transit_authority': 'str',
-    'subchapter_scorporation': 'str',
-    'limited_liability_corporation': 'str',
-    'foreign_owned': 'str',
-    'for_profit_organization': 'str',
-    'nonprofit_organization': 'str',
-    'other_not_for_profit_organization': 'str',
-    'the_ability_one_program': 'str',
-    'private_university_or_college': 'str',
-    'state_controlled_institution_of_higher_learning': 'str',
-    '1862_land_grant_college': 'str',
-    '1890_land_grant_college': 'str',
-    '1994_land_grant_college': 'str',
-    'minority_institution': 'str',
-    'historically_black_college': 'str',
-    'tribal_college': 'str',
-    'alaskan_native_servicing_institution': 'str',
-    'native_hawaiian_servicing_institution': 'str',
-    'school_of_forestry': 'str',
-    'veterinary_college': 'str',
-    'dot_certified_disadvantage': 'str',
-    'self_certified_small_disadvantaged_business': 'str',
-    'small_disadvantaged_business': 'str',
-    'c8a_program_participant': 'str',
-    'historically_underutilized_business_zone_hubzone_firm': 'str',
-    'sba_certified_8a_joint_venture': 'str',
-    'highly_compensated_officer_1_name': 'str',
-    'highly_compensated_officer_1_amount': 'float',
-    'highly_compensated_officer_2_name': 'str',
-    'highly_compensated_officer_2_amount': 'float',
-    'highly_compensated_officer_3_name': 'str',
-    'highly_compensated_officer_3_amount': 'float',
-    'highly_compensated_officer_4_name': 'str',
-    'highly_compensated_officer_4_amount': 'float',
-    'highly_compensated_officer_5_name': 'str',
-    'highly_compensated_officer_5_amount': 'float',
-    'usaspending_permalink': 'str',
-    'initial_report_date': 'str',
-    'last_modified_date': 'str',
-}
+# Define data types for columns from the schema shared by the filter scripts.  The compact schema reads the
+# low-cardinality fields and the t/f flags as categoricals and a few integers as narrower types, which shrinks every
+# parsed chunk (measure it with "schema memory report.py") and writes the same outputs.  Set use_compact_dtypes to
+# False to read every column with its declared type instead.
+use_compact_dtypes = True
+dtype_mapping = award_schema.compact_dtype_mapping if use_compact_dtypes else award_schema.dtype_mapping
 
 # Specify the fields to save in the output file
 fields_to_save = [
@@ -463,15 +214,19 @@ fields_to_save = [
 'usaspending_permalink',
 ]
 
-# Define the list of NAICS codes to include in the final dataset
+# Parse only the fields read by the filter profiles plus fields_to_save instead of all columns in dtype_mapping.
+# Set to False to read every column, e.g. when adding new predicates or output fields.
+use_column_projection = True
+
+# Define the list of NAICS codes to include in the final IT dataset
 naics_codes_to_filter = [
     "541511", "541512", "541513", "541519", 
     "541611", "541612", "541613", "541614", 
     "541618", "541620", "541690"
 ]
 
-# Convert the NAICS codes to a set for faster lookup
-naics_codes_hash_set = set(naics_codes_to_filter)
+# Compile the NAICS codes once into a matcher for fast lookup; codes shorter than six digits match whole industry groups
+naics_codes_matcher = compile_code_matcher(naics_codes_to_filter, naics_code_length)
 
 # Define the list of PSC codes to include in the final dataset.
 psc_codes_to_filter = ["R499", "D399", "D306", "R408", "R410", "D308", "D318", "D301", "DC01", "DA01", "DF01", 
@@ -483,27 +238,138 @@ psc_codes_to_filter = ["R499", "D399", "D306", "R408", "R410", "D308", "D318", "
                        "DE10","DE11","DF","DF01","DF10","DG","DG01","DG10","DG11","DH","DH01",
                        "DH10","DJ","DJ01","DJ10","DJ10","DK","DK01","DK10",
                        ]
-# Convert the codes to a set for faster lookup
-psc_codes_hash_set = set(psc_codes_to_filter)
+# Compile the codes once into a matcher for fast lookup: four-character codes match exactly, and shorter
+# category entries such as "D", "D3" or "DA" match every PSC code that starts with them
+psc_codes_matcher = compile_code_matcher(psc_codes_to_filter, psc_code_length)
+
+# Define the list of NAICS codes for the human resources (HCATS) dataset, which is not filtered by PSC code
+hr_naics_codes_to_filter = [
+     "611430", "611699", "624210", "611710"
+]
+
+# Define the filter profiles evaluated in a single pass over the input files.  Add a profile here for each new
+# market segment; the input is still read only once.  The extension of an output name picks its format:
+#   .csv                plain CSV
+#   .csv.gz, .csv.zst   CSV compressed with gzip or zstd
+#   .parquet            Parquet, compressed with zstd
+#   .arrow, .feather    an uncompressed Arrow IPC file that later stages can memory-map instead of parsing
+filter_profiles = [
+    {
+        'name': 'IT',
+        'naics_codes': naics_codes_matcher,
+        'psc_codes': psc_codes_matcher,
+        'excluded_awarding_sub_agencies': {'Federal Acquisition Service'},       # Indicator of MAS Schedule actions which we don't care about
+        'split_by_funding_agency': True,
+        'output_file_name_fedciv': "combined_fedciv.csv",
+        'output_file_name_dod': "combined_dod.csv",
+    },
+    {
+        'name': 'HCATS HR',
+        'naics_codes': compile_code_matcher(hr_naics_codes_to_filter, naics_code_length),
+        'psc_codes': None,
+        'excluded_awarding_sub_agencies': {'Federal Acquisition Service'},
+        'split_by_funding_agency': True,
+        'output_file_name_fedciv': "combined_fedciv_HR.csv",
+        'output_file_name_dod': "combined_dod_HR.csv",
+    },
+]
+
+# Compression of particular outputs instead of that of their format, by output file name, e.g.
+# {"combined_fedciv.parquet": 'snappy', "combined_dod.feather": 'lz4'}
+output_compression = {}
+
+# Writer of the CSV outputs: 'pandas' for exactly the CSV of earlier runs, or 'arrow' for pyarrow's native writer,
+# many times faster but quoting every text value and writing floats in shortest form
+csv_writer = 'pandas'
+
+# Read the CSV files in chunks of this many rows to lower memory needs
+chunk_size = 250000
+
+# Memory budget for the chunks being parsed and filtered, e.g. '4GB', '512MB', or 'auto' for half of the available
+# memory.  When set, the rows per chunk are tuned from the bytes per row observed as the files are read, and
+# chunk_size above is only used when this is None.
+max_memory = 'auto'
+if max_memory:
+    chunk_size = AdaptiveChunkSize(max_memory)
+
+# CSV parser: 'pandas' for the single-threaded C parser, or 'pyarrow' for pyarrow's multithreaded streaming
+# reader with Arrow compute predicates (requires pyarrow; batches are sized in bytes instead of chunk_size rows)
+csv_engine = 'pandas'
+
+# Number of worker processes to filter input files in parallel; 1 processes the files one at a time.
+# The actual count is also capped by the CPU count and by the memory available for one chunk per worker.
+parallel_workers = 1
+
+# When running in parallel, also split large files into byte ranges on record boundaries so that a
+# single 10+ GB file is parsed on every worker instead of one.  UTF-16 files are split via their UTF-8 copy.
+split_large_files = True
+
+# Keep a manifest of each input file's size and mtime and cache its filtered records under out/.run_cache, so a
+# re-run only parses new or changed files and reassembles the outputs from the cache.  Changing the filter profiles
+# or fields_to_save invalidates the cache.  Not used with the Parquet store, which tracks ingested files itself.
+use_run_manifest = True
+
+# Also record a SHA-256 of each input file, so a file that was touched or downloaded again unchanged is not reprocessed
+hash_input_contents = False
+
+# With the run manifest and parallel_workers = 1, commit the outputs and a checkpoint every checkpoint_interval_bytes
+# of input, so a crashed or rebooted run resumes at the last committed chunk instead of starting the file over
+use_checkpoints = True
+checkpoint_interval_bytes = 256 * 1024 * 1024
+
+# Keep only the latest row of each contract_award_unique_key in the outputs, by last_modified_date and then
+# modification_number, instead of one row per transaction.  last_modified_date is added to the outputs if it is
+# not in fields_to_save.  The rows wait on disk; the key and position of each award's latest row are held in memory
+# up to latest_per_award_memory and spill to disk beyond it.
+latest_per_award = False
+latest_per_award_memory = '1GB'
+
+# Also write award-level and recipient-level tables next to each output, e.g. combined_dod_awards.csv and
+# combined_dod_recipients.csv, with the sum of federal_action_obligation, the transaction count and, per award,
+# the max of potential_total_value_of_award.  They are rolled up a chunk at a time as the rows are filtered.
+award_rollups = False
+
+# Read only the records that can match the NAICS and PSC codes of the profiles from raw files with a current code
+# index, built by "build code index.py", instead of parsing every record.  Serial runs only; files without a
+# current index, and profiles with no code predicate, are read in full.
+use_code_index = True
+
+# Time the detect, split, parse, filter, concat and write stages of each input file and chunk, and save them with
+# the rows read and written to pipeline_metrics.json in the output directory.  Each run also appends a row per
+# input file to pipeline_metrics.csv, to compare stage times and throughput across runs.
+collect_metrics = True
+
+# Report how far the run is through the bytes of the input files, with MB/s, rows/s, rows written and ETA, at most
+# every progress_interval_seconds.  Set progress_log_file_path to append the progress lines to a log file instead
+# of printing them, for unattended runs.
+progress_interval_seconds = 10
+progress_log_file_path = None  # e.g. r"C:\temp\awards\out\progress.log"
 
 # Define the input directory and output directory
 input_directory = r"C:\temp\awards"  
 output_directory = os.path.join(input_directory, "out")
 
-# Create the output directory if it does not exist
-os.makedirs(output_directory, exist_ok=True)
+# Also keep each output as a table of a local SQLite database, e.g. combined_dod, with indexes on the NAICS, PSC,
+# agency, office, recipient UEI and end date fields for ad-hoc queries.  With the run manifest, only the rows of
+# new or changed input files are inserted; the tables are replaced in one transaction when the run succeeds.
+award_database_path = None  # e.g. os.path.join(output_directory, "awards.sqlite")
+
+# Parquet store built from the input directory by "build parquet store.py".  When set, the store is queried
+# instead of the CSV files; rows then come out grouped by fiscal year rather than in raw file order.
+parquet_store_directory = None  # e.g. os.path.join(input_directory, "parquet_store")
 
-# Initialize an array to hold filtered records from all files
-all_filtered_fedciv_data = []
-all_filtered_dod_data = []
+# Guard the run so worker processes can import this script without starting another run
+if __name__ == '__main__':
+    # Create the output directory if it does not exist
+    os.makedirs(output_directory, exist_ok=True)
 
-combine_and_filter_data(input_directory,output_directory,naics_codes_hash_set,psc_codes_hash_set)
-#End the timer to measure total script elapsed time
-script_duration = time.time() - script_start_time
+    combine_and_filter_data(input_directory,output_directory,filter_profiles)
+    #End the timer to measure total script elapsed time
+    script_duration = time.time() - script_start_time
 
-# Convert duration into hours, minutes, and seconds for readability
-hours, remainder = divmod(script_duration, 3600)
-minutes, seconds = divmod(remainder, 60)
+    # Convert duration into hours, minutes, and seconds for readability
+    hours, remainder = divmod(script_duration, 3600)
+    minutes, seconds = divmod(remainder, 60)
 
-# Print user-friendly execution time
-print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
\ No newline at end of file
+    # Print user-friendly execution time
+    print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
\ No newline at end of file
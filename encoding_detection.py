@@ -0,0 +1,161 @@
+import os
+import io
+import json
+import codecs
+from input_files import is_zip_member, get_input_name, get_input_directory, get_input_size, get_input_mtime, open_input_file
+
+# Sidecar file, one per input directory, caching the detected encoding of each file by name, size and mtime
+encoding_cache_name = '.file_encodings.json'
+
+# Directory, inside the input directory, that holds UTF-8 copies of UTF-16/UTF-32 inputs.  It has no .csv
+# extension, so the filter scripts never pick it up as an input file.
+utf8_copy_directory_name = '.utf8'
+
+# Bytes checked for UTF-8 validity at the start, middle and end of a file
+sample_bytes = 1024 * 1024
+
+# Byte order marks, longest first so UTF-32 LE is not mistaken for UTF-16 LE
+byte_order_marks = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+# Characters per read while transcoding to UTF-8
+transcode_block_chars = 4 * 1024 * 1024
+
+def read_samples(file_path):
+    """Returns byte samples from the start, middle and end of a file, so a multi-GB file is not judged by its first block only.
+
+    A zip member is only sampled at the start, since seeking in it means decompressing everything before.
+    """
+    file_size = get_input_size(file_path)
+    offsets = [0]
+    if file_size > sample_bytes and not is_zip_member(file_path):
+        offsets += [(file_size - sample_bytes) // 2, file_size - sample_bytes]
+    samples = []
+    with open_input_file(file_path) as file:
+        for offset in offsets:
+            file.seek(offset)
+            samples.append((offset, file.read(sample_bytes)))
+    return samples
+
+def is_valid_utf8(sample, starts_mid_file):
+    """Returns True if a sample decodes as UTF-8, allowing multi-byte characters cut off at either edge."""
+    if starts_mid_file:
+        # Skip up to three continuation bytes of a character that started before the sample
+        skipped = 0
+        while skipped < 3 and skipped < len(sample) and 0x80 <= sample[skipped] <= 0xBF:
+            skipped += 1
+        sample = sample[skipped:]
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def detect_encoding_uncached(file_path):
+    """Detects an encoding from the byte order mark, then UTF-8 validity, and only then with chardet."""
+    samples = read_samples(file_path)
+    first_sample = samples[0][1]
+    for byte_order_mark, encoding in byte_order_marks:
+        if first_sample.startswith(byte_order_mark):
+            return encoding, 'byte order mark'
+
+    # Plain ASCII is valid UTF-8, so this covers most USAspending downloads
+    if all(is_valid_utf8(sample, offset > 0) for offset, sample in samples):
+        return 'utf-8', 'UTF-8 validation'
+
+    # Fall back to chardet on the samples only when the cheap checks are inconclusive
+    import chardet
+    result = chardet.detect(b''.join(sample for offset, sample in samples))
+    encoding = result['encoding']
+    encoding = 'utf-8' if encoding == 'ascii' else encoding
+    return encoding, f"chardet with confidence {result['confidence']*100:.2f}"
+
+def load_encoding_cache(directory):
+    """Loads the encoding sidecar of a directory, or an empty cache if there is none."""
+    encoding_cache_path = os.path.join(directory, encoding_cache_name)
+    if not os.path.exists(encoding_cache_path):
+        return {}
+    try:
+        with open(encoding_cache_path, 'r', encoding='utf-8') as encoding_cache_file:
+            return json.load(encoding_cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_encoding_cache(directory, encoding_cache):
+    """Writes the encoding sidecar of a directory atomically."""
+    encoding_cache_path = os.path.join(directory, encoding_cache_name)
+    temp_file_path = encoding_cache_path + f'.{os.getpid()}.tmp'
+    try:
+        with open(temp_file_path, 'w', encoding='utf-8') as encoding_cache_file:
+            json.dump(encoding_cache, encoding_cache_file, indent=2)
+        os.replace(temp_file_path, encoding_cache_path)
+    except OSError as e:
+        # A read-only input directory only costs us the cache
+        print(f"Could not save the encoding cache for {directory}: {e}")
+
+def detect_file_encoding(file_path):
+    """Detects the encoding of a given file and returns it for use in pd.read_csv, reusing the sidecar cache while the file is unchanged."""
+    try:
+        directory, filename = get_input_directory(file_path), get_input_name(file_path)
+        file_size, file_mtime = get_input_size(file_path), get_input_mtime(file_path)
+        encoding_cache = load_encoding_cache(directory)
+        cached_entry = encoding_cache.get(filename)
+        if cached_entry and cached_entry['size'] == file_size and cached_entry['mtime'] == file_mtime:
+            return cached_entry['encoding']
+
+        encoding, detection_method = detect_encoding_uncached(file_path)
+        print(f"Detected encoding for {file_path}: {encoding} by {detection_method}")
+
+        encoding_cache[filename] = {'size': file_size, 'mtime': file_mtime, 'encoding': encoding}
+        save_encoding_cache(directory, encoding_cache)
+        return encoding  # Return the detected encoding
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return None  # Return None in case of an error
+
+def is_wide_encoding(encoding):
+    """Returns True for UTF-16 and UTF-32, which the readers parse much more slowly than UTF-8."""
+    if not encoding:
+        return False
+    try:
+        return codecs.lookup(encoding).name.startswith(('utf-16', 'utf-32'))
+    except LookupError:
+        return False
+
+def transcode_to_utf8(input_file_path, encoding, output_file_path):
+    """Streams a file, or a zip member, from encoding to UTF-8 without a byte order mark, writing atomically."""
+    temp_file_path = output_file_path + '.tmp'
+    with io.TextIOWrapper(open_input_file(input_file_path), encoding=encoding, newline='') as input_file, \
+            open(temp_file_path, 'w', encoding='utf-8', newline='') as output_file:
+        while True:
+            text = input_file.read(transcode_block_chars)
+            if not text:
+                break
+            output_file.write(text)
+    os.replace(temp_file_path, output_file_path)
+
+def normalize_input_encoding(file_path):
+    """Returns the path and encoding the readers should use for a file.
+
+    UTF-16 and UTF-32 files are transcoded once into a UTF-8 copy next to them, so this and later runs use
+    the fast UTF-8 parser path and can split the file into byte ranges.  The copy is rebuilt when the file changes.
+    A wide-encoded zip member gets its copy next to the archive.
+    """
+    encoding = detect_file_encoding(file_path)
+    if not is_wide_encoding(encoding):
+        return file_path, encoding
+
+    utf8_directory = os.path.join(get_input_directory(file_path), utf8_copy_directory_name)
+    utf8_file_path = os.path.join(utf8_directory, get_input_name(file_path))
+
+    # The copy is current if it was written after the source was last modified
+    if not os.path.exists(utf8_file_path) or os.path.getmtime(utf8_file_path) < get_input_mtime(file_path):
+        print(f"Transcoding {file_path} from {encoding} to UTF-8")
+        os.makedirs(utf8_directory, exist_ok=True)
+        transcode_to_utf8(file_path, encoding, utf8_file_path)
+    return utf8_file_path, 'utf-8'
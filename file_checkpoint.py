@@ -0,0 +1,100 @@
+import os
+import json
+from chunk_reader import read_award_chunks, read_column_names, find_record_end, find_range_end
+from run_manifest import get_file_fingerprint
+
+# Bytes parsed between two checkpoints.  A restart repeats at most this much work.
+checkpoint_interval_bytes = 256 * 1024 * 1024
+
+# The committed progress of one input file, so an interrupted run resumes at the last committed chunk
+class FileCheckpoint:
+    """Records the byte offset, chunk index and records processed in an input file, and the position of each sink.
+
+    A checkpoint only applies to the same file version and filter settings it was written for.
+    """
+
+    def __init__(self, checkpoint_path, input_file_path, settings_hash, interval_bytes=checkpoint_interval_bytes):
+        self.checkpoint_path = checkpoint_path
+        self.settings_hash = settings_hash
+        self.interval_bytes = interval_bytes
+        self.fingerprint = get_file_fingerprint(input_file_path)
+        self.state = None
+
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf-8') as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state.get('settings_hash') == settings_hash and state.get('fingerprint') == self.fingerprint:
+                self.state = state
+
+    @property
+    def exists(self):
+        return self.state is not None
+
+    @property
+    def processed_count(self):
+        return self.state['processed_count'] if self.state else 0
+
+    def commit(self, offset, chunk_index, processed_count, sinks, audit=None):
+        """Flushes the sinks and then records the progress, so the checkpoint never points past rows on disk."""
+        self.state = {
+            'settings_hash': self.settings_hash,
+            'fingerprint': self.fingerprint,
+            'offset': offset,
+            'chunk_index': chunk_index,
+            'processed_count': processed_count,
+            'sinks': [sink.commit() for sink in sinks],
+            'audit': audit.get_state() if audit is not None else None,
+        }
+        temp_file_path = self.checkpoint_path + '.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as checkpoint_file:
+            json.dump(self.state, checkpoint_file, indent=2)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_file_path, self.checkpoint_path)
+
+    def remove(self):
+        """Deletes the checkpoint once the file is fully processed."""
+        self.state = None
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+def read_checkpointed_chunks(input_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding, checkpoint, sinks, engine='pandas', audit=None, progress=None):
+    """Yields the chunks of an award CSV one record-aligned byte segment at a time, committing a checkpoint after each segment.
+
+    Starts after the last committed segment when the checkpoint exists, rewinding the sinks to their committed
+    positions first, and restoring the counters of an InputFileAudit.  The consumer must have counted and
+    written a chunk before asking for the next one.  The file must be in a byte-splittable encoding.
+    The position read up to is reported to a ProgressReporter when given.
+    """
+    column_names = read_column_names(input_file_path, file_encoding)
+    file_size = os.path.getsize(input_file_path)
+
+    with open(input_file_path, 'rb') as file:
+        if checkpoint.exists:
+            offset = checkpoint.state['offset']
+            chunk_index = checkpoint.state['chunk_index']
+            print(f"Resuming {input_file_path} at chunk {chunk_index}, byte {offset} of {file_size}")
+            for sink, (position, records_written) in zip(sinks, checkpoint.state['sinks']):
+                sink.rewind(position, records_written)
+            if audit is not None and checkpoint.state['audit']:
+                audit.set_state(checkpoint.state['audit'])
+        else:
+            offset = find_record_end(file, 0, False)
+            chunk_index = 0
+            for sink in sinks:
+                sink.rewind(0, 0)
+        processed_count = checkpoint.processed_count
+
+        while offset < file_size:
+            segment_end = find_range_end(file, offset, checkpoint.interval_bytes)
+            for chunk in read_award_chunks(input_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding, (offset, segment_end), column_names, engine, audit, progress):
+                processed_count += len(chunk)
+                chunk_index += 1
+                yield chunk
+
+            # Every chunk of the segment has been written by now
+            offset = segment_end
+            checkpoint.commit(offset, chunk_index, processed_count, sinks, audit)
+
+    # The sinks are renamed into place only after this, so a crash in between just redoes the file
+    checkpoint.remove()
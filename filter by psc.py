@@ -1,6 +1,20 @@
-import pandas as pd
 import os
 import time
+from contextlib import ExitStack
+from chunk_reader import read_award_chunks
+from encoding_detection import normalize_input_encoding
+from chunk_predicates import isin_mask, select_rows, compile_code_matcher, psc_code_length, naics_code_length
+from output_sink import open_output_sink
+from input_files import list_input_files
+from award_filter import filter_award_file, filter_chunk_for_chain, get_chain_output_file_names, get_chain_tap_count, get_chain_filter_fields, get_chain_code_predicates, get_projected_columns
+from parquet_store import get_award_filter_expression, read_store_chunks
+from chunk_sizing import AdaptiveChunkSize
+from code_index import load_current_code_index, get_indexed_runs, read_indexed_chunks
+from award_database import load_csv_into_database
+from pipeline_metrics import RunMetrics, FileMetrics
+from progress_report import ProgressReporter
+from arrow_ipc import is_arrow_ipc_file, read_arrow_ipc_chunks
+import award_schema
 
 #start a timer to measure total elapsed time
 script_start_time = time.time()
@@ -20,95 +34,14 @@ psc_codes_to_filter = ["R499", "D399", "D306", "R408", "R410", "D308", "D318", "
                        "DE10","DE11","DF","DF01","DF10","DG","DG01","DG10","DG11","DH","DH01",
                        "DH10","DJ","DJ01","DJ10","DJ10","DK","DK01","DK10",
                        ]
-# Convert the codes to a set for faster lookup
-psc_codes_hash_set = set(psc_codes_to_filter)
-
-# Define data types for columns based on the original list of field types
-dtype_mapping = { 
-    'contract_award_unique_key': 'str',
-    'award_id_piid': 'str',
-    'modification_number': 'str',
-    'transaction_number': 'str',
-    'federal_action_obligation': 'float',
-    'total_dollars_obligated': 'float',
-    'base_and_exercised_options_value': 'float',
-    'current_total_value_of_award': 'float',
-    'base_and_all_options_value': 'float',
-    'potential_total_value_of_award': 'float',
-    'action_date': 'str',  # Using str to handle various date formats
-    'action_date_fiscal_year': 'Int64',
-    'period_of_performance_start_date': 'str',
-    'period_of_performance_current_end_date': 'str',
-    'period_of_performance_potential_end_date': 'str',
-    'ordering_period_end_date': 'str',
-    'solicitation_date': 'str',
-    'awarding_agency_name': 'str',
-    'awarding_sub_agency_name': 'str',
-    'awarding_office_name': 'str',
-    'funding_agency_name': 'str',
-    'funding_sub_agency_name': 'str',
-    'funding_office_name': 'str',
-    'recipient_uei': 'str',
-    'recipient_name': 'str',
-    'recipient_name_raw': 'str',
-    'cage_code': 'str',
-    'recipient_parent_uei': 'str',
-    'recipient_parent_name': 'str',
-    'recipient_parent_name_raw': 'str',
-    'recipient_country_code': 'str',
-    'recipient_address_line_1': 'str',
-    'recipient_city_name': 'str',
-    'recipient_county_name': 'str',
-    'recipient_state_code': 'str',
-    'recipient_state_name': 'str',
-    'recipient_zip_4_code': 'str',
-    'recipient_phone_number': 'str',
-    'primary_place_of_performance_country_code': 'str',
-    'primary_place_of_performance_city_name': 'str',
-    'primary_place_of_performance_state_code': 'str',
-    'award_or_idv_flag': 'str',
-    'award_type': 'str',
-    'type_of_contract_pricing': 'str',
-    'transaction_description': 'str',
-    'prime_award_base_transaction_description': 'str',
-    'action_type': 'str',
-    'solicitation_identifier': 'str',
-    'number_of_actions': 'Int64',
-    'inherently_governmental_functions_description': 'str',
-    'product_or_service_code': 'str',
-    'product_or_service_code_description': 'str',
-    'contract_bundling': 'str',
-    'dod_claimant_program_description': 'str',
-    'naics_code': 'str',
-    'naics_description': 'str',
-    'information_technology_commercial_item_category': 'str',
-    'subcontracting_plan': 'str',
-    'extent_competed': 'str',
-    'solicitation_procedures': 'str',
-    'type_of_set_aside': 'str',
-    'evaluated_preference': 'str',
-    'number_of_offers_received': 'Int64',
-    'commercial_item_acquisition_procedures': 'str',
-    'fed_biz_opps': 'str',
-    'price_evaluation_adjustment_preference_percent_difference': 'float',
-    'interagency_contracting_authority': 'str',
-    'national_interest_action': 'str',
-    'cost_or_pricing_data': 'str',
-    'performance_based_service_acquisition': 'str',
-    'multi_year_contract': 'str',
-    'contract_financing': 'str',
-    'contracting_officers_determination_of_business_size': 'str',
-    'organizational_type': 'str',
-    'dot_certified_disadvantage': 'str',
-    'self_certified_small_disadvantaged_business': 'str',
-    'small_disadvantaged_business': 'str',
-    'c8a_program_participant': 'str',
-    'historically_underutilized_business_zone_hubzone_firm': 'str',
-    'sba_certified_8a_joint_venture': 'str',
-    'usaspending_permalink': 'str',
-    'initial_report_date': 'str',
-    'last_modified_date': 'str',
-}
+# Compile the codes once into a matcher for fast lookup: four-character codes match exactly, and shorter
+# category entries such as "D", "D3" or "DA" match every PSC code that starts with them
+psc_codes_matcher = compile_code_matcher(psc_codes_to_filter, psc_code_length)
+
+# Define data types for columns from award_schema.py, shared with the other filter scripts.  The compact types,
+# categoricals and narrower integers, take less memory per chunk and write the same outputs as the declared ones.
+use_compact_dtypes = True
+dtype_mapping = award_schema.compact_dtype_mapping if use_compact_dtypes else award_schema.dtype_mapping
 
 # Specify the fields to save in the output file
 fields_to_save = [
@@ -198,66 +131,211 @@ fields_to_save = [
 ]
 
 # Read the CSV file in chunks and skip bad lines
-def filter_data(input_file, output_file, field_name, filter_hash_set, chunk_size):
+def filter_data(input_file, output_file, field_name, filter_hash_set, chunk_size, engine='pandas', store_directory=None, store_filter_expression=None, use_code_index=False,
+                metrics=None):
+    """Writes the records of one CSV or Arrow IPC file, or of the Parquet store, whose field_name is in filter_hash_set to output_file.
+
+    The extension of output_file picks its format, as in open_output_sink, and a .arrow or .feather input_file is
+    memory-mapped and filtered batch by batch instead of parsed.
+    """
 
-    # Initialize a counter for skipped lines and total processed records
-    skipped_lines_count = 0
+    # Time each stage in the metrics of the input, or of the store queried instead
+    metrics_input = store_directory or input_file
+    file_metrics = metrics.get_file_metrics(metrics_input) if metrics is not None else FileMetrics(metrics_input)
+
+    # Initialize a counter for total processed records
     total_processed_count = 0  # Counter for total records processed
 
-    # Initialize an array to hold filtered records from all files
-    all_filtered_data = []
+    # Progress is reported by bytes read, so only for the input CSV and not for the store
+    progress = None
+    if store_directory:
+        # Query the Parquet store with predicate and column pushdown instead of parsing the input CSV
+        chunks = read_store_chunks(store_directory, fields_to_save, store_filter_expression)
+    elif is_arrow_ipc_file(input_file):
+        # An Arrow IPC intermediate needs no decoding or parsing; its record batches are filtered where they are mapped
+        progress = ProgressReporter([input_file], progress_interval_seconds, progress_log_file_path)
+        chunks = read_arrow_ipc_chunks(input_file, None, progress)
+        progress.start_file(input_file)
+    else:
+        # The UTF-16 output of the PowerShell filters is read from a UTF-8 copy made on the first run
+        with file_metrics.time_stage('detect'):
+            csv_file, file_encoding = normalize_input_encoding(input_file)
+        file_metrics.set_parsed_file(csv_file)
+        progress = ProgressReporter([input_file], progress_interval_seconds, progress_log_file_path)
 
-    # use chunksize to lower memory needs, typically in multiples of 100,000
-    for chunk in pd.read_csv(input_file, dtype=dtype_mapping, encoding='utf-16', chunksize=chunk_size):
+        # With a current code index of the input, seek to the records with matching codes instead of parsing them all
+        code_index = load_current_code_index(csv_file) if use_code_index else None
+        record_runs = get_indexed_runs(csv_file, code_index, [{field_name: filter_hash_set}], engine) if code_index is not None else None
+        if record_runs is not None:
+            chunks = read_indexed_chunks(csv_file, code_index, record_runs, None, dtype_mapping, chunk_size, file_encoding, engine, progress)
+        else:
+            # use chunksize to lower memory needs, typically in multiples of 100,000
+            chunks = read_award_chunks(csv_file, None, dtype_mapping, chunk_size, file_encoding, engine=engine, progress=progress)
+        progress.start_file(input_file, csv_file)
 
-        # Update the total processed count
-        total_processed_count += len(chunk)
+    # Stream the filtered records of every chunk to the output with one header, so memory stays bounded by one chunk
+    with open_output_sink(output_file, fields_to_save, dtype_mapping, output_compression.get(os.path.basename(output_file)), csv_writer) as sink:
+        for chunk in file_metrics.time_chunks(chunks):
 
-        # Filter the DataFrame based on the psc codes 
-        filtered_chunk = chunk[chunk[field_name].isin(filter_hash_set)]  # Include limited psc codes of interest
+            # Update the total processed count
+            total_processed_count += len(chunk)
 
-        # Append the filtered records to the list
-        all_filtered_data.append(filtered_chunk)
+            # Filter the DataFrame based on the psc codes
+            # pyarrow batches are converted to pandas by the sink only after filtering, so just the matching rows pay for it
+            with file_metrics.time_stage('filter'):
+                filtered_chunk = select_rows(chunk, isin_mask(chunk, field_name, filter_hash_set))  # Include limited psc codes of interest
 
-        # Print the count of records processed
-        # print(f"Number of skipped lines in {input_file}: {skipped_lines_count}")
-        print(f"Processed {total_processed_count} records from {input_file}.")
+            # Append the filtered records to the output
+            with file_metrics.time_stage('write'):
+                sink.write(filtered_chunk)
+            file_metrics.end_chunk(chunk, len(filtered_chunk))
 
-    if all_filtered_data:
-        # Concatenate all filtered data
-        final_filtered_df = pd.concat(all_filtered_data, ignore_index=True)
-        
-    """Saves the filtered DataFrame to a CSV file with the specified fields."""
-    if not filtered_chunk.empty:
-        # Select only the desired fields
-        final_filtered_df = filtered_chunk[fields_to_save]
+            # Report the bytes, rows and matches so far, at most once per progress interval
+            if progress:
+                progress.add_chunk(len(chunk), len(filtered_chunk))
+            else:
+                print(f"Processed {total_processed_count} records from {input_file}.")
+        if progress:
+            progress.finish_file()
 
-        # Save the filtered DataFrame to a single output file with one header
-        final_filtered_df.to_csv(output_file, index=False)
+# A function to run the raw files through every stage of the filter chain in a single read
+def filter_chain_files(input_directory, output_directory, filter_chain, output_file_name, metrics=None):
+    """Writes the records of every raw CSV in input_directory, and every CSV inside its zip archives, that pass all the
+    stages of filter_chain to output_file_name in output_directory, and the records left after each stage with a tap
+    to the tap's file.
 
-        # Output the number of records saved
-        print(f"Filtered records saved to: {output_file}")
-        print(f"Number of records saved: {len(final_filtered_df)}")
-    else:
-        print("No records found matching the specified product_or_service_code values.")
+    Only the columns of the predicates and fields_to_save are parsed, and the records are read once whatever the
+    number of stages.  Malformed lines are quarantined in output_directory.  The extension of each output name picks
+    its format, as in open_output_sink.
+    """
+    input_file_paths = list_input_files(input_directory)
+    output_file_names = get_chain_output_file_names(filter_chain, output_file_name)
+    columns_to_read = get_projected_columns(get_chain_filter_fields(filter_chain), fields_to_save)
+    dtypes_to_read = {column: dtype_mapping[column] for column in columns_to_read if column in dtype_mapping}
+    code_predicates = get_chain_code_predicates(filter_chain) if use_code_index else None
+    progress = ProgressReporter(input_file_paths, progress_interval_seconds, progress_log_file_path)
+
+    # Stream the filtered records of each stage with a tap, and of the whole chain, to their own outputs
+    with ExitStack() as output_stack:
+        sinks = [output_stack.enter_context(open_output_sink(os.path.join(output_directory, file_name), fields_to_save, dtype_mapping, output_compression.get(file_name), csv_writer))
+                 for file_name in output_file_names]
+        for input_file_path in input_file_paths:
+            filter_award_file(input_file_path, columns_to_read, dtypes_to_read, chunk_size, filter_chunk_for_chain, (filter_chain,), sinks, engine=csv_engine,
+                              quarantine_directory=output_directory, code_predicates=code_predicates, metrics=metrics, progress=progress,
+                              tap_count=get_chain_tap_count(filter_chain))
 
 
 # Start timing the processing
 start_time = time.time()
 
-# Define the input directory and output directory
+# Define the input directory of the raw USAspending files and the output directory
+input_directory = r"C:\temp\awards"
+output_directory = os.path.join(input_directory, "out")
+
+# Define the NAICS-filtered input of the two-stage workflow, and the output.  Either can be an Arrow IPC file, e.g.
+# dod_awards_by_naics_codes.arrow saved by the tap below, which is memory-mapped and filtered without parsing.
 input_file = r"C:\temp\awards\out\dod_awards_by_naics_codes.csv" 
 output_file = r"C:\temp\awards\out\dod_awards_by_naics_and_psc_codes_isnotin.csv"
 
+# Define the list of NAICS codes of the DoD IT awards kept before the PSC codes are applied
+naics_codes_to_filter = [
+    "541511", "541512", "541513", "541519",
+    "541611", "541612", "541613", "541614",
+    "541618", "541620", "541690"
+]
+
+# The staged filter, run on the raw files in a single read instead of writing dod_awards_by_naics_codes.csv (UTF-16)
+# in a first pass and parsing it again here.  Set the first stage's tap_file_name to still save the NAICS-filtered
+# records, e.g. to "dod_awards_by_naics_codes.csv"; the taps are written in UTF-8.  A tap named .arrow or .feather,
+# e.g. "dod_awards_by_naics_codes.arrow", is saved as an Arrow IPC file that later filters, dedupe or analysis can
+# memory-map instead of parsing.
+filter_chain = [
+    {
+        'name': 'DoD IT NAICS',
+        'naics_codes': compile_code_matcher(naics_codes_to_filter, naics_code_length),
+        'excluded_awarding_sub_agencies': {'Federal Acquisition Service'},       # Indicator of MAS Schedule actions which we don't care about
+        'funding_group': 'dod',
+        'tap_file_name': None,
+    },
+    {
+        'name': 'IT PSC',
+        'psc_codes': psc_codes_matcher,
+    },
+]
+
+# Run filter_chain on the raw files in input_directory.  Set to False to filter the NAICS-filtered input_file by PSC
+# code with filter_data, as the two-stage workflow did.
+use_filter_chain = True
+
 chunk_size = 50000
-filter_data(input_file, output_file, 'product_or_service_code', psc_codes_hash_set, chunk_size)
 
-#End the timer to measure total script elapsed time
-script_duration = time.time() - script_start_time
+# Memory budget for the chunks being parsed and filtered, e.g. '4GB', '512MB', or 'auto' for half of the available
+# memory.  When set, the rows per chunk are tuned from the bytes per row observed as the files are read, and
+# chunk_size above is only used when this is None.
+max_memory = 'auto'
+if max_memory:
+    chunk_size = AdaptiveChunkSize(max_memory)
+
+# CSV parser: 'pandas' for the single-threaded C parser, or 'pyarrow' for pyarrow's multithreaded streaming reader
+csv_engine = 'pandas'
+
+# The extension of output_file and of the taps picks their format: .csv, .csv.gz or .csv.zst for compressed CSV,
+# .parquet for zstd-compressed Parquet, or .arrow or .feather for Arrow IPC.  output_compression sets another
+# compression for particular outputs by file name, e.g. {"dod_awards_by_naics_and_psc_codes_isnotin.parquet": 'snappy'}.
+output_compression = {}
+
+# Writer of the CSV outputs: 'pandas' for exactly the CSV of earlier runs, or 'arrow' for pyarrow's native writer,
+# many times faster but quoting every text value and writing floats in shortest form
+csv_writer = 'pandas'
+
+# Parquet store built by "build parquet store.py".  When set, filter_data skips the CSV files and queries the
+# store's DoD partitions for records in the NAICS and PSC codes above (MAS schedule actions excluded) instead.
+parquet_store_directory = None  # e.g. r"C:\temp\awards\parquet_store"
+store_filter_expression = None
+if parquet_store_directory:
+    store_filter_expression = get_award_filter_expression(set(naics_codes_to_filter), psc_codes_matcher, 'dod')
+
+# Read only the records with matching codes when an input has a current code index, built by "build code index.py"
+use_code_index = True
+
+# Also load the output into a table of the local SQLite database used by "combine and filter.py", for ad-hoc queries.
+# An unchanged output is not loaded again, and only an uncompressed CSV output is loaded.
+award_database_path = None  # e.g. r"C:\temp\awards\out\awards.sqlite"
+
+# Time the detect, parse, filter and write stages and save them with the rows read and written to
+# pipeline_metrics.json next to the output, appending a row to pipeline_metrics.csv to compare across runs
+collect_metrics = True
+
+# Report how far the run is through the input CSVs, with MB/s, rows/s, rows written and ETA, at most every
+# progress_interval_seconds, printed or appended to progress_log_file_path for unattended runs
+progress_interval_seconds = 10
+progress_log_file_path = None  # e.g. r"C:\temp\awards\out\progress.log"
+
+# Guard the run so the benchmarks can import filter_data without starting another run
+if __name__ == '__main__':
+    run_metrics = RunMetrics('filter by psc') if collect_metrics else None
+    if use_filter_chain and not parquet_store_directory:
+        # Create the output directory if it does not exist
+        os.makedirs(output_directory, exist_ok=True)
+        filter_chain_files(input_directory, output_directory, filter_chain, os.path.basename(output_file), run_metrics)
+
+        # The chain writes its output under the name of output_file in the output directory
+        output_file = os.path.join(output_directory, os.path.basename(output_file))
+    else:
+        filter_data(input_file, output_file, 'product_or_service_code', psc_codes_matcher, chunk_size, csv_engine, parquet_store_directory, store_filter_expression, use_code_index,
+                    run_metrics)
+    if run_metrics:
+        run_metrics.write_report(os.path.dirname(output_file))
+
+    if award_database_path and os.path.exists(output_file) and output_file.lower().endswith('.csv'):
+        load_csv_into_database(award_database_path, output_file, dtype_mapping)
+
+    #End the timer to measure total script elapsed time
+    script_duration = time.time() - script_start_time
 
-# Convert duration into hours, minutes, and seconds for readability
-hours, remainder = divmod(script_duration, 3600)
-minutes, seconds = divmod(remainder, 60)
+    # Convert duration into hours, minutes, and seconds for readability
+    hours, remainder = divmod(script_duration, 3600)
+    minutes, seconds = divmod(remainder, 60)
 
-# Print user-friendly execution time
-print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
\ No newline at end of file
+    # Print user-friendly execution time
+    print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
@@ -0,0 +1,75 @@
+import os
+import time
+import zipfile
+from collections import namedtuple
+
+# Input files are either paths of CSV files or ZipMembers, CSV files inside a USAspending zip archive that are
+# streamed straight from the archive instead of being extracted first.  The helpers below accept either kind.
+
+class ZipMember(namedtuple('ZipMember', ['archive_path', 'member_name'])):
+    """A CSV member of a zip archive."""
+    __slots__ = ()
+
+    def __str__(self):
+        return f"{self.archive_path}/{self.member_name}"
+
+def list_input_files(input_directory):
+    """Returns the .csv files of a directory and the .csv members of its .zip archives, in directory order.
+
+    Inputs are identified by file name in the caches and reports, so two inputs with the same name, e.g. an
+    archive and the CSVs already extracted from it, are an error rather than being counted twice.
+    """
+    input_files = []
+    for filename in os.listdir(input_directory):
+        file_path = os.path.join(input_directory, filename)
+        if filename.endswith('.csv'):
+            input_files.append(file_path)
+        elif filename.endswith('.zip'):
+            with zipfile.ZipFile(file_path) as archive:
+                input_files += [ZipMember(file_path, member.filename) for member in archive.infolist()
+                                if not member.is_dir() and member.filename.endswith('.csv')]
+
+    input_names = {}
+    for input_file in input_files:
+        input_name = get_input_name(input_file)
+        if input_name in input_names:
+            raise ValueError(f"Two input files are named {input_name}: {input_names[input_name]} and {input_file}")
+        input_names[input_name] = input_file
+    return input_files
+
+def is_zip_member(input_file):
+    """Returns True for a CSV inside a zip archive, which can only be read front to back."""
+    return isinstance(input_file, ZipMember)
+
+def get_input_name(input_file):
+    """Returns the file name of an input, e.g. FY2024_All_Contracts_Full_1.csv, the same whether it is zipped or not."""
+    if is_zip_member(input_file):
+        return os.path.basename(input_file.member_name)
+    return os.path.basename(input_file)
+
+def get_input_directory(input_file):
+    """Returns the directory that holds an input file, or its archive."""
+    return os.path.dirname(os.path.abspath(input_file.archive_path if is_zip_member(input_file) else input_file))
+
+def get_zip_info(input_file):
+    """Returns the ZipInfo of a zip member."""
+    with zipfile.ZipFile(input_file.archive_path) as archive:
+        return archive.getinfo(input_file.member_name)
+
+def get_input_size(input_file):
+    """Returns the uncompressed size of an input file in bytes."""
+    if is_zip_member(input_file):
+        return get_zip_info(input_file).file_size
+    return os.path.getsize(input_file)
+
+def get_input_mtime(input_file):
+    """Returns the modification time of an input file; for a zip member, the time recorded in the archive."""
+    if is_zip_member(input_file):
+        return time.mktime(get_zip_info(input_file).date_time + (0, 0, -1))
+    return os.path.getmtime(input_file)
+
+def open_input_file(input_file):
+    """Opens an input file for reading bytes, decompressing a zip member as it is read."""
+    if is_zip_member(input_file):
+        return zipfile.ZipFile(input_file.archive_path).open(input_file.member_name)
+    return open(input_file, 'rb')
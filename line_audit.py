@@ -0,0 +1,194 @@
+import os
+import csv
+import json
+from chunk_predicates import count_missing_values
+from input_files import get_input_name, open_input_file
+
+# Columns of the quarantine file written for each input file with malformed lines
+quarantine_fields = ['source_file', 'line_number', 'reason', 'raw_line']
+
+# Name of the file in the output directory that keeps the counters of every input file processed
+line_counts_file_name = 'input_line_counts.json'
+
+# Bytes scanned at a time while locating malformed records
+audit_block_bytes = 8 * 1024 * 1024
+
+def get_quarantine_file_path(quarantine_directory, input_file_path):
+    """Returns the quarantine file of an input file, e.g. out/FY2024_All_Contracts_1_bad_lines.csv."""
+    return os.path.join(quarantine_directory, os.path.splitext(get_input_name(input_file_path))[0] + '_bad_lines.csv')
+
+def load_line_counts(output_directory):
+    """Returns the counters recorded for each input file in the output directory, keyed by file name."""
+    line_counts_path = os.path.join(output_directory, line_counts_file_name)
+    if not os.path.exists(line_counts_path):
+        return {}
+    with open(line_counts_path, 'r', encoding='utf-8') as line_counts_file:
+        return json.load(line_counts_file)
+
+def iter_records(file, start):
+    """Yields the byte offset and raw bytes of each record from start, which must be a record boundary, keeping quoted newlines inside their record.
+
+    Only reads forward, so it also works on a zip member streamed out of its archive.
+    """
+    file.seek(start)
+    record_start = start
+    record_head = b''  # The part of the current record read with earlier blocks
+    in_quotes = False
+    block_start = start
+    while True:
+        block = file.read(audit_block_bytes)
+        if not block:
+            break
+        position = 0
+        block_record_start = 0
+        while True:
+            next_newline = block.find(b'\n', position)
+            next_quote = block.find(b'"', position)
+            if next_newline != -1 and (next_quote == -1 or next_newline < next_quote):
+                if not in_quotes:
+                    yield record_start, record_head + block[block_record_start:next_newline + 1]
+                    record_start = block_start + next_newline + 1
+                    record_head = b''
+                    block_record_start = next_newline + 1
+                position = next_newline + 1
+            elif next_quote != -1:
+                in_quotes = not in_quotes
+                position = next_quote + 1
+            else:
+                break
+        record_head += block[block_record_start:]
+        block_start += len(block)
+    if record_head:
+        yield record_start, record_head
+
+# Exact counters of one input file, and the malformed lines the CSV readers skipped in it
+class InputFileAudit:
+    """Counts the records read, the malformed lines skipped and the missing values per column of an input file.
+
+    Malformed lines are recorded as the readers report them: pandas gives a record number, pyarrow, and pandas for
+    the records with too many fields of a projected read, give the raw text.  Both are relative to the byte range they were read from.  write_quarantine() resolves them to
+    source line numbers and raw text with one extra pass over the file, made only when there are malformed lines.
+    """
+
+    def __init__(self, input_file_path):
+        self.input_file_path = input_file_path
+        self.records_read = 0
+        self.missing_values = {}
+        self.bad_lines = []
+
+    def count_chunk(self, chunk):
+        """Adds the records and missing values of a chunk, without copying it."""
+        self.records_read += len(chunk)
+        for column, missing_count in count_missing_values(chunk).items():
+            self.missing_values[column] = self.missing_values.get(column, 0) + missing_count
+
+    def record_bad_line(self, range_start, record_number, raw_line, reason):
+        """Records a skipped line by its record number within the byte range starting at range_start, or by its raw text."""
+        self.bad_lines.append([range_start, record_number, raw_line, reason])
+
+    def merge(self, other_audit):
+        """Adds the counters and malformed lines of another audit of the same file, e.g. of one byte range read by a worker."""
+        self.records_read += other_audit.records_read
+        for column, missing_count in other_audit.missing_values.items():
+            self.missing_values[column] = self.missing_values.get(column, 0) + missing_count
+        self.bad_lines += other_audit.bad_lines
+
+    def get_state(self):
+        """Returns the counters and malformed lines as JSON-friendly values, e.g. for a checkpoint."""
+        return {'records_read': self.records_read, 'missing_values': self.missing_values, 'bad_lines': self.bad_lines}
+
+    def set_state(self, state):
+        """Restores what get_state() returned."""
+        self.records_read = state['records_read']
+        self.missing_values = dict(state['missing_values'])
+        self.bad_lines = [list(bad_line) for bad_line in state['bad_lines']]
+
+    def locate_bad_lines(self, file_path, file_encoding):
+        """Returns [line_number, reason, raw_line] rows for the malformed lines, in file order.
+
+        file_path is the file that was actually parsed, e.g. the UTF-8 copy of a UTF-16 input, or a ZipMember.
+        """
+        bad_lines_by_range = {}
+        for range_start, record_number, raw_line, reason in self.bad_lines:
+            bad_lines_by_range.setdefault(range_start, []).append((record_number, raw_line, reason))
+
+        # Find the byte offset and text of each malformed record within its range
+        located = []
+        with open_input_file(file_path) as file:
+            for range_start, range_bad_lines in bad_lines_by_range.items():
+                wanted_numbers = {record_number for record_number, raw_line, reason in range_bad_lines if record_number is not None}
+                wanted_lines = {}
+                for record_number, raw_line, reason in range_bad_lines:
+                    if record_number is None:
+                        wanted_lines[raw_line] = wanted_lines.get(raw_line, 0) + 1
+                found_numbers = {}
+                found_lines = {}
+                for record_number, (record_start, record_bytes) in enumerate(iter_records(file, range_start), start=1):
+                    if not wanted_numbers and not wanted_lines:
+                        break
+                    if record_number not in wanted_numbers and not wanted_lines:
+                        continue
+                    raw_line = record_bytes.rstrip(b'\r\n').decode(file_encoding or 'utf-8', errors='replace')
+                    if record_number in wanted_numbers:
+                        found_numbers[record_number] = (record_start, raw_line)
+                        wanted_numbers.discard(record_number)
+                    elif raw_line in wanted_lines:
+                        found_lines.setdefault(raw_line, []).append(record_start)
+                        wanted_lines[raw_line] -= 1
+                        if not wanted_lines[raw_line]:
+                            del wanted_lines[raw_line]
+
+                for record_number, raw_line, reason in range_bad_lines:
+                    if record_number is not None:
+                        record_start, raw_line = found_numbers.get(record_number, (None, None))
+                    else:
+                        record_start = found_lines[raw_line].pop(0) if found_lines.get(raw_line) else None
+                    located.append([record_start, reason, raw_line])
+
+            # Turn byte offsets into line numbers by counting the newlines before them
+            located.sort(key=lambda bad_line: (bad_line[0] is None, bad_line[0] or 0))
+            file.seek(0)
+            position = 0
+            line_number = 1
+            for bad_line in located:
+                record_start = bad_line[0]
+                if record_start is None:
+                    continue
+                while position < record_start:
+                    block = file.read(min(audit_block_bytes, record_start - position))
+                    if not block:
+                        break
+                    line_number += block.count(b'\n')
+                    position += len(block)
+                bad_line[0] = line_number
+        return located
+
+    def write_quarantine(self, quarantine_directory, file_path, file_encoding):
+        """Writes the malformed lines to the quarantine file of this input, or removes a stale one if there are none."""
+        quarantine_file_path = get_quarantine_file_path(quarantine_directory, self.input_file_path)
+        if not self.bad_lines:
+            if os.path.exists(quarantine_file_path):
+                os.remove(quarantine_file_path)
+            return None
+
+        with open(quarantine_file_path, 'w', newline='', encoding='utf-8') as quarantine_file:
+            writer = csv.writer(quarantine_file)
+            writer.writerow(quarantine_fields)
+            for line_number, reason, raw_line in self.locate_bad_lines(file_path, file_encoding):
+                writer.writerow([get_input_name(self.input_file_path), line_number, reason, raw_line])
+        return quarantine_file_path
+
+    def save_counts(self, output_directory):
+        """Records the counters of this input in the output directory's input_line_counts.json."""
+        line_counts = load_line_counts(output_directory)
+        line_counts[get_input_name(self.input_file_path)] = {'records_read': self.records_read, 'bad_lines': len(self.bad_lines),
+                                                               'missing_values': self.missing_values}
+        with open(os.path.join(output_directory, line_counts_file_name), 'w', encoding='utf-8') as line_counts_file:
+            json.dump(line_counts, line_counts_file, indent=2)
+
+    def report(self, output_directory, file_path, file_encoding):
+        """Writes the quarantine file and the counters of this input, and prints a one-line summary."""
+        quarantine_file_path = self.write_quarantine(output_directory, file_path, file_encoding)
+        self.save_counts(output_directory)
+        if quarantine_file_path:
+            print(f"Skipped {len(self.bad_lines)} malformed lines in {self.input_file_path}; quarantined to {quarantine_file_path}")
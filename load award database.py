@@ -0,0 +1,33 @@
+import os
+import time
+import pandas as pd
+from award_schema import dtype_mapping
+from award_database import load_csv_into_database
+
+#start a timer to measure total elapsed time
+script_start_time = time.time()
+
+# Load the filtered award CSVs in the output directory into a local SQLite database, one table per file, e.g.
+# combined_dod, with indexes on the NAICS, PSC, agency, office, recipient UEI and end date fields, so ad-hoc
+# questions are answered with a SQL query instead of another pandas run.  Files loaded before are skipped until
+# their size or modification time changes.  "combine and filter.py" can also keep the tables up to date as it runs.
+
+# Define the output directory and the database
+output_directory = r"C:\temp\awards\out"
+award_database_path = os.path.join(output_directory, "awards.sqlite")
+
+# Only files of transactions are loaded, not the quarantined lines or rollup tables written next to them
+for file_name in sorted(os.listdir(output_directory)):
+    output_file_path = os.path.join(output_directory, file_name)
+    if file_name.endswith('.csv') and 'contract_transaction_unique_key' in pd.read_csv(output_file_path, nrows=0).columns:
+        load_csv_into_database(award_database_path, output_file_path, dtype_mapping)
+
+#End the timer to measure total script elapsed time
+script_duration = time.time() - script_start_time
+
+# Convert duration into hours, minutes, and seconds for readability
+hours, remainder = divmod(script_duration, 3600)
+minutes, seconds = divmod(remainder, 60)
+
+# Print user-friendly execution time
+print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
@@ -0,0 +1,291 @@
+import io
+import os
+import shutil
+import pandas as pd
+from abc import ABC, abstractmethod
+from chunk_reader import to_pandas_chunk, read_arrow_batches
+from arrow_ipc import is_arrow_ipc_file, get_arrow_schema
+from parquet_store import rows_per_row_group
+
+# Compressed CSV outputs are named with the extension of their compression after .csv, e.g. combined_dod.csv.gz
+csv_compression_extensions = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Compression of Parquet outputs unless an output sets its own: 'zstd', 'snappy', 'gzip' or 'none'
+parquet_compression = 'zstd'
+
+# CSV writers: 'pandas' writes exactly what DataFrame.to_csv always has.  'arrow' uses pyarrow's native CSV writer,
+# many times faster, but it quotes every text value and writes floats in shortest form, e.g. 1.23456789012e+11,
+# so its files read back the same but are not byte for byte those of earlier runs.
+csv_writers = ['pandas', 'arrow']
+
+def get_csv_compression(output_file_path):
+    """Returns the compression of a CSV output by its extension, e.g. 'gzip' for combined_dod.csv.gz, or None."""
+    return csv_compression_extensions.get(os.path.splitext(output_file_path)[1].lower())
+
+def get_output_file_stem(output_file_path):
+    """Returns an output path without its extension, or extensions for a compressed CSV, e.g. combined_dod for combined_dod.csv.gz."""
+    output_stem, extension = os.path.splitext(output_file_path)
+    if extension.lower() in csv_compression_extensions:
+        output_stem = os.path.splitext(output_stem)[0]
+    return output_stem
+
+def to_arrow_table(chunk, fields_to_save):
+    """Returns the fields_to_save columns of a DataFrame or pyarrow RecordBatch as a pyarrow Table."""
+    import pyarrow as pa
+    if isinstance(chunk, pd.DataFrame):
+        return pa.Table.from_pandas(chunk[fields_to_save], preserve_index=False)
+    return pa.Table.from_batches([chunk.select(fields_to_save)])
+
+
+# A streaming writer that appends each filtered chunk to an output CSV as soon as it is produced,
+# so memory stays bounded by one chunk instead of growing with the total number of matches
+class StreamingCsvSink:
+    """Appends DataFrame chunks to a temporary CSV with one header and renames it into place on close.
+
+    With a compression of 'gzip' or 'zstd' the CSV is compressed as it is written; a compressed CSV cannot be
+    committed to a checkpoint.  writer is one of csv_writers.
+    """
+
+    def __init__(self, output_file_path, fields_to_save, encoding='utf-8', verbose=True, resume=False, compression=None, writer='pandas'):
+        if writer not in csv_writers:
+            raise ValueError(f"Unknown CSV writer {writer!r}; choose one of {', '.join(csv_writers)}")
+        if writer == 'arrow' and encoding.lower().replace('-', '') != 'utf8':
+            raise ValueError(f"The arrow CSV writer only writes UTF-8, not {encoding}")
+        if compression and resume:
+            raise ValueError(f"{output_file_path} is compressed, so it cannot resume from a checkpoint")
+        self.output_file_path = output_file_path
+        self.fields_to_save = fields_to_save
+        self.encoding = encoding
+        self.verbose = verbose
+        self.compression = compression
+        self.writer = writer
+        self.records_written = 0
+        self.committed = False
+
+        # Write to a temp file in the same directory so the final rename is atomic.  When resuming, the temp
+        # file of the interrupted run is kept so rewind() can cut it back to the last checkpoint.
+        self.temp_file_path = output_file_path + '.tmp'
+        if compression:
+            import pyarrow as pa
+            self.file = io.TextIOWrapper(pa.CompressedOutputStream(self.temp_file_path, compression), encoding=encoding, newline='')
+        else:
+            self.file = open(self.temp_file_path, 'a' if resume else 'w', newline='', encoding=encoding)
+
+    def write(self, filtered_chunk):
+        """Appends the fields_to_save columns of a chunk, writing the header only with the first rows.
+
+        pyarrow RecordBatches are converted to pandas here, after filtering and projection, so only matching rows pay for
+        it; the arrow writer writes them, and DataFrames converted to Arrow, as they are.
+        """
+        if len(filtered_chunk) == 0:
+            return
+        if self.writer == 'arrow':
+            import pyarrow.csv as pa_csv
+            self.file.flush()
+            pa_csv.write_csv(to_arrow_table(filtered_chunk, self.fields_to_save), self.file.buffer, pa_csv.WriteOptions(include_header=self.records_written == 0))
+        else:
+            if not isinstance(filtered_chunk, pd.DataFrame):
+                filtered_chunk = to_pandas_chunk(filtered_chunk.select(self.fields_to_save))
+            filtered_chunk[self.fields_to_save].to_csv(self.file, index=False, header=self.records_written == 0)
+        self.records_written += len(filtered_chunk)
+
+    def append_part(self, part_file_path, part_records, remove_part=True):
+        """Appends the rows of a part CSV written by another sink with the same fields, then deletes the part unless remove_part is False."""
+        if part_records == 0:
+            return
+
+        # Copy the raw bytes so the merged output is identical to writing the chunks here directly
+        self.file.flush()
+        with open(part_file_path, 'rb') as part_file:
+            header = part_file.readline()
+            if self.records_written == 0:
+                self.file.buffer.write(header)
+            shutil.copyfileobj(part_file, self.file.buffer, 1024 * 1024)
+        self.records_written += part_records
+        if remove_part:
+            os.remove(part_file_path)
+
+    def commit(self):
+        """Flushes the written rows to disk and returns the (byte position, records written) a checkpoint can rewind to."""
+        if self.compression:
+            raise ValueError(f"{self.output_file_path} is compressed, so it cannot be committed to a checkpoint")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.committed = True
+        return [os.fstat(self.file.fileno()).st_size, self.records_written]
+
+    def rewind(self, position, records_written):
+        """Drops anything written after a committed position, e.g. the rows of a segment that was interrupted."""
+        if self.compression:
+            raise ValueError(f"{self.output_file_path} is compressed, so it cannot be rewound to a checkpoint")
+        self.file.flush()
+        if os.fstat(self.file.fileno()).st_size < position:
+            raise ValueError(f"{self.temp_file_path} is shorter than its checkpoint")
+        self.file.buffer.truncate(position)
+        self.records_written = records_written
+
+    def close(self):
+        """Finishes the output: renames the temp file into place, or removes it if nothing was written."""
+        self.file.close()
+        if self.records_written:
+            os.replace(self.temp_file_path, self.output_file_path)
+
+            # Output the number of records saved
+            if self.verbose:
+                print(f"Filtered records saved to: {self.output_file_path}")
+                print(f"Number of records saved: {self.records_written}")
+        else:
+            os.remove(self.temp_file_path)
+            if self.verbose:
+                print(f"No records found for {self.output_file_path} matching the specified filters across all files.")
+
+    def abort(self):
+        """Discards the temp file and leaves any previous output untouched.
+
+        A temp file with committed rows is kept, so the run can resume from its checkpoint.
+        """
+        self.file.close()
+        if not self.committed and os.path.exists(self.temp_file_path):
+            os.remove(self.temp_file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# A writer with the interface of StreamingCsvSink for the columnar formats, which pyarrow writes table by table
+class ArrowTableSink(ABC):
+    """Appends chunks as pyarrow Tables with the types of dtypes to a temporary file, renamed into place on close.
+
+    Subclasses open the writer of their format in open_writer().  These files cannot be cut back to a committed
+    position, so there is no commit() or rewind(), and they are only used for final outputs, never for the parts and
+    results that checkpoints and the run cache keep.
+    """
+
+    def __init__(self, output_file_path, fields_to_save, dtypes=None, compression=None, verbose=True):
+        self.output_file_path = output_file_path
+        self.fields_to_save = fields_to_save
+        self.dtypes = dtypes
+        self.compression = compression
+        self.verbose = verbose
+        self.records_written = 0
+        self.schema = get_arrow_schema(fields_to_save, dtypes)
+
+        # Write to a temp file in the same directory so the final rename is atomic
+        self.temp_file_path = output_file_path + '.tmp'
+        self.writer = self.open_writer()
+
+    @abstractmethod
+    def open_writer(self):
+        """Returns the writer of the format, writing to temp_file_path with schema."""
+
+    def write(self, filtered_chunk):
+        """Appends the fields_to_save columns of a DataFrame or pyarrow RecordBatch, cast to the output's schema."""
+        if len(filtered_chunk) == 0:
+            return
+        self.write_table(to_arrow_table(filtered_chunk, self.fields_to_save).cast(self.schema))
+        self.records_written += len(filtered_chunk)
+
+    def write_table(self, table):
+        self.writer.write_table(table)
+
+    def append_part(self, part_file_path, part_records, remove_part=True):
+        """Appends the rows of a part CSV written by a StreamingCsvSink with the same fields, then deletes the part unless remove_part is False."""
+        if part_records == 0:
+            return
+        for batch in read_arrow_batches(part_file_path, self.fields_to_save, self.dtypes, None):
+            self.write(batch)
+        if remove_part:
+            os.remove(part_file_path)
+
+    def close_writer(self):
+        self.writer.close()
+
+    def close(self):
+        """Finishes the output: renames the temp file into place, or removes it if nothing was written."""
+        self.close_writer()
+        if self.records_written:
+            os.replace(self.temp_file_path, self.output_file_path)
+
+            # Output the number of records saved
+            if self.verbose:
+                print(f"Filtered records saved to: {self.output_file_path}")
+                print(f"Number of records saved: {self.records_written}")
+        else:
+            os.remove(self.temp_file_path)
+            if self.verbose:
+                print(f"No records found for {self.output_file_path} matching the specified filters across all files.")
+
+    def abort(self):
+        """Discards the temp file and leaves any previous output untouched."""
+        self.writer.close()
+        if os.path.exists(self.temp_file_path):
+            os.remove(self.temp_file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class ArrowIpcSink(ArrowTableSink):
+    """Writes an Arrow IPC (Feather V2) file with one record batch per chunk, so read_arrow_ipc_chunks reads it back in the same chunks.
+
+    Uncompressed files can be memory-mapped without copying; a compression of 'lz4' or 'zstd' makes them smaller
+    but has every batch decompressed as it is read.
+    """
+
+    def open_writer(self):
+        import pyarrow as pa
+        return pa.ipc.new_file(self.temp_file_path, self.schema, options=pa.ipc.IpcWriteOptions(compression=self.compression))
+
+class ParquetSink(ArrowTableSink):
+    """Writes a Parquet file, gathering the filtered chunks into row groups of rows_per_row_group rows."""
+
+    def open_writer(self):
+        import pyarrow.parquet as pq
+        self.pending_tables = []
+        self.pending_rows = 0
+        return pq.ParquetWriter(self.temp_file_path, self.schema, compression=self.compression or 'none')
+
+    def write_table(self, table):
+        # Filtered chunks are often a few rows each, too small to be row groups of their own
+        self.pending_tables.append(table)
+        self.pending_rows += len(table)
+        if self.pending_rows >= rows_per_row_group:
+            self.write_pending_tables()
+
+    def write_pending_tables(self):
+        import pyarrow as pa
+        if self.pending_tables:
+            self.writer.write_table(pa.concat_tables(self.pending_tables), row_group_size=rows_per_row_group)
+        self.pending_tables = []
+        self.pending_rows = 0
+
+    def close_writer(self):
+        self.write_pending_tables()
+        self.writer.close()
+
+
+# A function to pick the writer of an output by the extension of its file name
+def open_output_sink(output_file_path, fields_to_save, dtypes=None, compression=None, csv_writer='pandas', verbose=True):
+    """Returns the sink of an output by its extension, compressed with compression when given:
+
+    .parquet          a ParquetSink, compressed with parquet_compression by default
+    .arrow, .feather  an ArrowIpcSink, uncompressed by default so it can be memory-mapped
+    .csv.gz, .csv.zst a StreamingCsvSink compressed with gzip or zstd, written by csv_writer
+    anything else     a StreamingCsvSink, written by csv_writer
+    """
+    if output_file_path.lower().endswith('.parquet'):
+        return ParquetSink(output_file_path, fields_to_save, dtypes, compression or parquet_compression, verbose=verbose)
+    if is_arrow_ipc_file(output_file_path):
+        return ArrowIpcSink(output_file_path, fields_to_save, dtypes, compression, verbose=verbose)
+    return StreamingCsvSink(output_file_path, fields_to_save, verbose=verbose, compression=compression or get_csv_compression(output_file_path), writer=csv_writer)
@@ -0,0 +1,181 @@
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from encoding_detection import normalize_input_encoding
+from chunk_reader import read_award_chunks, read_column_names, split_file_into_ranges, get_range_count, is_byte_splittable, open_whole_file
+from input_files import get_input_name
+from output_sink import StreamingCsvSink
+from line_audit import InputFileAudit
+from pipeline_metrics import FileMetrics
+from progress_report import ProgressReporter
+from chunk_sizing import AdaptiveChunkSize, get_available_memory, memory_sample_rows, chunk_memory_overhead_factor
+from award_filter import count_written_rows
+
+def estimate_worker_memory(input_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding):
+    """Estimates the peak bytes one worker needs to parse and filter a chunk of chunk_size rows."""
+    with open_whole_file(input_file_path) as input_file:
+        sample = pd.read_csv(input_file, usecols=columns_to_read, dtype=dtypes_to_read, nrows=memory_sample_rows, encoding=file_encoding, on_bad_lines='skip')
+    if sample.empty:
+        return 0
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    return int(bytes_per_row * chunk_size * chunk_memory_overhead_factor)
+
+def get_worker_count(requested_workers, memory_per_worker):
+    """Caps the requested worker count by the CPU count and the available memory."""
+    worker_count = min(requested_workers, os.cpu_count() or 1)
+
+    # Leave room for the parent process, which also holds one chunk while merging
+    available_memory = get_available_memory()
+    if available_memory and memory_per_worker:
+        memory_capped_workers = int(available_memory // memory_per_worker) - 1
+        if memory_capped_workers < worker_count:
+            print(f"Limiting workers to {max(memory_capped_workers, 1)} of {worker_count} to fit in {available_memory / 2**30:.1f} GB of available memory")
+            worker_count = memory_capped_workers
+
+    return max(worker_count, 1)
+
+# Worker entry point used by the process pool; must stay at module level so it can be pickled
+def filter_task_to_parts(input_file_path, byte_range, column_names, file_encoding, columns_to_read, dtypes_to_read, chunk_size, chunk_filter, filter_args, part_file_paths, part_fields, engine, csv_writer='pandas', tap_count=0):
+    """Filters one file, or one byte range of it, into a part file per output.
+
+    Returns the records processed, the records written per part, and the InputFileAudit and FileMetrics of the range.
+    """
+    part_sinks = [StreamingCsvSink(part_file_path, fields_to_save, verbose=False, writer=csv_writer) for part_file_path, fields_to_save in zip(part_file_paths, part_fields)]
+    audit = InputFileAudit(input_file_path)
+    metrics = FileMetrics(input_file_path, byte_range[0] if byte_range else 0)
+    total_processed_count = 0
+    try:
+        chunks = read_award_chunks(input_file_path, columns_to_read, dtypes_to_read, chunk_size, file_encoding, byte_range, column_names, engine, audit)
+        for chunk in metrics.time_chunks(chunks):
+            audit.count_chunk(chunk)
+            total_processed_count += len(chunk)
+
+            # chunk_filter returns one DataFrame per output, in the same order as the sinks
+            with metrics.time_stage('filter'):
+                filtered_chunks = chunk_filter(chunk, *filter_args)
+            with metrics.time_stage('write'):
+                for part_sink, filtered_chunk in zip(part_sinks, filtered_chunks):
+                    part_sink.write(filtered_chunk)
+            metrics.end_chunk(chunk, *count_written_rows(filtered_chunks, tap_count))
+    except BaseException:
+        for part_sink in part_sinks:
+            part_sink.abort()
+        raise
+
+    for part_sink in part_sinks:
+        part_sink.close()
+
+    # Print the count of records processed by this worker
+    range_description = f" bytes {byte_range[0]}-{byte_range[1]}" if byte_range else ""
+    print(f"\tProcessed {total_processed_count} records from {get_input_name(input_file_path)}{range_description}")
+    return total_processed_count, [part_sink.records_written for part_sink in part_sinks], audit, metrics
+
+# A function to filter input files on a pool of worker processes and merge the results in input order
+def filter_files_in_parallel(input_file_paths, output_directory, requested_workers, columns_to_read, dtypes_to_read, chunk_size, chunk_filter, filter_args, sinks, split_files=False, engine='pandas', quarantine_directory=None,
+                             metrics=None, progress=None, csv_writer='pandas', tap_count=0):
+    """Filters the files on worker processes into part files, then appends the parts to the sinks in input order.
+
+    chunk_filter(chunk, *filter_args) must be a module-level function returning one DataFrame per sink.  With
+    split_files, large files are also split into byte ranges on record boundaries so one big file uses every
+    worker.  With a quarantine_directory, the malformed lines of each file are written there as filter_award_file
+    does.  Zip members are tasks of their own, so the members of an archive are decompressed in parallel.
+    With a RunMetrics, the stage seconds and chunks of the workers are added to the metrics of their files, and
+    the encoding detection, splitting and appending of parts done here to the same.  Progress is reported to the
+    run's ProgressReporter, or to one of these files' own, as the results of each task are merged.
+    The part files are written by csv_writer, which should be that of the CSV sinks they are appended to.  The first
+    tap_count sinks are the taps of a filter chain, whose rows are not counted as matches.
+    Returns the total number of records processed.
+    """
+    if not input_file_paths:
+        return 0
+
+    source_file_paths = input_file_paths
+    progress = progress if progress is not None else ProgressReporter(source_file_paths)
+    file_metrics = [metrics.get_file_metrics(source_file_path) if metrics is not None else FileMetrics(source_file_path) for source_file_path in source_file_paths]
+
+    # UTF-16 files are replaced by their UTF-8 copies, which can be split like any other file
+    normalized_files = []
+    for source_file_path, source_metrics in zip(source_file_paths, file_metrics):
+        with source_metrics.time_stage('detect'):
+            normalized_files.append(normalize_input_encoding(source_file_path))
+        source_metrics.set_parsed_file(normalized_files[-1][0])
+    input_file_paths, file_encodings = zip(*normalized_files)
+    if isinstance(chunk_size, AdaptiveChunkSize):
+        # The workers split the memory budget, and each one sizes its chunks within its share
+        worker_count = get_worker_count(requested_workers, chunk_size.memory_budget // requested_workers)
+        chunk_size = chunk_size.share(worker_count)
+    else:
+        memory_per_worker = estimate_worker_memory(input_file_paths[0], columns_to_read, dtypes_to_read, chunk_size, file_encodings[0])
+        worker_count = get_worker_count(requested_workers, memory_per_worker)
+
+    # Build the task list: one task per file, or one per byte range when a file is split
+    tasks = []
+    task_file_indexes = []
+    for file_index, (input_file_path, file_encoding) in enumerate(zip(input_file_paths, file_encodings)):
+        range_count = get_range_count(input_file_path, worker_count) if split_files else 1
+        if range_count > 1 and is_byte_splittable(file_encoding):
+            with file_metrics[file_index].time_stage('split'):
+                column_names = read_column_names(input_file_path, file_encoding)
+                byte_ranges = split_file_into_ranges(input_file_path, range_count)
+            for byte_range in byte_ranges:
+                tasks.append((input_file_path, byte_range, column_names, file_encoding))
+                task_file_indexes.append(file_index)
+        else:
+            # Zip members, and files with a byte order mark or another multi-byte encoding, are read by one worker as a whole
+            tasks.append((input_file_path, None, None, file_encoding))
+            task_file_indexes.append(file_index)
+
+    if not tasks:
+        return 0
+    worker_count = min(worker_count, len(tasks))
+    print(f"Filtering {len(input_file_paths)} files as {len(tasks)} tasks on {worker_count} worker processes")
+
+    # Each task gets its own part file per output, next to the final outputs
+    part_fields = [sink.fields_to_save for sink in sinks]
+    task_part_file_paths = []
+    for task_index in range(len(tasks)):
+        task_part_file_paths.append([os.path.join(output_directory, f"{os.path.basename(sink.output_file_path)}.{task_index:05d}.part") for sink in sinks])
+
+    total_processed_count = 0
+    file_audits = [InputFileAudit(source_file_path) for source_file_path in source_file_paths]
+    try:
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            futures = []
+            for (input_file_path, byte_range, column_names, file_encoding), part_file_paths in zip(tasks, task_part_file_paths):
+                futures.append(executor.submit(filter_task_to_parts, input_file_path, byte_range, column_names, file_encoding, columns_to_read, dtypes_to_read,
+                                               chunk_size, chunk_filter, filter_args, part_file_paths, part_fields, engine, csv_writer, tap_count))
+
+            # Merge in submission order so the outputs match a serial run row for row
+            progress_file_index = None
+            for future, part_file_paths, file_index, (_, byte_range, _, _) in zip(futures, task_part_file_paths, task_file_indexes, tasks):
+                if file_index != progress_file_index:
+                    if progress_file_index is not None:
+                        progress.finish_file()
+                    progress.start_file(source_file_paths[file_index], input_file_paths[file_index])
+                    progress_file_index = file_index
+                processed_count, part_records, task_audit, task_metrics = future.result()
+                total_processed_count += processed_count
+                file_audits[file_index].merge(task_audit)
+                file_metrics[file_index].merge(task_metrics)
+                with file_metrics[file_index].time_stage('concat'):
+                    for sink, part_file_path, records in zip(sinks, part_file_paths, part_records):
+                        sink.append_part(part_file_path, records)
+
+                # The tasks of a file are merged in order, so the file has been read up to the end of this task's range
+                if byte_range:
+                    progress.set_position(byte_range[1])
+                progress.add_chunk(processed_count, sum(part_records[tap_count:]))
+            if progress_file_index is not None:
+                progress.finish_file()
+    finally:
+        # Remove part files left behind by a failed worker
+        for part_file_path in [path for part_file_paths in task_part_file_paths for path in part_file_paths]:
+            if os.path.exists(part_file_path):
+                os.remove(part_file_path)
+
+    # Quarantine the malformed lines and record the counters of each file
+    if quarantine_directory:
+        for file_audit, input_file_path, file_encoding in zip(file_audits, input_file_paths, file_encodings):
+            file_audit.report(quarantine_directory, input_file_path, file_encoding)
+
+    return total_processed_count
@@ -0,0 +1,156 @@
+import os
+import glob
+import json
+import itertools
+from award_filter import filter_chunk_for_profiles
+from encoding_detection import normalize_input_encoding
+from run_manifest import get_file_fingerprint
+from input_files import list_input_files, get_input_name
+from chunk_reader import read_award_chunks
+from chunk_predicates import CodeMatcher
+
+# Name of the file in the store that records which raw CSVs have been ingested; files starting with '_' are
+# ignored by pyarrow's dataset discovery, so it never gets read as data
+ingested_files_name = '_ingested_files.json'
+
+# Rows per Parquet row group; row group statistics let queries skip groups without matching codes
+rows_per_row_group = 250000
+
+def get_store_partitioning():
+    """Returns the hive partitioning of the store: fiscal year, then DoD vs. civilian funding agency."""
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+    return pa_ds.partitioning(pa.schema([('action_date_fiscal_year', pa.int64()), ('funding_group', pa.string())]), flavor='hive')
+
+def add_funding_group(batch):
+    """Adds the funding_group partition column: 'dod' for Department of Defense funded records, 'fedciv' for the rest."""
+    import pyarrow.compute as pc
+    is_dod = pc.fill_null(pc.equal(batch.column('funding_agency_name'), 'Department of Defense'), False)
+    return batch.append_column('funding_group', pc.if_else(is_dod, 'dod', 'fedciv'))
+
+def ingest_csv_file(input_file_path, store_directory, dtype_mapping):
+    """Converts one raw award CSV into Parquet files in the store, replacing any earlier ingest of the same file."""
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+
+    source_name = os.path.splitext(get_input_name(input_file_path))[0]
+
+    # Remove the fragments of an earlier ingest of this file so changed files do not leave stale rows behind
+    for old_fragment in glob.glob(os.path.join(glob.escape(store_directory), '**', f'{glob.escape(source_name)}-part-*.parquet'), recursive=True):
+        os.remove(old_fragment)
+
+    csv_file_path, file_encoding = normalize_input_encoding(input_file_path)
+    batches = (add_funding_group(batch) for batch in read_award_chunks(csv_file_path, None, dtype_mapping, None, file_encoding, engine='pyarrow'))
+
+    # The first batch gives the schema of the whole file
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return 0
+
+    records_ingested = 0
+    def count_batches():
+        nonlocal records_ingested
+        for batch in itertools.chain([first_batch], batches):
+            records_ingested += batch.num_rows
+            yield batch
+
+    parquet_options = pa_ds.ParquetFileFormat().make_write_options(compression='zstd')
+    pa_ds.write_dataset(pa.RecordBatchReader.from_batches(first_batch.schema, count_batches()), store_directory, format='parquet',
+                        partitioning=get_store_partitioning(), basename_template=f'{source_name}-part-{{i}}.parquet',
+                        existing_data_behavior='overwrite_or_ignore', file_options=parquet_options,
+                        min_rows_per_group=rows_per_row_group, max_rows_per_group=rows_per_row_group)
+    return records_ingested
+
+# A function to convert every raw csv file in a directory into the Parquet store, once per file version
+def build_parquet_store(input_directory, store_directory, dtype_mapping):
+    """Ingests the new or changed CSV files of input_directory, and of its zip archives, into a Parquet dataset partitioned by fiscal year and funding group."""
+    os.makedirs(store_directory, exist_ok=True)
+
+    # Load the record of files already ingested
+    ingested_files_path = os.path.join(store_directory, ingested_files_name)
+    ingested_files = {}
+    if os.path.exists(ingested_files_path):
+        with open(ingested_files_path, 'r', encoding='utf-8') as ingested_files_file:
+            ingested_files = json.load(ingested_files_file)
+
+    for input_file_path in list_input_files(input_directory):
+        filename = get_input_name(input_file_path)
+        fingerprint = get_file_fingerprint(input_file_path)
+        if ingested_files.get(filename) == fingerprint:
+            print(f"Skipping {filename}: already ingested")
+            continue
+
+        records_ingested = ingest_csv_file(input_file_path, store_directory, dtype_mapping)
+        print(f"Ingested {records_ingested} records from {filename}")
+
+        # Record the ingest after each file so an interrupted build resumes where it stopped
+        ingested_files[filename] = fingerprint
+        with open(ingested_files_path, 'w', encoding='utf-8') as ingested_files_file:
+            json.dump(ingested_files, ingested_files_file, indent=2)
+
+def get_codes_expression(field_name, codes):
+    """Builds the dataset filter for a code set, or for the exact codes and category prefixes of a CodeMatcher."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pa_ds
+
+    field = pa_ds.field(field_name)
+    if not isinstance(codes, CodeMatcher):
+        return field.isin(list(codes))
+
+    expression = field.isin(list(codes.exact_codes))
+    for prefix_length, prefixes in codes.prefixes_by_length:
+        expression = expression | pc.is_in(pc.utf8_slice_codeunits(field, 0, prefix_length), value_set=pa.array(list(prefixes)))
+    return expression
+
+def get_award_filter_expression(naics_codes_hash_set=None, psc_codes_hash_set=None, funding_group=None, excluded_awarding_sub_agencies=('Federal Acquisition Service',)):
+    """Builds the dataset filter for NAICS and PSC codes and excluded awarding sub agencies, as filter_chunk_for_profiles applies them.
+
+    A code set of None skips that predicate; funding_group ('dod' or 'fedciv') prunes whole partitions.
+    """
+    import pyarrow.dataset as pa_ds
+
+    # Weed out records from excluded sub agencies such as GSA MAS schedule actions; missing values are kept, as in the CSV filters
+    expression = pa_ds.scalar(True)
+    awarding_sub_agency = pa_ds.field('awarding_sub_agency_name')
+    for excluded_agency in excluded_awarding_sub_agencies or []:
+        expression = expression & ((awarding_sub_agency != excluded_agency) | awarding_sub_agency.is_null())
+    if naics_codes_hash_set is not None:
+        expression = expression & get_codes_expression('naics_code', naics_codes_hash_set)
+    if psc_codes_hash_set is not None:
+        expression = expression & get_codes_expression('product_or_service_code', psc_codes_hash_set)
+    if funding_group is not None:
+        expression = expression & (pa_ds.field('funding_group') == funding_group)
+    return expression
+
+def get_profiles_filter_expression(filter_profiles):
+    """Builds a dataset filter that keeps any row matched by at least one of the filter profiles."""
+    expression = None
+    for filter_profile in filter_profiles:
+        profile_expression = get_award_filter_expression(filter_profile.get('naics_codes'), filter_profile.get('psc_codes'), None,
+                                                         filter_profile.get('excluded_awarding_sub_agencies'))
+        expression = profile_expression if expression is None else expression | profile_expression
+    return expression
+
+def read_store_chunks(store_directory, columns_to_read, filter_expression):
+    """Yields pyarrow RecordBatches of the store rows matching filter_expression, reading only columns_to_read.
+
+    Partition pruning and Parquet row group statistics skip data that cannot match.  Rows come back grouped
+    by partition rather than in raw file order.
+    """
+    import pyarrow.dataset as pa_ds
+    dataset = pa_ds.dataset(store_directory, format='parquet', partitioning=get_store_partitioning())
+    for batch in dataset.to_batches(columns=columns_to_read, filter=filter_expression):
+        if batch.num_rows:
+            yield batch
+
+# A function to filter the Parquet store instead of the raw csv files
+def filter_parquet_store(store_directory, columns_to_read, filter_profiles, sinks):
+    """Queries the store once for the rows any profile can match, then routes them to the sinks of each profile."""
+    total_matched_count = 0
+    for batch in read_store_chunks(store_directory, columns_to_read, get_profiles_filter_expression(filter_profiles)):
+        for sink, filtered_chunk in zip(sinks, filter_chunk_for_profiles(batch, filter_profiles)):
+            sink.write(filtered_chunk)
+        total_matched_count += batch.num_rows
+    print(f"Matched {total_matched_count} records in the Parquet store {store_directory}")
+    return total_matched_count
@@ -0,0 +1,186 @@
+import os
+import csv
+import json
+import time
+from contextlib import contextmanager
+from chunk_sizing import memory_sample_rows
+from input_files import get_input_name, get_input_size, is_zip_member
+
+# The timed stages of the pipeline, in pipeline order:
+#   detect - detecting the encoding of an input and making the UTF-8 copy of a UTF-16 one
+#   split  - splitting a large input into byte ranges for the worker processes
+#   parse  - reading the chunks of an input
+#   filter - evaluating the predicates and selecting the rows of each output
+#   concat - concatenating filtered chunks, or appending worker parts and cached results to the outputs
+#   write  - writing the filtered rows to the outputs
+pipeline_stages = ['detect', 'split', 'parse', 'filter', 'concat', 'write']
+
+# The report of the latest run, with every chunk, and the per-file history appended to by every run
+metrics_report_file_name = 'pipeline_metrics.json'
+metrics_history_file_name = 'pipeline_metrics.csv'
+
+def get_chunk_memory_bytes(chunk):
+    """Returns the memory a parsed chunk takes, exactly for a pyarrow RecordBatch and from an evenly spaced sample of a DataFrame."""
+    if not hasattr(chunk, 'memory_usage'):
+        return chunk.nbytes
+    if len(chunk) == 0:
+        return 0
+    sample = chunk.iloc[::max(len(chunk) // memory_sample_rows, 1)]
+    return int(sample.memory_usage(deep=True, index=False).sum() / len(sample) * len(chunk))
+
+def get_column_memory_bytes(chunk):
+    """Returns the exact memory of each column of a parsed chunk, a DataFrame with its strings or a pyarrow RecordBatch or Table."""
+    if hasattr(chunk, 'memory_usage'):
+        return chunk.memory_usage(deep=True, index=False).to_dict()
+    return {column_name: column.nbytes for column_name, column in zip(chunk.schema.names, chunk.columns)}
+
+# Durations, rows and bytes of the stages of one input file
+class FileMetrics:
+    """The seconds spent in each pipeline stage on an input file, its rows read and written, and the same per chunk.
+
+    time_stage() adds to both the file's and the current chunk's stage seconds, and end_chunk() records the
+    chunk.  The rows written to the taps of a filter chain repeat rows of its output, so they are counted apart
+    and left out of the rows written.  A row written to several outputs counts once for each, so written_per_row_read
+    can exceed 1 and is not a match rate.  Chunks are numbered within the byte range starting at range_start, as worker processes read them.
+    An input that is not a file, such as a Parquet store directory, has no input_bytes.  The parse rate is of the
+    parsed_bytes of the file actually parsed, which set_parsed_file() sets for a UTF-16 input read through its UTF-8 copy.
+    """
+
+    def __init__(self, input_file_path, range_start=0):
+        self.input_name = get_input_name(input_file_path)
+        self.input_bytes = get_input_size(input_file_path) if is_zip_member(input_file_path) or os.path.isfile(input_file_path) else None
+        self.parsed_bytes = self.input_bytes
+        self.range_start = range_start
+        self.stage_seconds = dict.fromkeys(pipeline_stages, 0.0)
+        self.rows_read = 0
+        self.rows_written = 0
+        self.tap_rows_written = 0
+        self.chunks = []
+        self.chunk_stage_seconds = dict.fromkeys(pipeline_stages, 0.0)
+
+    @contextmanager
+    def time_stage(self, stage):
+        """Times the code in the with block as stage."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_duration = time.perf_counter() - start_time
+            self.stage_seconds[stage] += stage_duration
+            self.chunk_stage_seconds[stage] += stage_duration
+
+    def set_parsed_file(self, csv_file_path):
+        """Records the size of the file parsed in place of the input, as normalize_input_encoding returns it."""
+        self.parsed_bytes = get_input_size(csv_file_path)
+
+    def time_chunks(self, chunks):
+        """Yields the chunks of an iterator, timing the reading of each one as the parse stage."""
+        chunks = iter(chunks)
+        while True:
+            with self.time_stage('parse'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def end_chunk(self, chunk, rows_written, tap_rows_written=0):
+        """Records a chunk read and the rows written from it, and to any taps, with the stage seconds since the previous chunk."""
+        self.rows_read += len(chunk)
+        self.rows_written += rows_written
+        self.tap_rows_written += tap_rows_written
+        self.chunks.append({
+            'range_start': self.range_start,
+            'chunk': len(self.chunks) + 1,
+            'rows': len(chunk),
+            'memory_bytes': get_chunk_memory_bytes(chunk),
+            'rows_written': rows_written,
+            'written_per_row_read': round(rows_written / len(chunk), 6) if len(chunk) else None,
+            **({'tap_rows_written': tap_rows_written} if tap_rows_written else {}),
+            **{f'{stage}_seconds': round(seconds, 6) for stage, seconds in self.chunk_stage_seconds.items() if seconds},
+        })
+        self.chunk_stage_seconds = dict.fromkeys(pipeline_stages, 0.0)
+
+    def merge(self, other_metrics):
+        """Adds the metrics of another part of the same file, e.g. of one byte range read by a worker."""
+        for stage, seconds in other_metrics.stage_seconds.items():
+            self.stage_seconds[stage] += seconds
+        self.rows_read += other_metrics.rows_read
+        self.rows_written += other_metrics.rows_written
+        self.tap_rows_written += other_metrics.tap_rows_written
+        self.chunks += other_metrics.chunks
+
+    def get_summary(self):
+        """Returns the totals of the file as JSON-friendly values."""
+        parse_seconds = self.stage_seconds['parse']
+        return {
+            'input_file': self.input_name,
+            'input_bytes': self.input_bytes,
+            'parsed_bytes': self.parsed_bytes,
+            'rows_read': self.rows_read,
+            'rows_written': self.rows_written,
+            'written_per_row_read': round(self.rows_written / self.rows_read, 6) if self.rows_read else None,
+            'chunks': len(self.chunks),
+            'parsed_rows_per_second': round(self.rows_read / parse_seconds) if parse_seconds else None,
+            'parsed_megabytes_per_second': round(self.parsed_bytes / 1e6 / parse_seconds, 2) if parse_seconds and self.rows_read and self.parsed_bytes else None,
+            **{f'{stage}_seconds': round(seconds, 3) for stage, seconds in self.stage_seconds.items()},
+        }
+
+# The metrics of every input file of a run
+class RunMetrics:
+    """Collects the FileMetrics of a run and writes them to the output directory when it ends.
+
+    pipeline_metrics.json holds the latest run with every chunk; pipeline_metrics.csv gets one row per input
+    file of every run, so stage durations and throughput can be compared across runs.  The seconds of the run
+    also count what no stage covers, such as finishing the outputs.
+    """
+
+    def __init__(self, run_name):
+        self.run_name = run_name
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.start_time = time.perf_counter()
+        self.file_metrics = {}
+
+    def get_file_metrics(self, input_file_path):
+        """Returns the FileMetrics of an input file, adding it on first use."""
+        input_name = get_input_name(input_file_path)
+        if input_name not in self.file_metrics:
+            self.file_metrics[input_name] = FileMetrics(input_file_path)
+        return self.file_metrics[input_name]
+
+    def write_report(self, output_directory):
+        """Writes the report of this run and appends its files to the history, and prints where they are."""
+        run_seconds = time.perf_counter() - self.start_time
+        file_summaries = [file_metrics.get_summary() for file_metrics in self.file_metrics.values()]
+        report = {
+            'run': self.run_name,
+            'started': self.started,
+            'seconds': round(run_seconds, 3),
+            'input_bytes': sum(file_summary['input_bytes'] or 0 for file_summary in file_summaries),
+            'rows_read': sum(file_summary['rows_read'] for file_summary in file_summaries),
+            'rows_written': sum(file_summary['rows_written'] for file_summary in file_summaries),
+            'tap_rows_written': sum(file_metrics.tap_rows_written for file_metrics in self.file_metrics.values()),
+            'stage_seconds': {stage: round(sum(file_metrics.stage_seconds[stage] for file_metrics in self.file_metrics.values()), 3) for stage in pipeline_stages},
+            'files': file_summaries,
+            'chunks': [{'input_file': input_name, **chunk} for input_name, file_metrics in self.file_metrics.items() for chunk in file_metrics.chunks],
+        }
+        report_file_path = os.path.join(output_directory, metrics_report_file_name)
+        with open(report_file_path, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+        # A run that filtered no files, e.g. because the manifest skipped them all, adds nothing to the history
+        if file_summaries:
+            history_file_path = os.path.join(output_directory, metrics_history_file_name)
+            history_fields = ['run', 'started', 'run_seconds'] + list(file_summaries[0])
+            write_header = not os.path.exists(history_file_path)
+            with open(history_file_path, 'a', newline='', encoding='utf-8') as history_file:
+                writer = csv.DictWriter(history_file, history_fields)
+                if write_header:
+                    writer.writeheader()
+                for file_summary in file_summaries:
+                    writer.writerow({'run': self.run_name, 'started': self.started, 'run_seconds': round(run_seconds, 3), **file_summary})
+
+        stage_summary = ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in report['stage_seconds'].items() if seconds)
+        if stage_summary:
+            print(f"Stage times: {stage_summary}; metrics saved to: {report_file_path}")
+        else:
+            print(f"Metrics saved to: {report_file_path}")
@@ -0,0 +1,97 @@
+import time
+from input_files import get_input_name, get_input_size
+
+# Seconds between two progress lines; the line ending each file is always written
+progress_interval_seconds = 10
+
+def format_duration(seconds):
+    """Returns a number of seconds as H:MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+# Progress of a run through the bytes of its input files
+class ProgressReporter:
+    """Reports how far a run is through its input files by bytes read, with MB/s, rows/s, rows written and ETA.
+
+    The readers report the position they have reached in the current file with set_position(), and the consumer
+    reports each chunk with add_chunk(), which writes a line at most every interval_seconds.  Bytes before the
+    position a file starts at, such as the offset of a resumed checkpoint, count as done but not toward the rates.
+    With a log_file_path, the lines are appended to that file with a timestamp instead of printed.
+    """
+
+    def __init__(self, input_file_paths, interval_seconds=progress_interval_seconds, log_file_path=None):
+        self.total_bytes = sum(get_input_size(input_file_path) for input_file_path in input_file_paths)
+        self.interval_seconds = interval_seconds
+        self.log_file_path = log_file_path
+        self.start_time = time.perf_counter()
+        self.last_report_time = None
+        self.finished_bytes = 0
+        self.skipped_bytes = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.file_name = None
+        self.file_bytes = 0
+        self.position = 0
+
+    def start_file(self, input_file_path, csv_file_path=None, start_position=0):
+        """Starts on an input file, read from csv_file_path, e.g. its UTF-8 copy, when given, from start_position on."""
+        input_bytes = get_input_size(input_file_path)
+        self.file_name = get_input_name(input_file_path)
+        self.file_bytes = get_input_size(csv_file_path) if csv_file_path is not None else input_bytes
+        # A UTF-8 copy is about half the size of its UTF-16 original
+        self.total_bytes += self.file_bytes - input_bytes
+        self.file_start_time = time.perf_counter()
+        self.file_start_position = start_position
+        self.file_rows_read = 0
+        self.file_rows_written = 0
+        self.position = start_position
+        self.skipped_bytes += start_position
+
+    def set_position(self, position):
+        """Records the byte offset read up to in the current file."""
+        self.position = position
+
+    def add_chunk(self, rows_read, rows_written):
+        """Counts the rows of a chunk and the rows of it written to the outputs, and reports if the interval has passed."""
+        self.rows_read += rows_read
+        self.rows_written += rows_written
+        self.file_rows_read += rows_read
+        self.file_rows_written += rows_written
+        now = time.perf_counter()
+        if self.last_report_time is None or now - self.last_report_time >= self.interval_seconds:
+            self.last_report_time = now
+            self.write_line(self.get_progress_line(now))
+
+    def finish_file(self):
+        """Counts the rest of the current file as read and reports the file's totals."""
+        self.finished_bytes += self.file_bytes
+        self.position = 0
+        file_seconds = time.perf_counter() - self.file_start_time
+        file_megabytes_per_second = (self.file_bytes - self.file_start_position) / 1e6 / file_seconds if file_seconds else 0
+        self.write_line(f"Finished {self.file_name}: {self.file_rows_read:,} rows read, {self.file_rows_written:,} rows written "
+                        f"in {format_duration(file_seconds)} at {file_megabytes_per_second:.1f} MB/s")
+
+    def get_progress_line(self, now):
+        """Returns the progress line of the current file and the whole run."""
+        seconds = now - self.start_time
+        done_bytes = self.finished_bytes + self.position
+        bytes_per_second = (done_bytes - self.skipped_bytes) / seconds if seconds else 0
+        rows_per_second = self.rows_read / seconds if seconds else 0
+        file_share = self.position / self.file_bytes if self.file_bytes else 1
+        total_share = done_bytes / self.total_bytes if self.total_bytes else 1
+        if bytes_per_second:
+            file_eta = format_duration((self.file_bytes - self.position) / bytes_per_second)
+            total_eta = format_duration((self.total_bytes - done_bytes) / bytes_per_second)
+        else:
+            file_eta = total_eta = 'unknown'
+        return (f"{self.file_name}: {file_share:.1%} of {self.file_bytes / 1e6:,.0f} MB, all inputs {total_share:.1%} of {self.total_bytes / 1e6:,.0f} MB | "
+                f"{bytes_per_second / 1e6:.1f} MB/s, {rows_per_second:,.0f} rows/s, {self.rows_read:,} rows read, {self.rows_written:,} written | "
+                f"ETA {file_eta} for the file, {total_eta} for all")
+
+    def write_line(self, line):
+        if self.log_file_path:
+            with open(self.log_file_path, 'a', encoding='utf-8') as log_file:
+                log_file.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {line}\n")
+        else:
+            print(line)
@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import hashlib
+from input_files import get_input_name, get_input_size, get_input_mtime, open_input_file
+
+# Directory, inside the output directory, that holds the manifest and the cached filtered result of each input file
+run_cache_directory_name = '.run_cache'
+manifest_file_name = 'manifest.json'
+checkpoint_file_name = 'checkpoint.json'
+
+# Bytes read at a time while hashing file contents
+hash_block_bytes = 8 * 1024 * 1024
+
+def get_file_fingerprint(file_path):
+    """Returns the size and modification time used to tell whether a raw file, or a zip member, changed since it was last processed."""
+    return {'size': get_input_size(file_path), 'mtime': get_input_mtime(file_path)}
+
+def get_content_hash(file_path):
+    """Returns the SHA-256 of a file's contents; a zip member is hashed uncompressed."""
+    content_hash = hashlib.sha256()
+    with open_input_file(file_path) as file:
+        for block in iter(lambda: file.read(hash_block_bytes), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+def encode_setting(value):
+    """Turns the sets and frozensets in filter profiles into sorted lists so they hash the same on every run."""
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Cannot hash setting of type {type(value).__name__}")
+
+def get_settings_hash(*settings):
+    """Returns a hash of everything that decides what a filtered result contains, e.g. the filter profiles and output fields."""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=encode_setting).encode('utf-8')).hexdigest()
+
+# A record of the filtered result cached for each input file, so a re-run only parses new or changed files
+class RunManifest:
+    """Tracks each input file's fingerprint and the records it contributed to each output, for one settings hash.
+
+    The results of a file are cached as one CSV per output under .run_cache/<input file name>/ in the output
+    directory.  A change to the settings hash invalidates every cached result.
+    """
+
+    def __init__(self, output_directory, settings_hash, hash_contents=False):
+        self.cache_directory = os.path.join(output_directory, run_cache_directory_name)
+        self.manifest_path = os.path.join(self.cache_directory, manifest_file_name)
+        self.settings_hash = settings_hash
+        self.hash_contents = hash_contents
+        self.files = {}
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('settings_hash') == settings_hash:
+                self.files = manifest.get('files', {})
+            else:
+                print("Filter settings changed since the last run; every input file will be processed again")
+
+    def get_result_file_paths(self, input_file_path, output_file_names):
+        """Returns the cached result paths of an input file, one per output."""
+        result_directory = os.path.join(self.cache_directory, get_input_name(input_file_path))
+        return [os.path.join(result_directory, output_file_name) for output_file_name in output_file_names]
+
+    def is_current(self, input_file_path, output_file_names):
+        """Returns True if the cached results of a file are still valid for its current contents."""
+        entry = self.files.get(get_input_name(input_file_path))
+        if entry is None or list(entry['records']) != list(output_file_names):
+            return False
+
+        fingerprint = get_file_fingerprint(input_file_path)
+        if fingerprint['size'] != entry['size']:
+            return False
+        if fingerprint['mtime'] != entry['mtime']:
+            # A file that was touched or downloaded again with the same contents keeps its results when hashing is on
+            if not (self.hash_contents and entry.get('sha256') and get_content_hash(input_file_path) == entry['sha256']):
+                return False
+            entry['mtime'] = fingerprint['mtime']
+            self.save()
+
+        # Outputs with no records have no result file
+        result_file_paths = self.get_result_file_paths(input_file_path, output_file_names)
+        return all(os.path.exists(result_file_path) for result_file_path, records in zip(result_file_paths, entry['records'].values()) if records)
+
+    def get_checkpoint_path(self, input_file_path):
+        """Returns where the checkpoint of a file being processed into its cached results is kept."""
+        return os.path.join(self.cache_directory, get_input_name(input_file_path), checkpoint_file_name)
+
+    def prepare_results(self, input_file_path, output_file_names, keep_partial_results=False):
+        """Forgets the cached results of a file and returns result paths for it to be processed into.
+
+        The partial results of an interrupted run are kept when keep_partial_results is set, so it can resume from its checkpoint.
+        """
+        filename = get_input_name(input_file_path)
+        self.files.pop(filename, None)
+        result_file_paths = self.get_result_file_paths(input_file_path, output_file_names)
+        result_directory = os.path.dirname(result_file_paths[0])
+        if not keep_partial_results:
+            shutil.rmtree(result_directory, ignore_errors=True)
+        os.makedirs(result_directory, exist_ok=True)
+        return result_file_paths
+
+    def record(self, input_file_path, output_file_names, records_per_output):
+        """Records that a file was processed into its cached results, and saves the manifest right away."""
+        entry = get_file_fingerprint(input_file_path)
+        if self.hash_contents:
+            entry['sha256'] = get_content_hash(input_file_path)
+        entry['records'] = dict(zip(output_file_names, records_per_output))
+        self.files[get_input_name(input_file_path)] = entry
+        self.save()
+
+    def get_records(self, input_file_path):
+        """Returns the number of records a file contributed to each output, in output order."""
+        return list(self.files[get_input_name(input_file_path)]['records'].values())
+
+    def forget_removed_files(self, input_file_paths):
+        """Drops the entries and cached results of files no longer in the input directory."""
+        filenames = {get_input_name(input_file_path) for input_file_path in input_file_paths}
+        for filename in [filename for filename in self.files if filename not in filenames]:
+            del self.files[filename]
+            shutil.rmtree(os.path.join(self.cache_directory, filename), ignore_errors=True)
+        self.save()
+
+    def save(self):
+        """Writes the manifest atomically, so an interrupted run keeps the results of the files it finished."""
+        os.makedirs(self.cache_directory, exist_ok=True)
+        temp_file_path = self.manifest_path + '.tmp'
+        with open(temp_file_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'settings_hash': self.settings_hash, 'files': self.files}, manifest_file, indent=2)
+        os.replace(temp_file_path, self.manifest_path)
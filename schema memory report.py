@@ -0,0 +1,102 @@
+import os
+import csv
+import time
+from award_schema import dtype_mapping, compact_dtype_mapping, low_cardinality_fields, flag_fields, narrow_integer_types
+from encoding_detection import normalize_input_encoding
+from input_files import list_input_files, get_input_name
+from chunk_reader import read_award_chunks
+from pipeline_metrics import get_column_memory_bytes
+
+#start a timer to measure total elapsed time
+script_start_time = time.time()
+
+# Measure the memory of the first chunk of each raw award CSV parsed with the declared dtype_mapping, where nearly
+# every column is a string, and with the compact schema the filter scripts read with, column by column.  The
+# report is saved next to the outputs with one row per file, parser and column, and the totals per chunk of
+# report_chunk_rows rows are printed by kind of column.
+
+# Define the input directory and the report
+input_directory = r"C:\temp\awards"
+output_directory = os.path.join(input_directory, "out")
+report_file_path = os.path.join(output_directory, "schema_memory_report.csv")
+
+# Rows in the chunk measured; files with fewer rows are measured whole and scaled to this many rows
+report_chunk_rows = 250000
+
+# Parsers to measure: 'pandas' and 'pyarrow'
+csv_engines = ['pandas', 'pyarrow']
+
+def get_column_kind(column):
+    """Returns how the compact schema changes a column: categorical, flag, narrow integer or unchanged."""
+    if column in flag_fields:
+        return 'flag'
+    if column in low_cardinality_fields:
+        return 'categorical'
+    if column in narrow_integer_types:
+        return 'narrow integer'
+    return 'unchanged'
+
+def read_report_chunk(input_file_path, dtypes_to_read, engine):
+    """Returns the first report_chunk_rows rows of an input as one DataFrame, or as one pyarrow Table of its first batches."""
+    csv_file_path, file_encoding = normalize_input_encoding(input_file_path)
+    chunks = read_award_chunks(csv_file_path, None, dtypes_to_read, report_chunk_rows, file_encoding, engine=engine)
+    if engine == 'pandas':
+        chunk = next(chunks, None)
+        chunks.close()
+        return chunk
+
+    # pyarrow batches are sized in bytes, so gather them up to the rows of a chunk
+    import pyarrow as pa
+    batches = []
+    for batch in chunks:
+        batches.append(batch)
+        if sum(len(batch) for batch in batches) >= report_chunk_rows:
+            break
+    chunks.close()
+    return pa.Table.from_batches(batches).slice(0, report_chunk_rows) if batches else None
+
+os.makedirs(output_directory, exist_ok=True)
+report_fields = ['input_file', 'engine', 'rows', 'column', 'kind', 'declared_dtype', 'compact_dtype', 'declared_bytes', 'compact_bytes']
+with open(report_file_path, 'w', newline='', encoding='utf-8') as report_file:
+    writer = csv.DictWriter(report_file, report_fields)
+    writer.writeheader()
+    for input_file_path in list_input_files(input_directory):
+        for engine in csv_engines:
+            declared_chunk = read_report_chunk(input_file_path, dtype_mapping, engine)
+            compact_chunk = read_report_chunk(input_file_path, compact_dtype_mapping, engine)
+            if declared_chunk is None:
+                continue
+            declared_bytes = get_column_memory_bytes(declared_chunk)
+            compact_bytes = get_column_memory_bytes(compact_chunk)
+
+            # Scale to a full chunk, so files of different sizes compare
+            rows = len(declared_chunk)
+            scale = report_chunk_rows / rows
+            kind_bytes = {}
+            for column in declared_bytes:
+                kind = get_column_kind(column)
+                writer.writerow({'input_file': get_input_name(input_file_path), 'engine': engine, 'rows': rows, 'column': column, 'kind': kind,
+                                 'declared_dtype': dtype_mapping.get(column), 'compact_dtype': compact_dtype_mapping.get(column),
+                                 'declared_bytes': declared_bytes[column], 'compact_bytes': compact_bytes[column]})
+                before, after = kind_bytes.get(kind, (0, 0))
+                kind_bytes[kind] = (before + declared_bytes[column], after + compact_bytes[column])
+
+            # Print the memory of a chunk before and after, in total and by kind of column
+            declared_total = sum(declared_bytes.values()) * scale
+            compact_total = sum(compact_bytes.values()) * scale
+            print(f"{get_input_name(input_file_path)}, {engine}: {declared_total / 1e6:,.0f} MB per {report_chunk_rows:,}-row chunk declared, "
+                  f"{compact_total / 1e6:,.0f} MB compact ({1 - compact_total / declared_total:.0%} less)")
+            for kind, (before, after) in sorted(kind_bytes.items()):
+                print(f"\t{kind}: {before * scale / 1e6:,.1f} MB -> {after * scale / 1e6:,.1f} MB")
+
+print(f"Memory report saved to: {report_file_path}")
+
+#End the timer to measure total script elapsed time
+script_duration = time.time() - script_start_time
+
+# Convert duration into hours, minutes, and seconds for readability
+hours, remainder = divmod(script_duration, 3600)
+minutes, seconds = divmod(remainder, 60)
+
+# Print user-friendly execution time
+print(f"Script processing time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")